@@ -1,15 +1,25 @@
 import streamlit as st
-import tools.qdb as qdb
+import tools.snapshots as snapshots
 
-# Initialize the database
-qdb.setup_database(qdb.duckdb_conn)
+# The database is opened by the first page that queries it, so the home page starts without it
 
 # Navigation
 home = st.Page("pages/0_home.py", title="Home", icon="🏠")
 document = st.Page("pages/1_document.py", title="Documentation", icon="📄")
 request = st.Page("pages/2_request.py", title="Create a request", icon="📝")
 dashboard = st.Page("pages/3_dashboard.py", title="Dashboard", icon="📊")
+# not in the menu, open /performance to see query timings
+performance = st.Page("pages/4_performance.py", title="Performance", icon="⏱️", url_path="performance")
 
-nav_bar = st.navigation([home, document, request, dashboard])
+# replicas read a snapshot and cannot create requests, those go to the writer process
+if snapshots.is_replica():
+    menu = [home, document, dashboard]
+else:
+    menu = [home, document, request, dashboard]
+
+# streamlit 1.51 cannot hide a single page, so the menu is drawn from links and the built-in one is hidden
+nav_bar = st.navigation([*menu, performance], position="hidden")
+for page in menu:
+    st.sidebar.page_link(page)
 
 nav_bar.run()
\ No newline at end of file
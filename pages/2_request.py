@@ -1,131 +1,235 @@
 import streamlit as st
 import tools.qdb as qdb
-import tools.utils as utils
-import pandas as pd
-import time
-
-# function to validate the request from the customer point of view
-def customer_validate_request(customer_id, supplier, request_date, request_type):
-    #check that contains who, where and when
-    if not customer_id or not supplier or not request_date:
-        st.error("Please fill in all required fields: Customer ID, Supplier, and Request Date.")
-        return False
-    #check that request type is valid
-    valid_request_types = ["GMP", "GVP", "GCP"]
-    if request_type not in valid_request_types:
-        st.error(f"Invalid request type. Please choose from: {', '.join(valid_request_types)}.")
-        return False
-    
-    # check customer has enough credits
-    # GMP = 1 credit, GVP = 2 credits, GCP = 3 credits
-    required_credits = {"GMP": 1, "GVP": 2, "GCP": 3}
-    customer_credits = utils.get_customer_credits(qdb.duckdb_conn, customer_id)
-
-    if customer_credits < required_credits[request_type]:
-        st.error(f"Customer does not have enough credits for {request_type}. Required: {required_credits[request_type]}, Available: {customer_credits}.")
+import tools.ledger as ledger
+import tools.validation as validation
+import tools.dimensions as dimensions
+import tools.event_log as event_log
+import tools.request_writer as request_writer
+import tools.browser as browser
+import tools.bulk_jobs as bulk_jobs
+import io
+import os
+
+# requests are written from this page, they and their events are written in batches on background threads
+event_log.start(qdb.connections)
+request_writer.start(qdb.connections)
+
+# rules about the customer, any other failed rule is about the supplier
+CUSTOMER_RULES = {"completeness", "credit_balance"}
+
+
+def validate_request(customer_id, supplier_id, request_date, request_type):
+    """Run the validation pipeline and record the request if every rule passed."""
+    request = validation.ValidationRequest(customer_id, supplier_id, request_date, request_type)
+    with st.spinner("Validating...", show_time=True):
+        verdict = validation.validate(qdb.connections, request)
+
+    for result in verdict.results:
+        if result.status == validation.FAILED:
+            st.error(result.message)
+            st.error("Customer validation failed." if result.name in CUSTOMER_RULES else "Supplier validation failed.")
+
+    with st.expander(f"Validation took {verdict.seconds * 1000:.1f} ms"):
+        st.table([
+            {"rule": result.name, "status": result.status, "ms": round(result.seconds * 1000, 2), "detail": result.message}
+            for result in verdict.results
+        ])
+        st.caption(", ".join(
+            f"{stats['cache']} copy of {stats['entries']} rows, {stats['loads']} loads" for stats in dimensions.cache_stats()
+        ))
+
+    if not verdict.valid:
+        reason = next(result.message for result in verdict.results if result.status == validation.FAILED)
+        event_log.record_rejected(customer_id, request_type, "form", reason)
         return False
 
     st.success("Request is valid and can be processed.")
-    return True
+    pending = request_writer.submit(
+        customer_id, supplier_id, request_date, request_type, validation.rule_value(verdict, "quality_officer"),
+    )
+    # the form does not wait for the next background flush, its request is written with the ones buffered so far
+    request_writer.flush()
+    recorded = pending is not None and pending.wait(request_writer.WAIT_SECONDS)
+    if not recorded:
+        st.error(pending.reason if pending is not None and pending.reason else request_writer.UNRECORDED_REASON)
+    # the request page answers once its events are written
+    event_log.flush()
+    return recorded
 
 
-def supplier_validate_request(supplier, request_date):
-    # check supplier is not blacklisted
-    if not utils.is_supplier_blacklisted(qdb.duckdb_conn, supplier, request_date):
-        st.error("Supplier is blacklisted and cannot process requests.")
-        return False
-    else: 
-        if not utils.is_supplier_available(qdb.duckdb_conn, supplier):
-            st.error("Supplier is not available to process requests.")
-            return False
-        else:
-            return True if  utils.write_request_to_db(qdb.duckdb_conn,customer_id, supplier, request_date, request_type) else False
- 
-
 ## Body of the Streamlit app
 st.title("Request Validator and Overview")
 
 st.header("New Request")
 
-sup_df = utils.get_suppliers_name_and_location(qdb.duckdb_conn)
+# customers and suppliers come from the in-memory copies, reloaded only when their tables change
+with qdb.connections.reader() as conn:
+    customer_ids = [customer.customer_id for customer in dimensions.customers.rows(conn)]
+    suppliers = dimensions.suppliers.rows(conn)
+
+# the first available site with a given name is the one the form selects
+supplier_ids = {}
+for supplier_row in suppliers:
+    if supplier_row.supplier_site_availability:
+        supplier_ids.setdefault(supplier_row.supplier_site_name, supplier_row.supplier_site_id)
 
 # Check if suppliers are available
-if sup_df.empty:
+if not supplier_ids:
     st.error("No suppliers available. Please contact administrator.")
     st.stop()
 
 with st.form("request_form"):
-    customer_id = st.selectbox("Customer ID", [1001, 1002, 1003, 1004, 1005, 1006, 1007, 1008, 1009, 1010], index=None, placeholder="Select a customer ID")
-    supplier = st.selectbox("Supplier", sup_df['supplier_site_name'], index=None, placeholder="Select a supplier")
+    customer_id = st.selectbox("Customer ID", customer_ids, index=None, placeholder="Select a customer ID")
+    supplier = st.selectbox("Supplier", list(supplier_ids), index=None, placeholder="Select a supplier")
     request_date = st.date_input("Request Date")
     request_type = st.selectbox("Request Type", ["GMP", "GVP", "GCP"], index=None, placeholder="Select a request type")
     submit_button = st.form_submit_button("Evaluate Request", help="Click to evaluate the request based on customer and supplier validations.")
 
 if submit_button:
     st.write("Processing request...")
-    with st.spinner("Validating...", show_time=True):
-        time.sleep(2)
-
-    if customer_validate_request(customer_id, supplier, request_date, request_type):
-        st.write("Validating Supplier.")
-        with st.spinner("Validating...", show_time=True):
-            time.sleep(2)
-
-        # Get supplier ID safely
-        supplier_match = sup_df[sup_df['supplier_site_name'] == supplier]
-        if supplier_match.empty:
-            st.error("Supplier not found.")
-        else:
-            supplier_id = supplier_match['supplier_site_id'].values[0]
-            if supplier_validate_request(supplier_id, request_date):
-                st.success("Request has been successfully validated and recorded.")
-            else:
-                st.error("Supplier validation failed.")
-    else:
-        st.error("Customer validation failed.")
+    if validate_request(customer_id, supplier_ids.get(supplier), request_date, request_type):
+        st.success("Request has been successfully validated and recorded.")
 
 st.divider()
 
 st.header("Bulk request load")
 uploaded_file = st.file_uploader("Upload CSV file with requests", type=["csv"], help="Upload a CSV file containing multiple requests for bulk processing.")
-if uploaded_file is not None:
-    st.write("Processing bulk requests...")
-    bulk_df = pd.read_csv(uploaded_file)
-    successful_count = 0
-    failed_count = 0
-    for row in bulk_df.itertuples():
-        customer_id = row.customer_id
-        supplier_id = row.requested_supplier_site_id
-        request_date = row.request_date
-        request_type = row.requested_standard
-
-        # Get supplier name from ID
-        supplier_match = sup_df[sup_df['supplier_site_id'] == supplier_id]
-        if supplier_match.empty:
-            st.error(f"Supplier is not AVAILABLE for bulk request with ID: {supplier_id}")
-            failed_count += 1
-            continue
-        
-        supplier_name = supplier_match['supplier_site_name'].values[0]
-
-        if not customer_validate_request(customer_id, supplier_name, request_date, request_type):
-            st.error(f"Bulk request validation failed for Customer ID: {customer_id}, Supplier: {supplier_name}, Date: {request_date}, Type: {request_type}")
-            failed_count += 1
-            continue
-
-        if not supplier_validate_request(supplier_id, request_date):
-            st.error(f"Supplier validation failed for bulk request: Supplier ID: {supplier_id}, Date: {request_date}")
-            failed_count += 1
-            continue
-        
-        successful_count += 1
-    
-    st.write(f"Bulk request processing completed. Successful: {successful_count}, Failed: {failed_count}")
-
-    
+# the uploader keeps its file across reruns, each upload starts a single job
+if uploaded_file is not None and st.session_state.get("bulk_upload_id") != uploaded_file.file_id:
+    st.session_state["bulk_upload_id"] = uploaded_file.file_id
+    if bulk_jobs.create_job(qdb.connections, uploaded_file.name, uploaded_file) is None:
+        st.error("Bulk request file could not be processed. Please check the file columns.")
+
+# jobs left unfinished by a restart carry on from their last loaded chunk
+bulk_jobs.resume_jobs(qdb.connections)
+
+
+def prepare_report(job_id, rejected_rows):
+    """Build the rejection report of a job, kept until the job rejects more rows."""
+    sink = io.BytesIO()
+    with qdb.connections.reader() as conn:
+        bulk_jobs.export_rejections(conn, job_id, sink)
+    st.session_state[f"bulk_report_{job_id}"] = (rejected_rows, sink.getvalue())
+
+
+def bulk_job_panel():
+    with qdb.connections.reader() as conn:
+        jobs = bulk_jobs.get_recent_jobs(conn)
+    if not jobs:
+        st.caption("No bulk uploads yet.")
+
+    for job in jobs:
+        progress = job.processed_rows / job.total_rows if job.total_rows else 1.0
+        st.progress(
+            min(progress, 1.0),
+            text=f"{job.file_name} ({job.status}): {job.processed_rows} of {job.total_rows} rows, "
+                 f"{job.accepted_rows} accepted, {job.rejected_rows} rejected",
+        )
+        job_cols = st.columns(2)
+        if job.rejected_rows:
+            # the download button needs the file when it is drawn, so the report is only built when asked for
+            report = st.session_state.get(f"bulk_report_{job.job_id}")
+            if report is not None and report[0] == job.rejected_rows:
+                job_cols[0].download_button(
+                    "Download rejection report", report[1], file_name=f"rejected_{job.file_name}", mime="text/csv",
+                    on_click="ignore", key=f"bulk_report_download_{job.job_id}",
+                )
+            else:
+                job_cols[0].button(
+                    "Prepare rejection report", key=f"bulk_report_prepare_{job.job_id}",
+                    on_click=prepare_report, args=(job.job_id, job.rejected_rows),
+                )
+        if job.status == bulk_jobs.FAILED:
+            st.error(f"Bulk upload stopped: {job.error}")
+            job_cols[1].button(
+                "Resume", key=f"bulk_resume_{job.job_id}", on_click=bulk_jobs.start_job, args=(qdb.connections, job.job_id),
+            )
+
+    # stop polling once every job is finished
+    if st.session_state.get("bulk_polling") and not any(job.status in bulk_jobs.ACTIVE_STATES for job in jobs):
+        st.session_state["bulk_polling"] = False
+        st.rerun()
+
+
+with qdb.connections.reader() as conn:
+    active_jobs = any(job.status in bulk_jobs.ACTIVE_STATES for job in bulk_jobs.get_recent_jobs(conn))
+st.session_state["bulk_polling"] = active_jobs
+# the panel reruns on its own every second while a job is loading
+st.fragment(bulk_job_panel, run_every=1 if active_jobs else None)()
 
 
 st.divider()
 
+# the browser is a fragment, paging through requests only reruns this part of the page
+@st.fragment
+def request_browser():
+    filter_cols = st.columns(3)
+    browse_customer = filter_cols[0].number_input("Customer ID", min_value=0, value=None, step=1, key="browse_customer")
+    browse_standard = filter_cols[1].selectbox("Request Type", list(ledger.REQUIRED_CREDITS), index=None, key="browse_standard")
+    browse_supplier = filter_cols[2].number_input("Supplier site ID", min_value=0, value=None, step=1, key="browse_supplier")
+    filter_cols = st.columns(3)
+    browse_from = filter_cols[0].date_input("From", value=None, key="browse_from")
+    browse_to = filter_cols[1].date_input("To", value=None, key="browse_to")
+    browse_state = filter_cols[2].selectbox("Credit state", browser.CREDIT_STATES, index=None, key="browse_state")
+    sort_cols = st.columns(2)
+    sort = sort_cols[0].selectbox("Sort by", list(browser.SORT_KEYS), key="browse_sort")
+    descending = sort_cols[1].toggle("Descending", key="browse_descending")
+
+    filters = browser.RequestFilter(browse_customer, browse_standard, browse_supplier, browse_from, browse_to, browse_state)
+
+    # cursors[n] is where page n starts, any change of filters or sorting goes back to the first page
+    if st.session_state.get("browse_query") != (filters, sort, descending):
+        st.session_state["browse_query"] = (filters, sort, descending)
+        st.session_state["browse_cursors"] = [None]
+    cursors = st.session_state["browse_cursors"]
+
+    with qdb.connections.reader() as conn:
+        total = browser.count_requests(conn, filters)
+        page, next_cursor = browser.fetch_page(conn, filters, sort, descending, cursors[-1])
+
+    st.write(f"Page {len(cursors)} of {max(1, -(-total // browser.PAGE_SIZE))}, {total} matching requests")
+    st.dataframe(page)
+
+    nav_cols = st.columns(2)
+    nav_cols[0].button("Previous page", disabled=len(cursors) == 1, on_click=cursors.pop)
+    nav_cols[1].button("Next page", disabled=next_cursor is None, on_click=cursors.append, args=(next_cursor,))
+
+    def drop_export():
+        export = st.session_state.pop("browse_export", None)
+        if export is not None and export[-1] is not None:
+            browser.remove_export(export[-1])
+
+    def prepare_export(file_format):
+        # the export is written to a file, the session only keeps its path until it is downloaded
+        drop_export()
+        path = browser.new_export_path(file_format)
+        with qdb.connections.reader() as conn:
+            rows = browser.export_requests(conn, filters, path, file_format, sort, descending)
+        if rows < 0 or os.path.getsize(path) > browser.EXPORT_MAX_BYTES:
+            browser.remove_export(path)
+            path = None
+        st.session_state["browse_export"] = (filters, sort, descending, file_format, rows, path)
+
+    export_cols = st.columns(2)
+    export_cols[0].button("Prepare CSV export", on_click=prepare_export, args=("csv",))
+    export_cols[1].button("Prepare Parquet export", on_click=prepare_export, args=("parquet",))
+    # an export is offered for the filters and sorting it was built with only
+    export = st.session_state.get("browse_export")
+    if export is not None and export[:3] != (filters, sort, descending):
+        drop_export()
+    elif export is not None:
+        file_format, rows, path = export[3:]
+        if rows < 0:
+            st.error("Requests could not be exported.")
+        elif path is None:
+            st.warning(f"The export of {rows} requests is larger than {browser.EXPORT_MAX_BYTES // (1024 * 1024)} MB, narrow the filters.")
+        else:
+            with open(path, "rb") as export_file:
+                st.download_button(
+                    f"Download {file_format.upper()} ({rows} requests)", export_file, file_name=f"requests.{file_format}",
+                    mime="text/csv" if file_format == "csv" else "application/octet-stream", on_click=drop_export,
+                )
+
+
 with st.expander("View All Requests"):
-    st.dataframe(utils.get_all_requests(qdb.duckdb_conn))
\ No newline at end of file
+    request_browser()
\ No newline at end of file
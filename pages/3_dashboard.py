@@ -1,9 +1,8 @@
 import streamlit as st
 import tools.utils as utils
 import tools.qdb as qdb
-from prophet import Prophet
-import pandas as pd
-import matplotlib.pyplot as plt
+import tools.instrumentation as instrumentation
+import tools.event_log as event_log
 
 st.header("Dashboard Metrics")
 st.markdown('''
@@ -15,22 +14,28 @@ st.markdown('''
             ''')
 
 
-
-l_90d_req = utils.get_90d_requests(qdb.duckdb_conn)
-
-if not l_90d_req.empty:
-    st.subheader("Last 90 days Funnel from a total of " + str(len(l_90d_req)) + " requests")
-    # from the l_90d_req get the open, validated and finished requests
-    value_counts = l_90d_req['credit_state'].value_counts().to_dict() if 'credit_state' in l_90d_req.columns else {}
-    array_of_states = [
-        len(l_90d_req),
-        value_counts.get('reserved', 0),
-        value_counts.get('consumed', 0)
-    ]
-    fig1, ax1 = plt.subplots()
-    ax1.pie(array_of_states, labels=['Open','Reserved', 'Consumed'], autopct='%1.1f%%', startangle=90, radius=2)
-    ax1.axis('equal')  # Equal aspect ratio ensures that pie is drawn as a circle.
-    st.pyplot(fig1, width=500)
+# read every metric with one pooled cursor, then render
+with instrumentation.timed("dashboard_queries"), qdb.connections.reader() as conn:
+    funnel = utils.get_90d_funnel(conn)
+    total_requests = utils.get_total_requests(conn)
+    total_customers = utils.get_total_customers(conn)
+    avg_resolution = utils.avg_timeof_resolution(conn)
+    credits_by_customer = utils.get_credits_by_customer(conn)
+    audit_type_by_date = utils.get_audit_type_by_date(conn)
+    audit_by_country = utils.get_audit_by_country(conn)
+
+if funnel.get(event_log.SUBMITTED):
+    st.subheader("Last 90 days Funnel from a total of " + str(funnel[event_log.SUBMITTED]) + " requests")
+    # every stage counted from the state transitions in the event log
+    with instrumentation.timed("dashboard_funnel_chart"):
+        st.bar_chart(
+            {
+                "stage": [f"{position} {stage.capitalize()}" for position, stage in enumerate(event_log.FUNNEL, 1)],
+                "requests": [funnel.get(stage, 0) for stage in event_log.FUNNEL],
+            },
+            x="stage", y="requests", horizontal=True, sort=False,
+        )
+    st.caption(f"{funnel.get(event_log.REJECTED, 0)} requests rejected, {funnel.get(event_log.RELEASED, 0)} released their credits.")
 else:
     st.info("No requests found in the last 90 days.")
 
@@ -40,22 +45,21 @@ st.divider()
 st.subheader("Requests & Customer")
 left, right = st.columns(2)
 with left:
-    st.metric(label="Total Requests", value=utils.get_total_requests(qdb.duckdb_conn), border=True)
+    st.metric(label="Total Requests", value=total_requests, border=True)
 with right:
-    st.metric(label="Total Customers", value=utils.get_total_customers(qdb.duckdb_conn), border=True)
+    st.metric(label="Total Customers", value=total_customers, border=True)
 
 st.subheader("Resolution & Consumption")
 left2, right2 = st.columns(2)
 with left2:
-    st.metric(label="Avg time of resolution (in days)", value=utils.avg_timeof_resolution(qdb.duckdb_conn), border=True)
+    st.metric(label="Avg time of resolution (in days)", value=avg_resolution, border=True)
 with right2:
-    st.metric(label="Avg Credits by Customer", value=utils.get_credits_by_customer(qdb.duckdb_conn), border=True)
+    st.metric(label="Avg Credits by Customer", value=credits_by_customer, border=True)
 
 st.divider()
 
 st.subheader("Requests by Type and Date")
-audit_type_by_date = utils.get_audit_type_by_date(qdb.duckdb_conn)
-if not audit_type_by_date.empty:
+if audit_type_by_date.num_rows:
     st.scatter_chart(audit_type_by_date, x="request_date", y="total_requests", color="requested_standard")
 else:
     st.info("No data available for requests by type and date.")
@@ -63,8 +67,7 @@ else:
 st.divider()
 
 st.subheader("Requests by Country")
-audit_by_country = utils.get_audit_by_country(qdb.duckdb_conn)
-if not audit_by_country.empty:
+if audit_by_country.num_rows:
     st.bar_chart(audit_by_country, x="country", y="total_requests", sort="total_requests", horizontal=True)
 else:
     st.info("No data available for requests by country.")
@@ -75,42 +78,82 @@ st.divider()
 
 
 st.subheader("Trend in next 30 days and weekly behavior")
-audits_by_day = utils.get_audits_by_date(qdb.duckdb_conn)
-
-if not audits_by_day.empty and len(audits_by_day) > 2:
-    try:
-        # Validate and clean data
-        audits_by_day = audits_by_day.dropna()
-        audits_by_day = audits_by_day[audits_by_day['y'] > 0]  # Remove zero or negative values
-        
-        if len(audits_by_day) < 3:
-            st.info("Not enough valid data points to generate forecast. Need at least 3 data points.")
-        else:
-            # Train Prophet with suppressed warnings
-            import warnings
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                m = Prophet(yearly_seasonality=False, daily_seasonality=False, interval_width=0.95)
-                m.fit(audits_by_day)
-
-                # Make future dataframe and forecast
-                future = m.make_future_dataframe(periods=30, freq='d')
-                forecast = m.predict(future)
-                
-            st.write(m.plot_components(forecast))
-            # there can't be negative requests
-            forecast.loc[forecast['yhat'] < 0, 'yhat'] = 0
-            forecast.loc[forecast['yhat_lower'] < 0, 'yhat_lower'] = 0
-            # show only the forcasted values from now on
-            forecast = forecast[forecast['ds'] >= audits_by_day['ds'].max()]
+# pandas and the forecast engine load after the tiles above are on screen, Prophet only when asked for
+import pandas as pd
+import tools.dimensions as dimensions
+import tools.forecast_engine as forecast_engine
+
+# every series of the selected family is fitted at once, updated with the days added since the last view
+families = {family.label: family.name for family in forecast_engine.FAMILIES.values()}
+left3, right3 = st.columns(2)
+with left3:
+    selected_family = families[st.selectbox("Series", list(families), index=0)]
+with instrumentation.timed("dashboard_forecast_engine"), qdb.connections.reader() as conn:
+    forecasts = forecast_engine.get_forecasts(conn, selected_family)
+    # the busiest series first, a selector of every supplier site would not be usable
+    busiest = forecast_engine.top_series(forecasts, count=200)
+    names = {}
+    if selected_family == "site":
+        for key, _ in busiest:
+            supplier = dimensions.suppliers.get(conn, key)
+            names[key] = supplier.supplier_site_name if supplier else str(key)
+
+with right3:
+    selected_series = st.selectbox(
+        forecast_engine.FAMILIES[selected_family].label, [key for key, _ in busiest], index=0,
+        format_func=lambda key: names.get(key, str(key)),
+    )
+use_prophet = st.toggle("High accuracy (Prophet)", help="Fits Prophet on the selected series only, it takes a few seconds.")
+
+try:
+    if use_prophet:
+        import tools.forecast as forecast
+
+        with qdb.connections.reader() as conn:
+            history = forecast_engine.series_history(conn, selected_family, selected_series)
+        with st.spinner("Fitting forecast...", show_time=True), instrumentation.timed("dashboard_forecast_wait"):
+            fitted = forecast.get_forecast(f"{selected_family}:{selected_series}", history, wait=True)
+    else:
+        fitted = forecast_engine.series_forecast(forecasts, selected_series)
+
+    if fitted is None:
+        st.info("Not enough valid data points to generate forecast. Need at least 3 data points.")
+    elif use_prophet:
+        with instrumentation.timed("dashboard_forecast_chart"):
+            st.write(fitted.model.plot_components(fitted.forecast))
+        # there can't be negative requests
+        future = fitted.forecast.copy()
+        future.loc[future['yhat'] < 0, 'yhat'] = 0
+        future.loc[future['yhat_lower'] < 0, 'yhat_lower'] = 0
+        # show only the forcasted values from now on
+        future = future[future['ds'] >= fitted.last_day]
+
+        st.subheader("Forecast for next month")
+        st.area_chart(pd.DataFrame({
+                "forecast": future.set_index("ds")["yhat"],
+                "lowest": future.set_index("ds")["yhat_lower"],
+                "highest": future.set_index("ds")["yhat_upper"]
+            }))
+    else:
+        with instrumentation.timed("dashboard_forecast_chart"):
+            st.metric(label="Trend (requests per day, week over week)", value=f"{fitted.trend * 7:+.2f}", border=True)
+            st.bar_chart(pd.DataFrame({
+                "weekday": ["1 Mon", "2 Tue", "3 Wed", "4 Thu", "5 Fri", "6 Sat", "7 Sun"],
+                "requests vs an average day": fitted.weekly,
+            }), x="weekday", y="requests vs an average day")
 
             st.subheader("Forecast for next month")
             st.area_chart(pd.DataFrame({
-                    "forecast": forecast.set_index("ds")["yhat"],
-                    "lowest": forecast.set_index("ds")["yhat_lower"],
-                    "highest": forecast.set_index("ds")["yhat_upper"]
-                }))
-    except Exception as e:
-        st.error(f"Error generating forecast: {e}")
-else:
-    st.info("Not enough data to generate forecast. Need at least 3 data points.")
+                "forecast": fitted.yhat,
+                "lowest": fitted.yhat_lower,
+                "highest": fitted.yhat_upper,
+            }, index=pd.to_datetime(fitted.days)))
+except Exception as e:
+    st.error(f"Error generating forecast: {e}")
+
+if busiest and selected_family != "total":
+    st.subheader(f"Expected requests in the next {forecast_engine.FORECAST_DAYS} days")
+    st.dataframe(pd.DataFrame({
+        forecast_engine.FAMILIES[selected_family].label: [names.get(key, str(key)) for key, _ in busiest[:20]],
+        "requests": [round(total, 1) for _, total in busiest[:20]],
+    }), hide_index=True)
@@ -0,0 +1,80 @@
+import datetime
+
+import streamlit as st
+import tools.dimensions as dimensions
+import tools.event_log as event_log
+import tools.instrumentation as instrumentation
+import tools.partitions as partitions
+import tools.qdb as qdb
+import tools.request_writer as request_writer
+
+# hidden page, reached at /performance: query timings, timed sections and slow query plans of this process
+
+st.header("Performance")
+st.markdown('''
+            Timings of the database queries and of the slow sections of the app since the last reset.
+            Queries are grouped by the function that ran them, with their literals replaced by `?`.
+            ''')
+
+left, middle, right = st.columns(3)
+with left:
+    threshold_ms = st.number_input(
+        "Slow query threshold (ms)", min_value=1, value=int(instrumentation.slow_query_seconds * 1000), step=50
+    )
+    instrumentation.slow_query_seconds = threshold_ms / 1000
+with middle:
+    instrumentation.explain_slow_queries = st.toggle(
+        "Capture EXPLAIN ANALYZE of slow queries", value=instrumentation.explain_slow_queries,
+        help="Slow read-only queries are run a second time to capture their plan.",
+    )
+with right:
+    if st.button("Reset metrics"):
+        instrumentation.reset()
+    st.download_button(
+        "Download Prometheus metrics", instrumentation.prometheus_text(), file_name="qdb_metrics.prom", mime="text/plain"
+    )
+
+st.subheader("Sections")
+sections = instrumentation.section_stats()
+if sections:
+    st.dataframe(sections, hide_index=True)
+else:
+    st.info("No section was timed yet, open the dashboard first.")
+
+st.subheader("Queries")
+queries = instrumentation.query_stats()
+if queries:
+    st.dataframe(queries, hide_index=True, column_config={"query": st.column_config.TextColumn(width="large")})
+else:
+    st.info("No query was run yet.")
+
+st.subheader("Slow queries")
+slow = instrumentation.slow_queries()
+if not slow:
+    st.info(f"No query took more than {threshold_ms} ms.")
+for query in slow:
+    at = datetime.datetime.fromtimestamp(query.at).strftime("%H:%M:%S")
+    with st.expander(f"{at} · {query.caller} · {1000 * query.seconds:.0f} ms"):
+        st.code(query.query, language="sql")
+        if query.rows is not None:
+            st.caption(f"{query.rows} rows")
+        if query.plan:
+            st.code(query.plan, language=None)
+
+st.subheader("Dimension caches")
+st.dataframe(dimensions.cache_stats(), hide_index=True)
+st.subheader("Event log")
+st.caption("Request events waiting in the buffer, and the events and batches this process wrote since it started.")
+st.dataframe([event_log.stats()], hide_index=True)
+st.subheader("Request writer")
+st.caption("Requests waiting in the buffer, the requests stored, turned down or failed in the batches this process wrote, and the FACT_REQUESTS refreshes after them.")
+st.dataframe([request_writer.stats()], hide_index=True)
+
+st.subheader("Partitions")
+st.caption(
+    "Months of fact_request with the row groups they are stored in, archived months are read from Parquet. "
+    "Months spread over more row groups than their rows need are compacted with `python -m tools.facts --compact`."
+)
+with qdb.connections.reader() as conn:
+    fact_partitions = partitions.partition_stats(conn, "fact_request")
+st.dataframe([partition._asdict() for partition in fact_partitions], hide_index=True)
@@ -0,0 +1,130 @@
+'''
+archivecheck.py
+This file is the regression check of the fact archive.
+It generates a synthetic dataset with tools.synthetic in a scratch directory, sets the database up and
+moves the fact months to Parquet and back while refreshing the fact in between: every month is
+archived, a request is backdated into an archived month, its month is archived again and every month
+is restored. After each step the fact rows, their distinct requests and the requests counted by
+kpi_daily must match what the step added, so no refresh loads an archived request a second time.
+
+Usage:
+    python -m tools.archivecheck
+    python -m tools.archivecheck --requests 200000
+'''
+import argparse
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+
+import tools.connections as connections
+import tools.facts as facts
+import tools.ledger as ledger
+import tools.partitions as partitions
+import tools.qdb as qdb
+import tools.request_writer as request_writer
+import tools.synthetic as synthetic
+
+# a month after every synthetic request, so archiving before it moves them all
+ARCHIVE_ALL = "9999-12"
+
+
+def fact_totals(duckdb_conn):
+    """Get the fact rows, archived months included, their distinct requests and the requests counted by kpi_daily."""
+    return duckdb_conn.execute("""
+        SELECT
+            (SELECT count(*) FROM fact_request_all),
+            (SELECT count(DISTINCT id_request) FROM fact_request_all),
+            (SELECT COALESCE(sum(total_requests), 0) FROM kpi_daily)
+    """).fetchone()
+
+
+def _backdated_request(duckdb_conn, request_date):
+    """Build a request the writer accepts on request_date, from the customer with the most credits and a supplier never blacklisted."""
+    customer_id = duckdb_conn.execute("SELECT customer_id FROM credit_balances ORDER BY available DESC LIMIT 1").fetchone()[0]
+    supplier_site_id = duckdb_conn.execute("""
+        SELECT supplier_site_id FROM suppliers
+        WHERE supplier_site_availability
+        AND supplier_site_id NOT IN (SELECT supplier_site_id FROM blacklist_intervals)
+        ORDER BY supplier_site_id
+        LIMIT 1
+    """).fetchone()[0]
+    standard = min(ledger.REQUIRED_CREDITS, key=ledger.REQUIRED_CREDITS.get)
+    return (customer_id, supplier_site_id, request_date, standard, None)
+
+
+def check_archive(duckdb_conn):
+    """Archive, backdate, restore and refresh the fact. Returns the list of steps whose totals do not match."""
+    problems = []
+    expected = fact_totals(duckdb_conn)
+
+    def step(name, added=0):
+        nonlocal expected
+        if facts.refresh_fact_requests(duckdb_conn) < 0:
+            problems.append(f"{name}: refresh failed")
+        expected = tuple(total + added for total in expected)
+        totals = fact_totals(duckdb_conn)
+        print(f"{name}: {totals[0]} rows, {totals[1]} requests, {totals[2]} in kpi_daily")
+        if totals != expected:
+            problems.append(f"{name}: expected {expected}, got {totals}")
+
+    if facts.archive_fact_requests(duckdb_conn, ARCHIVE_ALL) < 0:
+        problems.append("archive failed")
+    step("archive every month")
+
+    month = partitions.archived_months(duckdb_conn, "fact_request")[0]
+    request_date = datetime.date.fromisoformat(f"{month}-01")
+    outcomes = request_writer.write_requests(duckdb_conn, [_backdated_request(duckdb_conn, request_date)], refresh_facts=False)
+    if not outcomes or outcomes[0][0] is None:
+        problems.append(f"backdated request turned down: {outcomes[0][1] if outcomes else 'write failed'}")
+        return problems
+    step(f"backdate a request to {request_date}", added=1)
+
+    next_month = (request_date + datetime.timedelta(days=32)).strftime("%Y-%m")
+    if facts.archive_fact_requests(duckdb_conn, next_month) < 0:
+        problems.append("second archive failed")
+    step(f"archive {month} again")
+
+    if facts.restore_fact_requests(duckdb_conn, partitions.archived_months(duckdb_conn, "fact_request")) < 0:
+        problems.append("restore failed")
+    step("restore every month")
+    return problems
+
+
+def run(requests, seed=0, workdir=None):
+    """Generate a dataset in workdir, the current directory, set the database up and check the archive. Returns the list of problems."""
+    synthetic.generate(workdir, requests, seed=seed)
+    manager = connections.ConnectionManager(connections.DEFAULT_DATABASE, pool_size=1, setup=qdb.setup_database)
+    try:
+        with manager.writer() as conn:
+            return check_archive(conn)
+    finally:
+        manager.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check that archiving and restoring fact months keeps every request once.")
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="Directory for the generated data and database, a temporary one by default.")
+    args = parser.parse_args(argv)
+
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="qualifyze-archive-")
+    os.makedirs(workdir, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        problems = run(args.requests, args.seed, workdir)
+    finally:
+        os.chdir(cwd)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    for problem in problems:
+        print(problem)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,257 @@
+'''
+benchmark.py
+This file benchmarks the request and validation paths on a synthetic dataset.
+It generates the CSV exports with tools.synthetic in a scratch directory, then times the database
+setup, every dashboard KPI, scans of FACT_REQUESTS, the supplier site forecasts, single validations,
+single and buffered writes and bulk validation throughput. The results are written as JSON; given a
+baseline from an earlier run, the benchmark fails when a metric got worse by more than the tolerance.
+
+Usage:
+    python -m tools.benchmark --requests 100000 --output benchmark.json
+    python -m tools.benchmark --requests 100000 --baseline benchmark.json --tolerance 0.25
+'''
+import argparse
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import duckdb
+import pandas as pd
+
+import tools.bulk as bulk
+import tools.bulk_jobs as bulk_jobs
+import tools.connections as connections
+import tools.dimensions as dimensions
+import tools.event_log as event_log
+import tools.facts as facts
+import tools.forecast_engine as forecast_engine
+import tools.qdb as qdb
+import tools.request_writer as request_writer
+import tools.synthetic as synthetic
+import tools.utils as utils
+import tools.validation as validation
+
+LOWER, HIGHER = "lower", "higher"
+
+# utils functions behind the dashboard tiles and charts
+KPI_FUNCTIONS = [
+    "get_total_requests",
+    "get_total_customers",
+    "avg_timeof_resolution",
+    "get_credits_by_customer",
+    "get_audit_type_by_date",
+    "get_audit_by_country",
+    "get_audits_by_date",
+    "get_90d_funnel",
+    "get_valid_requests",
+    "get_finished_requests",
+]
+
+FACT_SCANS = {
+    "fact_scan_count": "SELECT count(*) FROM FACT_REQUESTS",
+    "fact_scan_group": """
+        SELECT supplier_site_country, credit_state, count(*), avg(consumed_date - reserved_date)
+        FROM FACT_REQUESTS GROUP BY ALL
+    """,
+    # the dashboard window, reads only the row groups of the last months
+    "fact_scan_90d": """
+        SELECT credit_state, count(*) FROM FACT_REQUESTS
+        WHERE request_date >= current_date - interval '90' day GROUP BY ALL
+    """,
+}
+
+
+def _best_of(repeat, function):
+    """Run function repeat times. Returns the fastest run in seconds."""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _sample_requests(conn, count, seed):
+    """Pick request-like rows (customer, site, date, standard) from the generated data."""
+    rows = conn.execute(f"""
+        SELECT customer_id, requested_supplier_site_id, request_date, requested_standard
+        FROM requests WHERE requested_standard IS NOT NULL
+        USING SAMPLE reservoir({int(count)} ROWS) REPEATABLE ({int(seed)})
+    """).fetchall()
+    random.Random(seed).shuffle(rows)
+    return rows
+
+
+def run(requests, skew=1.0, seed=0, repeat=3, validations=200, bulk_rows=10000, workdir=None):
+    """Generate a dataset in workdir, the current directory, and run every benchmark on it. Returns the results dict."""
+    metrics = {}
+
+    def record(name, value, unit="s", better=LOWER):
+        metrics[name] = {"value": value, "unit": unit, "better": better}
+        print(f"{name}: {value:.6g} {unit}")
+
+    started = time.perf_counter()
+    counts = synthetic.generate(workdir, requests, skew=skew, seed=seed)
+    record("generate", time.perf_counter() - started)
+
+    manager = connections.ConnectionManager(connections.DEFAULT_DATABASE, pool_size=4, setup=qdb.setup_database)
+    started = time.perf_counter()
+    manager.open()
+    record("setup_database", time.perf_counter() - started)
+    # writes and bulk loads record their events as in the app, submitted requests are written in batches
+    event_log.start(manager)
+    request_writer.start(manager)
+
+    with manager.reader() as conn:
+        for name in KPI_FUNCTIONS:
+            function = getattr(utils, name)
+            record(f"kpi_{name}", _best_of(repeat, lambda: function(conn)))
+        for name, query in FACT_SCANS.items():
+            record(name, _best_of(repeat, lambda: conn.execute(query).fetchall()))
+        # every supplier site forecast at once, from the whole history and then from the last days only
+        forecast_engine.reset()
+        record("forecast_sites_load", _best_of(1, lambda: forecast_engine.get_forecasts(conn, "site")))
+        record("forecast_sites_update", _best_of(repeat, lambda: forecast_engine.get_forecasts(conn, "site", max_age=0)))
+        sample = _sample_requests(conn, max(validations, bulk_rows), seed)
+
+    with manager.writer() as conn:
+        record("fact_rebuild", _best_of(1, lambda: facts.rebuild_fact_requests(conn)))
+
+    # validations of distinct requests, starting from an empty dimension cache
+    dimensions.suppliers.clear()
+    latencies = []
+    for row in sample[:validations]:
+        started = time.perf_counter()
+        validation.validate(manager, validation.ValidationRequest(*row))
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+    record("validation_p50", statistics.median(latencies))
+    record("validation_p95", latencies[int(0.95 * (len(latencies) - 1))])
+
+    today = datetime.date.today()
+    writes = sample[: max(1, validations // 10)]
+    with manager.writer() as conn:
+        started = time.perf_counter()
+        for customer_id, site_id, _, standard in writes:
+            utils.write_request_to_db(conn, customer_id, site_id, today, standard)
+        record("write_request", (time.perf_counter() - started) / len(writes))
+
+    # the same kind of requests submitted from many sessions at once, written in batches by the request writer
+    started = time.perf_counter()
+    submitted = [
+        request_writer.submit(customer_id, site_id, today, standard, source="benchmark")
+        for customer_id, site_id, _, standard in sample[:bulk_rows]
+    ]
+    for pending in submitted:
+        pending.wait()
+    record("write_request_buffered_throughput", len(submitted) / (time.perf_counter() - started), "rows/s", HIGHER)
+
+    upload = pd.DataFrame(sample[:bulk_rows], columns=bulk.BULK_COLUMNS)
+    with manager.writer() as conn:
+        elapsed = _best_of(repeat, lambda: bulk.validate_bulk_requests(conn, upload))
+        record("bulk_validate_throughput", len(upload) / elapsed, "rows/s", HIGHER)
+        started = time.perf_counter()
+        bulk.load_bulk_requests(conn, upload)
+        record("bulk_load_throughput", len(upload) / (time.perf_counter() - started), "rows/s", HIGHER)
+
+    # the same rows uploaded as a file and loaded by a background job
+    started = time.perf_counter()
+    job_id = bulk_jobs.create_job(manager, "benchmark.csv", io.BytesIO(upload.to_csv(index=False).encode()))
+    while bulk_jobs.is_running(job_id):
+        time.sleep(0.01)
+    record("bulk_job_throughput", len(upload) / (time.perf_counter() - started), "rows/s", HIGHER)
+
+    # events recorded in a burst, then written as one batch of the log
+    event_log.flush()
+    started = time.perf_counter()
+    for customer_id, _, _, standard in sample[:bulk_rows]:
+        event_log.record(event_log.SUBMITTED, None, customer_id, standard, "benchmark")
+    record("event_record", (time.perf_counter() - started) / len(sample[:bulk_rows]))
+    started = time.perf_counter()
+    event_log.flush()
+    record("event_log_flush", time.perf_counter() - started)
+
+    manager.close()
+    return {
+        "meta": {
+            "requests": requests,
+            "skew": skew,
+            "seed": seed,
+            "rows": counts,
+            "python": platform.python_version(),
+            "duckdb": duckdb.__version__,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        },
+        "metrics": metrics,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Compare results with a baseline run. Returns the list of regressions."""
+    if results["meta"]["requests"] != baseline["meta"]["requests"]:
+        print(f"Warning: baseline was run with {baseline['meta']['requests']} requests")
+    regressions = []
+    for name, metric in results["metrics"].items():
+        base = baseline["metrics"].get(name)
+        if base is None or not base["value"]:
+            continue
+        ratio = metric["value"] / base["value"]
+        worse = ratio > 1 + tolerance if metric["better"] == LOWER else ratio < 1 / (1 + tolerance)
+        if worse:
+            regressions.append(f"{name}: {metric['value']:.6g} {metric['unit']} vs baseline {base['value']:.6g} {base['unit']}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark setup, KPIs, validation and bulk loads on synthetic data.")
+    parser.add_argument("--requests", type=int, default=100000)
+    parser.add_argument("--skew", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per timing, the fastest one is kept.")
+    parser.add_argument("--validations", type=int, default=200, help="Single validations to time.")
+    parser.add_argument("--bulk-rows", type=int, default=10000, help="Rows of the bulk upload to time.")
+    parser.add_argument("--workdir", help="Directory for the generated data and database, a temporary one by default.")
+    parser.add_argument("--output", default="benchmark.json", help="Where to write the results.")
+    parser.add_argument("--baseline", help="Results of an earlier run to compare with.")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown against the baseline, 0.25 = 25%%.")
+    args = parser.parse_args(argv)
+
+    output = os.path.abspath(args.output)
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="qualifyze-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        results = run(args.requests, args.skew, args.seed, args.repeat, args.validations, args.bulk_rows, workdir)
+    finally:
+        os.chdir(cwd)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2, default=str)
+    print(f"Results written to {output}")
+
+    if baseline_path:
+        with open(baseline_path) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,174 @@
+'''
+blacklist.py
+This file keeps the supplier blacklist as merged, non-overlapping intervals per supplier site.
+The intervals are stored in the blacklist_intervals table for range joins in SQL, and loaded
+into an in-memory index that answers "was site X blacklisted on date D" with a binary search.
+Every rebuild of the intervals is logged in dimension_changes as the "blacklist" dimension, and the
+index is reloaded like the dimension copies when a newer change is logged, by this process or another.
+'''
+import bisect
+import datetime
+
+import tools.dimensions as dimensions
+import tools.facts as facts
+
+# Upper bound used for open ended blacklist windows (blacklist_until is NULL)
+OPEN_END = datetime.date.max
+
+
+def _as_date(value):
+    """Convert a date, datetime, pandas Timestamp or ISO string to a date."""
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    return datetime.date.fromisoformat(str(value)[:10])
+
+
+class BlacklistIndex:
+    """Merged blacklist intervals per supplier site, sorted by start date."""
+
+    def __init__(self, rows):
+        self._starts = {}
+        self._ends = {}
+        for supplier_site_id, since, until in sorted(rows, key=lambda row: (row[0], row[1])):
+            self._starts.setdefault(int(supplier_site_id), []).append(since)
+            self._ends.setdefault(int(supplier_site_id), []).append(until or OPEN_END)
+
+    def __len__(self):
+        return sum(len(starts) for starts in self._starts.values())
+
+    def is_blacklisted(self, supplier_site_id, request_date):
+        """Check if the site was blacklisted on the given date."""
+        starts = self._starts.get(int(supplier_site_id))
+        if not starts:
+            return False
+        request_date = _as_date(request_date)
+        position = bisect.bisect_right(starts, request_date) - 1
+        return position >= 0 and request_date <= self._ends[int(supplier_site_id)][position]
+
+    def are_blacklisted(self, pairs):
+        """Check a batch of (supplier_site_id, request_date) pairs. Returns a list of booleans."""
+        return [self.is_blacklisted(supplier_site_id, request_date) for supplier_site_id, request_date in pairs]
+
+
+class BlacklistCache(dimensions.DimensionCache):
+    """BlacklistIndex of blacklist_intervals, reloaded when the change log of the blacklist moves on."""
+
+    def __init__(self):
+        super().__init__("blacklist", """
+            SELECT supplier_site_id, blacklist_since, blacklist_until FROM blacklist_intervals
+        """, None)
+
+    def _load(self, duckdb_conn, change_id):
+        self.loads += 1
+        return change_id, BlacklistIndex(duckdb_conn.execute(self.query).fetchall())
+
+    def index(self, duckdb_conn):
+        """Get the index, reloading it first if the blacklist changed."""
+        self.hits += 1
+        return self._current(duckdb_conn)[1]
+
+    def stats(self):
+        """Get the size and reload count of the index."""
+        data = self._data
+        return {
+            "cache": self.name,
+            "entries": len(data[1]) if data else 0,
+            "hits": self.hits,
+            "loads": self.loads,
+            "change_id": data[0] if data else None,
+        }
+
+
+index_cache = dimensions.register(BlacklistCache())
+
+
+def rebuild_blacklist_intervals(duckdb_conn):
+    """Merge overlapping and adjacent blacklist windows into the blacklist_intervals table. Returns True on success, False on failure."""
+    try:
+        duckdb_conn.execute("""
+            CREATE OR REPLACE TABLE blacklist_intervals AS
+            WITH windows AS (
+                SELECT
+                    supplier_site_id,
+                    blacklist_since,
+                    COALESCE(blacklist_until, DATE '9999-12-31') AS blacklist_until
+                FROM blacklist
+                WHERE supplier_site_id IS NOT NULL
+                AND blacklist_since IS NOT NULL
+                AND (blacklist_until IS NULL OR blacklist_until >= blacklist_since)
+            ),
+
+            -- Latest end seen before each window, a window starts a new island when it begins after it
+            ordered AS (
+                SELECT
+                    *,
+                    max(blacklist_until) OVER (
+                        PARTITION BY supplier_site_id
+                        ORDER BY blacklist_since, blacklist_until
+                        ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+                    ) AS previous_until
+                FROM windows
+            ),
+            islands AS (
+                SELECT
+                    *,
+                    sum(CASE WHEN previous_until IS NULL OR blacklist_since > previous_until + 1 THEN 1 ELSE 0 END) OVER (
+                        PARTITION BY supplier_site_id
+                        ORDER BY blacklist_since, blacklist_until
+                        ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+                    ) AS island
+                FROM ordered
+            )
+            SELECT
+                supplier_site_id,
+                min(blacklist_since) AS blacklist_since,
+                NULLIF(max(blacklist_until), DATE '9999-12-31') AS blacklist_until
+            FROM islands
+            GROUP BY supplier_site_id, island
+            ORDER BY supplier_site_id, blacklist_since
+        """)
+        dimensions.log_change(duckdb_conn, "blacklist")
+        return True
+    except Exception as e:
+        print(f"Error rebuilding blacklist intervals: {e}")
+        return False
+
+
+def get_blacklist_index(duckdb_conn):
+    """Get the in-memory blacklist index, reloaded from blacklist_intervals when a newer blacklist change is logged."""
+    return index_cache.index(duckdb_conn)
+
+
+def add_blacklist_entry(duckdb_conn, supplier_site_id, blacklist_since, blacklist_until=None):
+    """Blacklist a supplier site from a date, open ended when blacklist_until is None. Returns True on success, False on failure."""
+    try:
+        duckdb_conn.execute(
+            "INSERT INTO blacklist (supplier_site_id, blacklist_since, blacklist_until) VALUES (?, ?, ?)",
+            [int(supplier_site_id), _as_date(blacklist_since), _as_date(blacklist_until) if blacklist_until else None],
+        )
+    except Exception as e:
+        print(f"Error adding blacklist entry: {e}")
+        return False
+    return _blacklist_changed(duckdb_conn, supplier_site_id)
+
+
+def remove_blacklist_entry(duckdb_conn, supplier_site_id, blacklist_since):
+    """Remove the blacklist window of a supplier site starting on a date. Returns True on success, False on failure."""
+    try:
+        duckdb_conn.execute(
+            "DELETE FROM blacklist WHERE supplier_site_id = ? AND blacklist_since = ?",
+            [int(supplier_site_id), _as_date(blacklist_since)],
+        )
+    except Exception as e:
+        print(f"Error removing blacklist entry: {e}")
+        return False
+    return _blacklist_changed(duckdb_conn, supplier_site_id)
+
+
+def _blacklist_changed(duckdb_conn, supplier_site_id):
+    """Bring the intervals, the index and the fact table in line after a blacklist write."""
+    if not rebuild_blacklist_intervals(duckdb_conn):
+        return False
+    return facts.refresh_fact_blacklist(duckdb_conn, supplier_site_id)
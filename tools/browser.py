@@ -0,0 +1,162 @@
+'''
+browser.py
+This file runs the queries behind the request browser. Filtering, sorting and paging happen in DuckDB
+over FACT_REQUESTS, so only one page of rows ever leaves the database.
+Pages use keyset pagination: the next page starts after the (sort key, id_request) of the last row
+shown, which costs the same on the first page and on the thousandth. Exports stream the matching
+rows in Arrow batches to a CSV or Parquet file under data/exports, which the page offers for download
+and removes once downloaded.
+'''
+import collections
+import os
+import time
+import uuid
+
+import tools.results as results
+
+PAGE_SIZE = 50
+
+BROWSER_COLUMNS = [
+    "id_request",
+    "request_date",
+    "customer_id",
+    "requested_standard",
+    "requested_supplier_site_id",
+    "supplier_site_name",
+    "credit_state",
+]
+
+# sort keys never NULL, so the keyset comparison keeps every row
+SORT_KEYS = {
+    "id_request": "id_request",
+    "request_date": "COALESCE(request_date, DATE '0001-01-01')",
+    "customer_id": "COALESCE(customer_id, -1)",
+}
+
+# credit_state filter value for requests without a credit
+NO_CREDIT = "none"
+CREDIT_STATES = ["reserved", "consumed", NO_CREDIT]
+
+EXPORT_FORMATS = ["csv", "parquet"]
+EXPORT_DIR = "data/exports"
+# the download button reads the file into the server memory while it is shown
+EXPORT_MAX_BYTES = 200 * 1024 * 1024
+# exports of sessions closed before downloading them
+EXPORT_MAX_AGE_SECONDS = 3600
+
+RequestFilter = collections.namedtuple(
+    "RequestFilter",
+    ["customer_id", "requested_standard", "supplier_site_id", "date_from", "date_to", "credit_state"],
+    defaults=(None,) * 6,
+)
+
+
+def _where(filters):
+    """Build the WHERE predicate and its parameters for a RequestFilter."""
+    clauses, params = [], []
+    if filters.customer_id is not None:
+        clauses.append("customer_id = ?")
+        params.append(int(filters.customer_id))
+    if filters.requested_standard:
+        clauses.append("requested_standard = ?")
+        params.append(filters.requested_standard)
+    if filters.supplier_site_id is not None:
+        clauses.append("requested_supplier_site_id = ?")
+        params.append(int(filters.supplier_site_id))
+    if filters.date_from is not None:
+        clauses.append("request_date >= ?")
+        params.append(filters.date_from)
+    if filters.date_to is not None:
+        clauses.append("request_date <= ?")
+        params.append(filters.date_to)
+    if filters.credit_state == NO_CREDIT:
+        clauses.append("credit_state IS NULL")
+    elif filters.credit_state:
+        clauses.append("credit_state = ?")
+        params.append(filters.credit_state)
+    return " AND ".join(clauses) or "true", params
+
+
+def _ordered_query(filters, sort, descending, after=None):
+    key = SORT_KEYS[sort]
+    direction, op = ("DESC", "<") if descending else ("ASC", ">")
+    where, params = _where(filters)
+    if after is not None:
+        where += f" AND ({key} {op} ? OR ({key} = ? AND id_request {op} ?))"
+        params += [after[0], after[0], after[1]]
+    query = f"""
+        SELECT {key} AS sort_key, {", ".join(BROWSER_COLUMNS)}
+        FROM FACT_REQUESTS
+        WHERE {where}
+        ORDER BY sort_key {direction}, id_request {direction}
+    """
+    return query, params
+
+
+def count_requests(duckdb_conn, filters):
+    """Count the requests matching the filters. Returns 0 on error."""
+    try:
+        where, params = _where(filters)
+        return int(results.fetch_scalar(duckdb_conn, f"SELECT count(*) FROM FACT_REQUESTS WHERE {where}", params, default=0))
+    except Exception as e:
+        print(f"Error counting requests: {e}")
+        return 0
+
+
+def fetch_page(duckdb_conn, filters, sort="id_request", descending=False, after=None, page_size=PAGE_SIZE):
+    """Get one page of requests starting after the cursor of the previous page (None for the first page).
+    Returns the page as an Arrow table and the cursor of the next page, None on the last page. Returns an empty table on error."""
+    try:
+        query, params = _ordered_query(filters, sort, descending, after)
+        page = results.fetch_table(duckdb_conn, f"{query} LIMIT {int(page_size) + 1}", params)
+        next_cursor = None
+        if page.num_rows > page_size:
+            page = page.slice(0, page_size)
+            last = page_size - 1
+            next_cursor = (page["sort_key"][last].as_py(), page["id_request"][last].as_py())
+        return page.drop_columns(["sort_key"]), next_cursor
+    except Exception as e:
+        print(f"Error fetching requests page: {e}")
+        return results.empty_table(), None
+
+
+def new_export_path(file_format):
+    """Get the path of a new export file, removing the exports older than EXPORT_MAX_AGE_SECONDS."""
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    expired = time.time() - EXPORT_MAX_AGE_SECONDS
+    for entry in os.scandir(EXPORT_DIR):
+        try:
+            if entry.stat().st_mtime < expired:
+                os.remove(entry.path)
+        except OSError:
+            pass
+    return os.path.join(EXPORT_DIR, f"{uuid.uuid4().hex}.{file_format}")
+
+
+def remove_export(path):
+    """Delete an export file, if it is still there."""
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def export_requests(duckdb_conn, filters, sink, file_format="csv", sort="id_request", descending=False):
+    """Stream the requests matching the filters into sink, a path or a binary file, as CSV or Parquet. Returns the number of rows written, -1 on error."""
+    try:
+        # the writers are only needed for exports, not to browse
+        import pyarrow.csv as pa_csv
+        import pyarrow.parquet as pq
+
+        query, params = _ordered_query(filters, sort, descending)
+        batches = results.stream_batches(duckdb_conn, f"SELECT * EXCLUDE (sort_key) FROM ({query})", params)
+        writer_class = pa_csv.CSVWriter if file_format == "csv" else pq.ParquetWriter
+        rows = 0
+        with writer_class(sink, batches.schema) as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+                rows += batch.num_rows
+        return rows
+    except Exception as e:
+        print(f"Error exporting requests: {e}")
+        return -1
@@ -0,0 +1,224 @@
+'''
+bulk.py
+This file validates uploaded request files as a whole, using set-based queries instead of a row by row loop.
+'''
+import uuid
+
+import pandas as pd
+import tools.event_log as event_log
+import tools.facts as facts
+import tools.ingest as ingest
+import tools.ledger as ledger
+
+BULK_COLUMNS = ["customer_id", "requested_supplier_site_id", "request_date", "requested_standard"]
+
+MISSING_FIELDS_REASON = "Missing required fields: Customer ID, Supplier, and Request Date."
+INVALID_DATE_REASON = "Invalid request date, expected YYYY-MM-DD."
+INVALID_STANDARD_REASON = f"Invalid request type. Please choose from: {', '.join(ledger.REQUIRED_CREDITS)}."
+
+
+def _verdict_query(upload_name):
+    """Build the query that returns one verdict per uploaded row."""
+    required_values = ", ".join(f"('{standard}', {credits})" for standard, credits in ledger.REQUIRED_CREDITS.items())
+    return f"""
+        WITH upload AS (
+            SELECT
+                row_id,
+                try_cast(customer_id AS BIGINT) AS customer_id,
+                try_cast(requested_supplier_site_id AS BIGINT) AS requested_supplier_site_id,
+                try_cast(request_date AS DATE) AS request_date,
+                NULLIF(trim(CAST(request_date AS VARCHAR)), '') IS NOT NULL AS has_date,
+                CAST(requested_standard AS VARCHAR) AS requested_standard
+            FROM {upload_name}
+        ),
+        required AS (
+            SELECT * FROM (VALUES {required_values}) AS t(requested_standard, required_credits)
+        ),
+
+        -- One balance lookup for every customer in the upload
+        balances AS (
+            SELECT customer_id, available AS available_credits
+            FROM credit_balances
+            WHERE customer_id IN (SELECT customer_id FROM upload)
+        ),
+
+        -- Rows whose request date falls inside a merged blacklist interval (open ended ones included)
+        blacklisted AS (
+            SELECT u.row_id
+            FROM upload u
+            JOIN blacklist_intervals bi
+                ON bi.supplier_site_id = u.requested_supplier_site_id
+                AND u.request_date >= bi.blacklist_since
+                AND u.request_date <= COALESCE(bi.blacklist_until, DATE '9999-12-31')
+        ),
+
+        checked AS (
+            SELECT
+                u.*,
+                r.required_credits,
+                COALESCE(bal.available_credits, 0) AS available_credits,
+                CASE
+                    WHEN u.customer_id IS NULL OR u.requested_supplier_site_id IS NULL OR NOT u.has_date
+                        THEN '{MISSING_FIELDS_REASON}'
+                    WHEN u.request_date IS NULL
+                        THEN '{INVALID_DATE_REASON}'
+                    WHEN r.required_credits IS NULL
+                        THEN '{INVALID_STANDARD_REASON}'
+                    WHEN s.supplier_site_id IS NULL
+                        THEN 'Supplier not found.'
+                    WHEN bl.row_id IS NOT NULL
+                        THEN 'Supplier is blacklisted and cannot process requests.'
+                    WHEN NOT COALESCE(s.supplier_site_availability, false)
+                        THEN 'Supplier is not available to process requests.'
+                END AS rejection_reason
+            FROM upload u
+            LEFT JOIN required r ON r.requested_standard = u.requested_standard
+            LEFT JOIN balances bal ON bal.customer_id = u.customer_id
+            LEFT JOIN suppliers s ON s.supplier_site_id = u.requested_supplier_site_id
+            LEFT JOIN blacklisted bl ON bl.row_id = u.row_id
+        ),
+
+        -- Credits are spent in upload order, so one file cannot overspend a customer balance
+        spent AS (
+            SELECT
+                *,
+                SUM(required_credits) FILTER (WHERE rejection_reason IS NULL) OVER (
+                    PARTITION BY customer_id
+                    ORDER BY row_id
+                    ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+                ) AS credits_spent
+            FROM checked
+        )
+        SELECT
+            row_id,
+            customer_id,
+            requested_supplier_site_id,
+            request_date,
+            requested_standard,
+            required_credits,
+            available_credits,
+            COALESCE(
+                rejection_reason,
+                CASE WHEN credits_spent > available_credits
+                    THEN 'Customer does not have enough credits for ' || requested_standard || '.'
+                END
+            ) AS rejection_reason,
+            rejection_reason IS NULL AND credits_spent <= available_credits AS accepted
+        FROM spent
+        ORDER BY row_id
+    """
+
+
+def check_chunk(chunk):
+    """Check the rules that need no database on a chunk of uploaded rows read as strings, with their row_id.
+    Returns the stripped rows with a rejection_reason column, None for the rows still to validate against the database.
+    It runs on the job thread of the bulk jobs."""
+    checked = chunk[["row_id"]].copy()
+    for column in BULK_COLUMNS:
+        checked[column] = chunk[column].astype("string").str.strip().replace("", pd.NA)
+    ids = checked[["customer_id", "requested_supplier_site_id"]].apply(pd.to_numeric, errors="coerce")
+    complete = ids.notna().all(axis=1) & checked["request_date"].notna()
+    dates = pd.to_datetime(checked["request_date"], format="%Y-%m-%d", errors="coerce")
+    known_standard = checked["requested_standard"].isin(list(ledger.REQUIRED_CREDITS))
+    checked["rejection_reason"] = None
+    checked.loc[complete & ~known_standard, "rejection_reason"] = INVALID_STANDARD_REASON
+    checked.loc[complete & dates.isna(), "rejection_reason"] = INVALID_DATE_REASON
+    checked.loc[~complete, "rejection_reason"] = MISSING_FIELDS_REASON
+    return checked
+
+
+def _register_upload(duckdb_conn, bulk_df):
+    """Register the uploaded frame with a row id, kept from a row_id column if it has one, and return its view name.
+    Returns None if columns are missing."""
+    missing = [column for column in BULK_COLUMNS if column not in bulk_df.columns]
+    if missing:
+        print(f"Error: Bulk upload is missing columns: {', '.join(missing)}")
+        return None
+
+    upload = bulk_df[BULK_COLUMNS].reset_index(drop=True)
+    row_ids = bulk_df["row_id"].to_numpy() if "row_id" in bulk_df.columns else range(len(upload))
+    upload.insert(0, "row_id", row_ids)
+
+    upload_name = f"bulk_upload_{uuid.uuid4().hex}"
+    duckdb_conn.register(upload_name, upload)
+    return upload_name
+
+
+def validate_bulk_requests(duckdb_conn, bulk_df):
+    """Validate every uploaded row without writing. Returns a verdict DataFrame, empty on error."""
+    upload_name = None
+    try:
+        upload_name = _register_upload(duckdb_conn, bulk_df)
+        if upload_name is None:
+            return pd.DataFrame()
+        return duckdb_conn.execute(_verdict_query(upload_name)).df()
+    except Exception as e:
+        print(f"Error validating bulk requests: {e}")
+        return pd.DataFrame()
+    finally:
+        if upload_name is not None:
+            duckdb_conn.unregister(upload_name)
+
+
+def load_bulk_requests(duckdb_conn, bulk_df, before_commit=None, refresh_facts=True, source="bulk"):
+    """Validate every uploaded row, insert the accepted ones and reserve their credits in one transaction. Returns a verdict DataFrame, empty on error.
+    before_commit is called with the connection and the verdicts inside the transaction, refresh_facts=False leaves FACT_REQUESTS to the caller.
+    The events of every row are recorded as coming from source."""
+    upload_name = None
+    in_transaction = False
+    verdict_name = f"bulk_verdicts_{uuid.uuid4().hex}"
+    accepted_name = f"bulk_accepted_{uuid.uuid4().hex}"
+    try:
+        upload_name = _register_upload(duckdb_conn, bulk_df)
+        if upload_name is None:
+            return pd.DataFrame()
+
+        duckdb_conn.begin()
+        in_transaction = True
+        duckdb_conn.execute(f"CREATE TEMP TABLE {verdict_name} AS {_verdict_query(upload_name)}")
+        duckdb_conn.execute(f"""
+            CREATE TEMP TABLE {accepted_name} AS
+            SELECT row_id, {ingest.REQUEST_ID_SQL} AS id_request, customer_id, requested_supplier_site_id,
+                request_date, requested_standard, required_credits
+            FROM {verdict_name}
+            WHERE accepted
+            ORDER BY row_id
+        """)
+        duckdb_conn.execute(f"""
+            INSERT INTO requests (id_request, customer_id, requested_supplier_site_id, request_date, requested_standard)
+            SELECT id_request, customer_id, requested_supplier_site_id, request_date, requested_standard
+            FROM {accepted_name}
+            ORDER BY row_id
+        """)
+        if not ledger.reserve_for_requests(duckdb_conn, accepted_name):
+            raise RuntimeError("credit balances changed during the upload")
+
+        verdicts = duckdb_conn.execute(f"""
+            SELECT v.*, a.id_request
+            FROM {verdict_name} v
+            LEFT JOIN {accepted_name} a USING (row_id)
+            ORDER BY row_id
+        """).df()
+        duckdb_conn.execute(f"DROP TABLE {verdict_name}")
+        duckdb_conn.execute(f"DROP TABLE {accepted_name}")
+        if before_commit is not None:
+            before_commit(duckdb_conn, verdicts)
+        duckdb_conn.commit()
+        in_transaction = False
+    except Exception as e:
+        print(f"Error loading bulk requests: {e}")
+        if in_transaction:
+            duckdb_conn.rollback()
+        return pd.DataFrame()
+    finally:
+        if upload_name is not None:
+            duckdb_conn.unregister(upload_name)
+
+    # the rows are stored, a failure from here on is reported without turning them into an error
+    try:
+        event_log.record_verdicts(verdicts, source)
+    except Exception as e:
+        print(f"Error recording bulk request events: {e}")
+    if refresh_facts:
+        facts.refresh_fact_requests(duckdb_conn)
+    return verdicts
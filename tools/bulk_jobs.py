@@ -0,0 +1,283 @@
+'''
+bulk_jobs.py
+This file runs bulk uploads as background jobs, so a large file neither blocks the page nor floods it
+with one error per rejected row.
+The upload is saved under data/bulk_uploads and read back in chunks of CHUNK_ROWS rows. The job thread
+checks the rules that need no database (required fields, date format, request type) on a chunk, then
+validates the rest against the database, inserts its accepted rows and reserves their credits. The
+rejected rows and the job progress are written in the same transaction as the chunk, so a job stopped
+by a restart resumes after its last committed chunk and never loads a row twice. Jobs and their
+progress are kept in bulk_jobs, their rejected rows in bulk_job_rejections.
+pandas is only loaded when a job runs.
+'''
+import collections
+import csv
+import os
+import shutil
+import threading
+import uuid
+
+import tools.event_log as event_log
+import tools.facts as facts
+import tools.results as results
+
+UPLOAD_DIR = "data/bulk_uploads"
+CHUNK_ROWS = 20000
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+ACTIVE_STATES = (QUEUED, RUNNING)
+
+REQUIRED_COLUMNS = ["customer_id", "requested_supplier_site_id", "request_date", "requested_standard"]
+
+Job = collections.namedtuple("Job", [
+    "job_id", "file_name", "status", "total_rows", "processed_rows", "accepted_rows", "rejected_rows",
+    "created_at", "updated_at", "error",
+])
+
+_JOB_COLUMNS = ", ".join(Job._fields)
+
+_runners = {}
+_runners_lock = threading.Lock()
+
+
+def setup_jobs(duckdb_conn):
+    """Create the tables of the bulk jobs and their rejected rows."""
+    duckdb_conn.execute("""
+        CREATE TABLE IF NOT EXISTS bulk_jobs (
+            job_id VARCHAR PRIMARY KEY,
+            file_name VARCHAR,
+            source_path VARCHAR,
+            status VARCHAR,
+            total_rows BIGINT,
+            processed_rows BIGINT DEFAULT 0,
+            accepted_rows BIGINT DEFAULT 0,
+            rejected_rows BIGINT DEFAULT 0,
+            created_at TIMESTAMP DEFAULT current_timestamp,
+            updated_at TIMESTAMP DEFAULT current_timestamp,
+            error VARCHAR
+        )
+    """)
+    duckdb_conn.execute("""
+        CREATE TABLE IF NOT EXISTS bulk_job_rejections (
+            job_id VARCHAR,
+            row_id BIGINT,
+            customer_id VARCHAR,
+            requested_supplier_site_id VARCHAR,
+            request_date VARCHAR,
+            requested_standard VARCHAR,
+            rejection_reason VARCHAR
+        )
+    """)
+
+
+def _count_rows(path):
+    """Count the records of a CSV file, a quoted field may span several lines. Blank lines are not records."""
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        return max(0, sum(1 for row in csv.reader(f) if row) - 1)
+
+
+def create_job(manager, file_name, upload):
+    """Save an uploaded CSV file (a binary file object) and start a job loading it. Returns the job id, None if the file lacks columns or on error."""
+    job_id = uuid.uuid4().hex
+    path = os.path.join(UPLOAD_DIR, f"{job_id}.csv")
+    try:
+        header = next(csv.reader([upload.readline().decode("utf-8-sig")]), [])
+        missing = [column for column in REQUIRED_COLUMNS if column not in [name.strip() for name in header]]
+        if missing:
+            print(f"Error: Bulk upload is missing columns: {', '.join(missing)}")
+            return None
+
+        os.makedirs(UPLOAD_DIR, exist_ok=True)
+        upload.seek(0)
+        with open(path, "wb") as f:
+            shutil.copyfileobj(upload, f)
+        with manager.writer() as conn:
+            conn.execute("""
+                INSERT INTO bulk_jobs (job_id, file_name, source_path, status, total_rows)
+                VALUES (?, ?, ?, ?, ?)
+            """, [job_id, file_name, path, QUEUED, _count_rows(path)])
+    except Exception as e:
+        print(f"Error creating bulk job: {e}")
+        return None
+
+    start_job(manager, job_id)
+    return job_id
+
+
+def get_job(duckdb_conn, job_id):
+    """Get a job. Returns None if it does not exist or on error."""
+    try:
+        row = duckdb_conn.execute(f"SELECT {_JOB_COLUMNS} FROM bulk_jobs WHERE job_id = ?", [job_id]).fetchone()
+        return Job(*row) if row else None
+    except Exception as e:
+        print(f"Error getting bulk job: {e}")
+        return None
+
+
+def get_recent_jobs(duckdb_conn, limit=5):
+    """Get the last jobs created, the newest first. Returns an empty list on error."""
+    try:
+        rows = duckdb_conn.execute(
+            f"SELECT {_JOB_COLUMNS} FROM bulk_jobs ORDER BY created_at DESC LIMIT ?", [int(limit)]
+        ).fetchall()
+        return [Job(*row) for row in rows]
+    except Exception as e:
+        print(f"Error getting bulk jobs: {e}")
+        return []
+
+
+def is_running(job_id):
+    """Check if a thread of this process is working on the job."""
+    with _runners_lock:
+        runner = _runners.get(job_id)
+        return runner is not None and runner.is_alive()
+
+
+def start_job(manager, job_id):
+    """Run or resume a job on a background thread. Returns False if it is already running."""
+    with _runners_lock:
+        runner = _runners.get(job_id)
+        if runner is not None and runner.is_alive():
+            return False
+        runner = threading.Thread(target=_run_in_background, args=(manager, job_id), name=f"bulk-{job_id[:8]}", daemon=True)
+        _runners[job_id] = runner
+        runner.start()
+    return True
+
+
+def resume_jobs(manager):
+    """Resume the jobs left queued or running by a process that stopped. Returns the number of resumed jobs."""
+    try:
+        with manager.reader() as conn:
+            job_ids = [row[0] for row in conn.execute(
+                "SELECT job_id FROM bulk_jobs WHERE status IN (?, ?) ORDER BY created_at", list(ACTIVE_STATES)
+            ).fetchall()]
+    except Exception as e:
+        print(f"Error resuming bulk jobs: {e}")
+        return 0
+    return sum(start_job(manager, job_id) for job_id in job_ids)
+
+
+def _set_status(manager, job_id, status, error=None):
+    with manager.writer() as conn:
+        conn.execute("""
+            UPDATE bulk_jobs SET status = ?, error = ?, updated_at = current_timestamp WHERE job_id = ?
+        """, [status, error, job_id])
+
+
+def _run_in_background(manager, job_id):
+    try:
+        run_job(manager, job_id)
+    except Exception as e:
+        print(f"Error running bulk job {job_id}: {e}")
+        _set_status(manager, job_id, FAILED, str(e))
+
+
+def _read_chunks(path, start_row, chunk_rows):
+    """Yield the rows of the file from start_row on, as string frames of at most chunk_rows rows with a row_id column."""
+    import pandas as pd
+
+    first_row = 0
+    with pd.read_csv(path, dtype=str, chunksize=chunk_rows, skipinitialspace=True) as reader:
+        for chunk in reader:
+            chunk.columns = [column.strip() for column in chunk.columns]
+            chunk.insert(0, "row_id", range(first_row, first_row + len(chunk)))
+            first_row += len(chunk)
+            if first_row > start_row:
+                yield chunk[chunk["row_id"] >= start_row]
+
+
+def _write_chunk(manager, job_id, checked):
+    """Load the rows of a checked chunk that passed bulk.check_chunk on the job thread, then record its rejected rows and the job progress in the same transaction."""
+    import pandas as pd
+    import tools.bulk as bulk
+
+    counts = {}
+
+    def record(conn, verdicts=None):
+        rejected = checked[checked["rejection_reason"].notna()]
+        if verdicts is not None and not verdicts.empty:
+            refused = verdicts.loc[~verdicts["accepted"].astype(bool), ["row_id", "rejection_reason"]]
+            raw = checked.drop(columns="rejection_reason")
+            rejected = pd.concat([rejected, raw.merge(refused, on="row_id")], ignore_index=True)
+        rejected = rejected[["row_id", *bulk.BULK_COLUMNS, "rejection_reason"]].astype({"row_id": "int64"})
+        conn.register("bulk_job_rejected", rejected)
+        try:
+            conn.execute("""
+                INSERT INTO bulk_job_rejections
+                SELECT ?, row_id, customer_id, requested_supplier_site_id, request_date, requested_standard, rejection_reason
+                FROM bulk_job_rejected
+            """, [job_id])
+        finally:
+            conn.unregister("bulk_job_rejected")
+        counts["rejected"] = len(rejected)
+        counts["accepted"] = len(checked) - len(rejected)
+        conn.execute("""
+            UPDATE bulk_jobs
+            SET processed_rows = processed_rows + ?, accepted_rows = accepted_rows + ?,
+                rejected_rows = rejected_rows + ?, updated_at = current_timestamp
+            WHERE job_id = ?
+        """, [len(checked), counts["accepted"], counts["rejected"], job_id])
+
+    candidates = checked[checked["rejection_reason"].isna()]
+    with manager.writer() as conn:
+        if candidates.empty:
+            conn.begin()
+            try:
+                record(conn)
+            except Exception:
+                conn.rollback()
+                raise
+            conn.commit()
+        elif bulk.load_bulk_requests(conn, candidates, before_commit=record, refresh_facts=False).empty:
+            raise RuntimeError(f"rows {int(checked['row_id'].min())} to {int(checked['row_id'].max())} could not be stored")
+    # the rows of the candidates were recorded by the load, the ones bulk.check_chunk turned down are recorded here
+    event_log.record_verdicts(checked[checked["rejection_reason"].notna()], "bulk")
+    return counts
+
+
+def run_job(manager, job_id, chunk_rows=CHUNK_ROWS):
+    """Load the chunks of a job not committed yet, then refresh FACT_REQUESTS. Returns the finished Job."""
+    import tools.bulk as bulk
+
+    with manager.reader() as conn:
+        job = get_job(conn, job_id)
+        source_path = results.fetch_scalar(conn, "SELECT source_path FROM bulk_jobs WHERE job_id = ?", [job_id])
+    if job is None:
+        raise ValueError(f"unknown bulk job {job_id}")
+    _set_status(manager, job_id, RUNNING)
+
+    for chunk in _read_chunks(source_path, job.processed_rows, chunk_rows):
+        _write_chunk(manager, job_id, bulk.check_chunk(chunk))
+
+    with manager.writer() as conn:
+        facts.refresh_fact_requests(conn)
+        conn.execute("""
+            UPDATE bulk_jobs
+            SET status = ?, total_rows = processed_rows, error = NULL, updated_at = current_timestamp
+            WHERE job_id = ?
+        """, [DONE, job_id])
+    with manager.reader() as conn:
+        return get_job(conn, job_id)
+
+
+def export_rejections(duckdb_conn, job_id, sink):
+    """Stream the rejected rows of a job into sink as CSV, in upload order. Returns the number of rows written, -1 on error."""
+    try:
+        import pyarrow.csv as pa_csv
+
+        batches = results.stream_batches(duckdb_conn, """
+            SELECT row_id + 1 AS row_number, customer_id, requested_supplier_site_id, request_date, requested_standard, rejection_reason
+            FROM bulk_job_rejections
+            WHERE job_id = ?
+            ORDER BY row_id
+        """, [job_id])
+        rows = 0
+        with pa_csv.CSVWriter(sink, batches.schema) as writer:
+            for batch in batches:
+                writer.write_batch(batch)
+                rows += batch.num_rows
+        return rows
+    except Exception as e:
+        print(f"Error exporting bulk job rejections: {e}")
+        return -1
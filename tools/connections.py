@@ -0,0 +1,108 @@
+'''
+connections.py
+This file manages the DuckDB connections shared by all Streamlit sessions.
+There is a single writer connection guarded by a lock, and a bounded pool of reader cursors
+created from it. Each cursor has its own transaction context, so reads from different sessions
+run in parallel and see committed data while writes stay serialized on the writer.
+The database is opened on the first reader or writer request, not when the manager is created,
+so importing the app does not touch the database file.
+The writer and the reader cursors are wrapped by tools.instrumentation, so every query is measured.
+'''
+import contextlib
+import os
+import queue
+import threading
+
+import duckdb
+
+import tools.instrumentation as instrumentation
+
+DEFAULT_DATABASE = "data/qdb.duckdb"
+DEFAULT_POOL_SIZE = 8
+
+
+class ConnectionManager:
+    """One writer connection and a pool of reader cursors over the same database.
+    setup, if given, is called with the writer connection once, right after the database is opened."""
+
+    def __init__(self, database=DEFAULT_DATABASE, pool_size=DEFAULT_POOL_SIZE, setup=None):
+        self.database = database
+        self.pool_size = pool_size
+        self.setup = setup
+        self._writer = None
+        self._write_lock = threading.RLock()
+        self._readers = queue.Queue(maxsize=pool_size)
+
+    def open(self):
+        """Open the database and fill the reader pool, if not done yet."""
+        if self._writer is not None:
+            return
+        with self._write_lock:
+            if self._writer is not None:
+                return
+            writer = instrumentation.InstrumentedConnection(duckdb.connect(self.database, read_only=False))
+            if self.setup is not None:
+                try:
+                    self.setup(writer)
+                except Exception:
+                    # leave the manager closed so the next request retries the setup
+                    writer.close()
+                    raise
+            for _ in range(self.pool_size):
+                self._readers.put(writer.cursor())
+            self._writer = writer
+
+    @contextlib.contextmanager
+    def reader(self, timeout=None):
+        """Borrow a reader cursor for the current thread, waiting for a free one when the pool is exhausted."""
+        self.open()
+        cursor = self._readers.get(timeout=timeout)
+        try:
+            yield cursor
+        finally:
+            cursor.flush()
+            self._readers.put(cursor)
+
+    @contextlib.contextmanager
+    def writer(self):
+        """Hold the writer connection, for functions that manage their own commits."""
+        self.open()
+        with self._write_lock:
+            try:
+                yield self._writer
+            finally:
+                self._writer.flush()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Run a block in one write transaction, committed on success and rolled back on error."""
+        self.open()
+        with self._write_lock:
+            self._writer.begin()
+            try:
+                yield self._writer
+            except Exception:
+                self._writer.rollback()
+                raise
+            finally:
+                self._writer.flush()
+            self._writer.commit()
+
+    def close(self):
+        """Close every reader cursor and the writer connection."""
+        with self._write_lock:
+            if self._writer is None:
+                return
+            while not self._readers.empty():
+                self._readers.get_nowait().close()
+            self._writer.close()
+            self._writer = None
+
+
+def pool_size_from_env():
+    """Read the reader pool size from QDB_POOL_SIZE. Returns the default if unset or invalid."""
+    try:
+        return max(1, int(os.environ.get("QDB_POOL_SIZE", DEFAULT_POOL_SIZE)))
+    except ValueError:
+        print(f"Error: QDB_POOL_SIZE must be an integer, using {DEFAULT_POOL_SIZE}")
+        return DEFAULT_POOL_SIZE
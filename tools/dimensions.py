@@ -0,0 +1,171 @@
+'''
+dimensions.py
+This file keeps in-memory copies of the small tables the request form and validation read on every
+run: suppliers, customers and quality officers. A copy is a set of column arrays with dictionaries
+from the id and from the name of a row to its position, so a lookup is a dictionary hit.
+Writes to the source tables add a row to dimension_changes with log_change, in the transaction of
+the write. A copy remembers the last change it has seen and is only reloaded when a newer change of
+its dimension is logged. The log is polled at most every POLL_SECONDS, which also picks up changes
+made by other processes or published in a newer snapshot; changes logged by this process are seen
+on the next lookup. Caches of other tables on the same log, such as the blacklist index, are added
+with register.
+'''
+import array
+import collections
+import threading
+import time
+
+POLL_SECONDS = 1.0
+
+Supplier = collections.namedtuple(
+    "Supplier", ["supplier_site_id", "supplier_site_name", "supplier_site_country", "supplier_site_availability"]
+)
+Customer = collections.namedtuple("Customer", ["customer_id"])
+QualityOfficer = collections.namedtuple("QualityOfficer", ["quality_officer_id", "quality_officer_name"])
+
+
+def setup_changes(duckdb_conn):
+    """Create the change log of the dimension tables."""
+    duckdb_conn.execute("CREATE SEQUENCE IF NOT EXISTS dimension_change_seq START 1")
+    duckdb_conn.execute("""
+        CREATE TABLE IF NOT EXISTS dimension_changes (
+            change_id BIGINT DEFAULT nextval('dimension_change_seq'),
+            dimension VARCHAR,
+            key BIGINT,
+            changed_at TIMESTAMP DEFAULT current_timestamp
+        )
+    """)
+
+
+def _compact(values):
+    """Store a column as an array when its values allow it, as a tuple otherwise."""
+    if values and all(type(value) is bool for value in values):
+        return array.array("b", values)
+    if values and all(type(value) is int for value in values):
+        return array.array("q", values)
+    return tuple(values)
+
+
+class DimensionCache:
+    """Column arrays of a dimension table, indexed by id (the first column) and by name, reloaded when the change log moves on."""
+
+    def __init__(self, name, query, row_type, name_field=None):
+        self.name = name
+        self.query = query
+        self.row_type = row_type
+        self.name_field = name_field
+        self.hits = 0
+        self.loads = 0
+        # (change id, columns, position by id, position by name), replaced as a whole on reload
+        self._data = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _last_change(self, duckdb_conn):
+        return duckdb_conn.execute(
+            "SELECT COALESCE(max(change_id), 0) FROM dimension_changes WHERE dimension = ?", [self.name]
+        ).fetchone()[0]
+
+    def _load(self, duckdb_conn, change_id):
+        rows = duckdb_conn.execute(self.query).fetchall()
+        columns = [_compact(list(column)) for column in zip(*rows)] or [() for _ in self.row_type._fields]
+        by_id = {key: position for position, key in enumerate(columns[0])}
+        by_name = {}
+        if self.name_field:
+            # the first row with a name is the one a name lookup returns
+            for position, name in enumerate(columns[self.row_type._fields.index(self.name_field)]):
+                by_name.setdefault(name, position)
+        self.loads += 1
+        return change_id, columns, by_id, by_name
+
+    def _current(self, duckdb_conn):
+        """Get the loaded copy, reloading it first if the change log moved on since the last poll."""
+        data = self._data
+        if data is not None and time.monotonic() - self._checked_at < POLL_SECONDS:
+            return data
+        with self._lock:
+            if self._data is not None and time.monotonic() - self._checked_at < POLL_SECONDS:
+                return self._data
+            change_id = self._last_change(duckdb_conn)
+            if self._data is None or self._data[0] != change_id:
+                self._data = self._load(duckdb_conn, change_id)
+            self._checked_at = time.monotonic()
+            return self._data
+
+    def _row(self, columns, position):
+        return self.row_type(*(
+            bool(column[position]) if isinstance(column, array.array) and column.typecode == "b" else column[position]
+            for column in columns
+        ))
+
+    def get(self, duckdb_conn, key):
+        """Get the row of an id. Returns None if there is none."""
+        _, columns, by_id, _ = self._current(duckdb_conn)
+        position = by_id.get(key)
+        self.hits += 1
+        return None if position is None else self._row(columns, position)
+
+    def find(self, duckdb_conn, name):
+        """Get the first row with a name. Returns None if there is none."""
+        _, columns, _, by_name = self._current(duckdb_conn)
+        position = by_name.get(name)
+        self.hits += 1
+        return None if position is None else self._row(columns, position)
+
+    def rows(self, duckdb_conn):
+        """Get every row, in id order."""
+        _, columns, _, _ = self._current(duckdb_conn)
+        return [self._row(columns, position) for position in range(len(columns[0]))]
+
+    def invalidate(self):
+        """Poll the change log on the next lookup."""
+        self._checked_at = 0.0
+
+    def clear(self):
+        with self._lock:
+            self._data = None
+            self._checked_at = 0.0
+            self.hits = 0
+            self.loads = 0
+
+    def stats(self):
+        """Get the size and reload count of the copy."""
+        data = self._data
+        return {
+            "cache": self.name,
+            "entries": len(data[1][0]) if data else 0,
+            "hits": self.hits,
+            "loads": self.loads,
+            "change_id": data[0] if data else None,
+        }
+
+
+suppliers = DimensionCache("suppliers", """
+    SELECT supplier_site_id, supplier_site_name, supplier_site_country, supplier_site_availability
+    FROM suppliers ORDER BY supplier_site_id
+""", Supplier, "supplier_site_name")
+# the customers holding credits, the ones a request can be made for
+customers = DimensionCache("customers", "SELECT customer_id FROM credit_balances ORDER BY customer_id", Customer)
+quality_officers = DimensionCache("quality_officers", """
+    SELECT quality_officer_id, quality_officer_name FROM quality_officers ORDER BY quality_officer_id
+""", QualityOfficer, "quality_officer_name")
+
+CACHES = {cache.name: cache for cache in [suppliers, customers, quality_officers]}
+
+
+def register(cache):
+    """Add a cache of another module, such as the blacklist index, to the ones log_change and cache_stats reach. Returns the cache."""
+    CACHES[cache.name] = cache
+    return cache
+
+
+def log_change(duckdb_conn, dimension, key=None):
+    """Record a write to the source table of a dimension, key None for a reload of the whole table.
+    Call it in the transaction of the write."""
+    duckdb_conn.execute("INSERT INTO dimension_changes (dimension, key) VALUES (?, ?)", [dimension, key])
+    CACHES[dimension].invalidate()
+
+
+def cache_stats():
+    """Get the stats of every dimension cache."""
+    return [cache.stats() for cache in CACHES.values()]
@@ -0,0 +1,411 @@
+'''
+event_log.py
+This file keeps the append-only log of request state transitions: a request is submitted, then
+validated or rejected with the reason, its credits reserved, and later consumed or released.
+Each event is stored in request_events with its time, the request, customer and standard it is
+about and where it came from (the form, a bulk upload, the API, the ledger or the exports).
+Recording an event only appends it to an in-memory buffer. A background thread writes the buffer
+in one transaction every FLUSH_SECONDS, or as soon as it holds FLUSH_EVENTS events, so a burst of
+events shares one commit. flush() writes it right away, for callers that need the events on disk;
+the events still buffered when the process dies are lost, the state changes they describe are not.
+The log is tamper-evident: every written batch is a link of a hash chain. Each event has the SHA-256
+of its fields, and each batch in request_event_batches the SHA-256 of the previous batch hash and of
+the hashes of its events in order, so changing, removing or reordering an event breaks the hash of
+its batch and the chain after it. verify() recomputes the chain in SQL.
+The requests and credits loaded from the exports get their events once, from their recorded dates.
+
+Usage:
+    python -m tools.event_log --verify
+    python -m tools.event_log --verify --snapshot     # while the app runs
+'''
+import argparse
+import atexit
+import datetime
+import sys
+import threading
+
+import tools.instrumentation as instrumentation
+
+FLUSH_SECONDS = 0.2
+FLUSH_EVENTS = 5000
+# events per batch when logging the exports
+IMPORT_BATCH_EVENTS = 100000
+GENESIS_HASH = "0" * 64
+
+SUBMITTED, VALIDATED, REJECTED = "submitted", "validated", "rejected"
+RESERVED, RELEASED, CONSUMED = "reserved", "released", "consumed"
+# the stages of the funnel, in order
+FUNNEL = [SUBMITTED, VALIDATED, RESERVED, CONSUMED]
+
+EVENT_COLUMNS = ["occurred_at", "event", "id_request", "customer_id", "requested_standard", "source", "reason"]
+
+# hash of an event row, every field in a fixed order with NULLs as empty strings
+EVENT_HASH_SQL = """
+    sha256(concat_ws(chr(31),
+        event_id, epoch_us(occurred_at), event, COALESCE(id_request, ''), COALESCE(customer_id::VARCHAR, ''),
+        COALESCE(requested_standard, ''), COALESCE(source, ''), COALESCE(reason, '')
+    ))
+"""
+
+_log = None
+_log_lock = threading.Lock()
+
+
+def setup_events(duckdb_conn):
+    """Create the event log and its hash chain."""
+    duckdb_conn.execute("""
+        CREATE TABLE IF NOT EXISTS request_events (
+            event_id BIGINT,
+            batch_id BIGINT,
+            occurred_at TIMESTAMP,
+            event VARCHAR,
+            id_request VARCHAR,
+            customer_id BIGINT,
+            requested_standard VARCHAR,
+            source VARCHAR,
+            reason VARCHAR,
+            event_hash VARCHAR
+        )
+    """)
+    duckdb_conn.execute("""
+        CREATE TABLE IF NOT EXISTS request_event_batches (
+            batch_id BIGINT PRIMARY KEY,
+            first_event_id BIGINT,
+            last_event_id BIGINT,
+            events BIGINT,
+            prev_hash VARCHAR,
+            batch_hash VARCHAR,
+            committed_at TIMESTAMP DEFAULT current_timestamp
+        )
+    """)
+
+
+def _head(duckdb_conn):
+    """Get the last batch id, batch hash and event id of the chain."""
+    row = duckdb_conn.execute("""
+        SELECT batch_id, batch_hash, last_event_id FROM request_event_batches ORDER BY batch_id DESC LIMIT 1
+    """).fetchone()
+    return row if row else (0, GENESIS_HASH, 0)
+
+
+def _write_batch(duckdb_conn, source_query, params=None):
+    """Append the events of source_query (event_id and EVENT_COLUMNS) as the next batch of the chain,
+    inside the caller's transaction. Returns the number of events written."""
+    batch_id, prev_hash, _ = _head(duckdb_conn)
+    batch_id += 1
+    written = duckdb_conn.execute(f"""
+        INSERT INTO request_events
+        SELECT event_id, ?, {", ".join(EVENT_COLUMNS)}, {EVENT_HASH_SQL}
+        FROM ({source_query})
+        ORDER BY event_id
+    """, [batch_id, *(params or [])]).fetchone()[0]
+    if written:
+        duckdb_conn.execute("""
+            INSERT INTO request_event_batches (batch_id, first_event_id, last_event_id, events, prev_hash, batch_hash)
+            SELECT ?, min(event_id), max(event_id), count(*), ?, sha256(? || string_agg(event_hash, '' ORDER BY event_id))
+            FROM request_events
+            WHERE batch_id = ?
+        """, [batch_id, prev_hash, prev_hash, batch_id])
+    return written
+
+
+def log_imported(duckdb_conn):
+    """Log the transitions of the requests and credits loaded from the exports that have no event yet,
+    at their recorded dates. Run it in the setup transaction. Returns the number of events logged."""
+    duckdb_conn.execute(f"""
+        CREATE OR REPLACE TEMP TABLE imported_events AS
+        WITH derived AS (
+            SELECT request_date::TIMESTAMP AS occurred_at, '{SUBMITTED}' AS event, id_request, customer_id, requested_standard
+            FROM requests
+            UNION ALL
+            SELECT request_date::TIMESTAMP, '{VALIDATED}', id_request, customer_id, requested_standard
+            FROM requests
+            WHERE requested_standard IS NOT NULL
+            UNION ALL
+            SELECT c.occurred_at, c.event, c.id_request, c.customer_id, r.requested_standard
+            FROM (
+                SELECT min(reserved_date)::TIMESTAMP AS occurred_at, '{RESERVED}' AS event, id_request, any_value(customer_id) AS customer_id
+                FROM credits
+                WHERE id_request IS NOT NULL AND reserved_date IS NOT NULL
+                GROUP BY id_request
+                UNION ALL
+                SELECT min(consumed_date)::TIMESTAMP, '{CONSUMED}', id_request, any_value(customer_id)
+                FROM credits
+                WHERE id_request IS NOT NULL AND credit_state = 'consumed' AND consumed_date IS NOT NULL
+                GROUP BY id_request
+            ) c
+            LEFT JOIN requests r ON r.id_request = c.id_request
+        )
+        SELECT
+            (SELECT COALESCE(max(last_event_id), 0) FROM request_event_batches)
+                + row_number() OVER (ORDER BY d.occurred_at, d.id_request, d.event) AS event_id,
+            d.occurred_at, d.event, d.id_request, d.customer_id, d.requested_standard,
+            'import' AS source, NULL::VARCHAR AS reason
+        FROM derived d
+        WHERE d.id_request IS NOT NULL AND d.occurred_at IS NOT NULL
+        AND NOT EXISTS (
+            SELECT 1 FROM request_events e WHERE e.id_request = d.id_request AND e.event = d.event
+        )
+    """)
+    try:
+        first, last = duckdb_conn.execute("SELECT min(event_id), max(event_id) FROM imported_events").fetchone()
+        logged = 0
+        # a batch is hashed as one string, large imports are cut into several
+        for start in range(first or 0, (last or -1) + 1, IMPORT_BATCH_EVENTS):
+            logged += _write_batch(duckdb_conn, """
+                SELECT * FROM imported_events WHERE event_id >= ? AND event_id < ?
+            """, [start, start + IMPORT_BATCH_EVENTS])
+        return logged
+    finally:
+        duckdb_conn.execute("DROP TABLE imported_events")
+
+
+class EventLog:
+    """Buffer of events written to request_events by a background thread, one batch per commit."""
+
+    def __init__(self, manager, flush_seconds=FLUSH_SECONDS, flush_events=FLUSH_EVENTS):
+        self.manager = manager
+        self.flush_seconds = flush_seconds
+        self.flush_events = flush_events
+        self.flushes = 0
+        self.written = 0
+        self._buffer = []
+        self._ready = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def append(self, events):
+        """Buffer events, tuples of EVENT_COLUMNS."""
+        with self._ready:
+            self._buffer.extend(events)
+            if len(self._buffer) >= self.flush_events:
+                self._ready.notify()
+
+    def pending(self):
+        """Count the buffered events."""
+        return len(self._buffer)
+
+    def flush(self):
+        """Write the buffered events as one batch of the chain. Returns the number written, -1 on error (they stay buffered)."""
+        with self._flush_lock:
+            with self._ready:
+                events, self._buffer = self._buffer, []
+            if not events:
+                return 0
+            try:
+                self._write(events)
+            except Exception as e:
+                print(f"Error writing request events: {e}")
+                with self._ready:
+                    self._buffer[:0] = events
+                return -1
+            self.flushes += 1
+            self.written += len(events)
+            return len(events)
+
+    def _write(self, events):
+        import pyarrow as pa
+
+        columns = list(zip(*events))
+        buffer = pa.table({
+            "position": pa.array(range(1, len(events) + 1), pa.int64()),
+            "occurred_at": pa.array(columns[0], pa.timestamp("us")),
+            **{name: pa.array(values, pa.string()) for name, values in zip(EVENT_COLUMNS[1:3], columns[1:3])},
+            "customer_id": pa.array(columns[3], pa.int64()),
+            **{name: pa.array(values, pa.string()) for name, values in zip(EVENT_COLUMNS[4:], columns[4:])},
+        })
+        with instrumentation.timed("event_log_flush"), self.manager.writer() as conn:
+            conn.register("request_events_buffer", buffer)
+            conn.begin()
+            try:
+                _, _, last_event_id = _head(conn)
+                _write_batch(conn, f"""
+                    SELECT ? + position AS event_id, * FROM request_events_buffer
+                """, [last_event_id])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.unregister("request_events_buffer")
+
+    def start(self):
+        """Flush on a background thread every flush_seconds, or sooner when flush_events are buffered."""
+
+        def flush_forever():
+            while True:
+                with self._ready:
+                    self._ready.wait_for(lambda: len(self._buffer) >= self.flush_events, timeout=self.flush_seconds)
+                self.flush()
+
+        self._thread = threading.Thread(target=flush_forever, name="event-log", daemon=True)
+        self._thread.start()
+        # the events buffered when the interpreter exits are written before it does
+        atexit.register(self.flush)
+
+
+def start(manager):
+    """Start the event log of this process on the writer of manager, once. Returns True if started.
+    Replicas read a snapshot and have no writer, their events are not recorded."""
+    global _log
+    import tools.snapshots as snapshots
+
+    if snapshots.is_replica():
+        return False
+    with _log_lock:
+        if _log is not None:
+            return False
+        _log = EventLog(manager)
+        _log.start()
+    return True
+
+
+def flush():
+    """Write the buffered events now. Returns the number written, -1 on error."""
+    return _log.flush() if _log is not None else 0
+
+
+def stats():
+    """Get the buffered, written and flush counts of the event log."""
+    if _log is None:
+        return {"pending": 0, "written": 0, "flushes": 0}
+    return {"pending": _log.pending(), "written": _log.written, "flushes": _log.flushes}
+
+
+def record(event, id_request=None, customer_id=None, requested_standard=None, source=None, reason=None):
+    """Record one event. Nothing is recorded if the log was not started in this process."""
+    if _log is not None:
+        _log.append([(datetime.datetime.now(), event, id_request, _as_id(customer_id), requested_standard, source, reason)])
+
+
+def record_accepted(id_request, customer_id, requested_standard, source):
+    """Record a request stored after its validation passed, with its credits reserved."""
+    if _log is not None:
+        now, customer_id = datetime.datetime.now(), _as_id(customer_id)
+        _log.append([
+            (now, event, id_request, customer_id, requested_standard, source, None)
+            for event in (SUBMITTED, VALIDATED, RESERVED)
+        ])
+
+
+def record_rejected(customer_id, requested_standard, source, reason):
+    """Record a request turned down, it was never stored."""
+    if _log is not None:
+        now, customer_id = datetime.datetime.now(), _as_id(customer_id)
+        _log.append([
+            (now, SUBMITTED, None, customer_id, requested_standard, source, None),
+            (now, REJECTED, None, customer_id, requested_standard, source, reason),
+        ])
+
+
+def record_verdicts(verdicts, source):
+    """Record the rows of a bulk verdict frame: the accepted ones with their id_request, the others with their rejection_reason."""
+    if _log is None or verdicts.empty:
+        return
+    now = datetime.datetime.now()
+    accepted = verdicts["accepted"] if "accepted" in verdicts else [False] * len(verdicts)
+    id_requests = verdicts["id_request"] if "id_request" in verdicts else [None] * len(verdicts)
+    events = []
+    for is_accepted, id_request, customer_id, standard, reason in zip(
+        accepted, id_requests, verdicts["customer_id"], verdicts["requested_standard"], verdicts["rejection_reason"]
+    ):
+        customer_id = _as_id(customer_id)
+        standard = standard if isinstance(standard, str) else None
+        events.append((now, SUBMITTED, id_request if is_accepted else None, customer_id, standard, source, None))
+        if is_accepted:
+            events.append((now, VALIDATED, id_request, customer_id, standard, source, None))
+            events.append((now, RESERVED, id_request, customer_id, standard, source, None))
+        else:
+            events.append((now, REJECTED, None, customer_id, standard, source, reason))
+    _log.append(events)
+
+
+def _as_id(value):
+    """Turn a customer id as read from a form or file into an int. Returns None if it is not a number."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_funnel(duckdb_conn, days=90):
+    """Count the events of every funnel stage, and the rejections, of the last days. Returns an empty dict on error."""
+    try:
+        rows = duckdb_conn.execute("""
+            SELECT event, count(*) FROM request_events
+            WHERE occurred_at >= current_date - to_days(?::INTEGER)
+            GROUP BY event
+        """, [int(days)]).fetchall()
+        return dict(rows)
+    except Exception as e:
+        print(f"Error getting the request funnel: {e}")
+        return {}
+
+
+def verify(duckdb_conn):
+    """Recompute the hash of every event and batch of the chain. Returns the batch ids that do not match,
+    empty if the log is intact, and the hash of the last batch, to keep outside the database."""
+    broken = duckdb_conn.execute(f"""
+        WITH events AS (
+            SELECT batch_id, count(*) AS events, min(event_id) AS first_event_id, max(event_id) AS last_event_id,
+                bool_and(event_hash = {EVENT_HASH_SQL}) AS events_match,
+                string_agg(event_hash, '' ORDER BY event_id) AS hashes
+            FROM request_events
+            GROUP BY batch_id
+        ),
+        batches AS (
+            SELECT *, COALESCE(lag(batch_hash) OVER (ORDER BY batch_id), '{GENESIS_HASH}') AS chained_hash
+            FROM request_event_batches
+        )
+        SELECT COALESCE(b.batch_id, e.batch_id) AS batch_id
+        FROM batches b
+        FULL JOIN events e ON e.batch_id = b.batch_id
+        WHERE b.batch_id IS NULL OR e.batch_id IS NULL
+            OR NOT e.events_match
+            OR e.events <> b.events OR e.first_event_id <> b.first_event_id OR e.last_event_id <> b.last_event_id
+            OR b.prev_hash <> b.chained_hash
+            OR b.batch_hash <> sha256(b.prev_hash || e.hashes)
+        ORDER BY batch_id
+    """).fetchall()
+    return [row[0] for row in broken], _head(duckdb_conn)[1]
+
+
+def main(argv=None):
+    import tools.connections as connections
+
+    parser = argparse.ArgumentParser(description="Check the hash chain of the request event log.")
+    parser.add_argument("--verify", action="store_true", help="Recompute every event and batch hash.")
+    parser.add_argument("--database", default=connections.DEFAULT_DATABASE, help="DuckDB database file.")
+    parser.add_argument("--snapshot", action="store_true", help="Read the current snapshot, the database is locked while the app runs.")
+    args = parser.parse_args(argv)
+    if not args.verify:
+        parser.print_usage()
+        return 2
+
+    if args.snapshot:
+        import tools.snapshots as snapshots
+
+        manager = snapshots.ReplicaManager(snapshots.snapshot_dir_from_env(), 1)
+    else:
+        import tools.qdb as qdb
+
+        manager = connections.ConnectionManager(args.database, 1, setup=qdb.setup_database)
+    try:
+        with manager.reader() as conn:
+            broken, head = verify(conn)
+            events = conn.execute("SELECT count(*) FROM request_events").fetchone()[0]
+    except Exception as e:
+        print(f"Error verifying the event log: {e}")
+        return 2
+    finally:
+        manager.close()
+
+    if broken:
+        print(f"Event log tampered with: batches {', '.join(str(batch_id) for batch_id in broken)} do not match")
+        return 1
+    print(f"Event log intact: {events} events, last batch hash {head}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
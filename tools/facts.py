@@ -0,0 +1,478 @@
+'''
+facts.py
+This file maintains the star schema the dashboard and the request browser read from, and keeps it
+up to date incrementally.
+fact_request holds one row per request with integer surrogate keys into the date, customer, supplier
+site and standard dimensions. Every join between them is an equality on a single key, so DuckDB plans
+them as hash joins. FACT_REQUESTS is a view adding the customer and supplier site attributes to the
+fact, for the queries written against the flat table.
+fact_request is kept in request_date order, so windowed queries skip the row groups of other months,
+and closed months can be archived to Parquet with tools.partitions. FACT_REQUESTS and the rollups
+read fact_request_all, the table and its archived months together. Archived months are frozen: credit
+changes of their requests are picked up when the months are restored or the star schema is rebuilt.
+New requests are picked up with a watermark on the requests rowid, kept in fact_watermark rather than
+read from fact_request so archiving the newest months does not lower it, and requests whose credits
+changed are read from credit_changes, which tools.ledger appends to when it moves credits and the
+refresh empties. Credits changed outside tools.ledger are picked up by a rebuild.
+'''
+import collections
+import datetime
+
+import tools.kpis as kpis
+import tools.ledger as ledger
+import tools.partitions as partitions
+
+Dimension = collections.namedtuple("Dimension", ["table", "key", "natural_key", "columns", "source"])
+
+_STANDARDS = ", ".join(f"('{standard}', {credits})" for standard, credits in ledger.REQUIRED_CREDITS.items())
+
+# source selects the distinct natural keys, and their attributes, of the requests matching {request_filter}
+DIMENSIONS = [
+    Dimension(
+        "dim_date", "date_key", "calendar_date",
+        "calendar_date DATE, year INTEGER, quarter INTEGER, month INTEGER, iso_week INTEGER, day_of_week INTEGER",
+        """
+            SELECT calendar_date, year(calendar_date), quarter(calendar_date), month(calendar_date),
+                weekofyear(calendar_date), isodow(calendar_date)
+            FROM (SELECT DISTINCT r.request_date AS calendar_date FROM requests r WHERE {request_filter})
+        """,
+    ),
+    Dimension(
+        "dim_customer", "customer_key", "customer_id",
+        "customer_id BIGINT",
+        "SELECT DISTINCT r.customer_id FROM requests r WHERE {request_filter}",
+    ),
+    Dimension(
+        "dim_supplier_site", "supplier_site_key", "supplier_site_id",
+        "supplier_site_id BIGINT, supplier_site_name VARCHAR, supplier_site_country VARCHAR, "
+        "supplier_site_address VARCHAR, supplier_site_availability BOOLEAN",
+        """
+            SELECT s.supplier_site_id, s.supplier_site_name, s.supplier_site_country,
+                s.supplier_site_address, s.supplier_site_availability
+            FROM suppliers s
+            WHERE s.supplier_site_id IN (SELECT r.requested_supplier_site_id FROM requests r WHERE {request_filter})
+        """,
+    ),
+    Dimension(
+        "dim_standard", "standard_key", "requested_standard",
+        "requested_standard VARCHAR, required_credits INTEGER",
+        f"""
+            SELECT s.requested_standard, q.required_credits
+            FROM (SELECT DISTINCT r.requested_standard FROM requests r WHERE {{request_filter}}) s
+            LEFT JOIN (VALUES {_STANDARDS}) q(requested_standard, required_credits) USING (requested_standard)
+        """,
+    ),
+]
+
+FACT_COLUMNS = """
+    request_rowid BIGINT,
+    id_request VARCHAR,
+    date_key INTEGER,
+    customer_key INTEGER,
+    supplier_site_key INTEGER,
+    standard_key INTEGER,
+    request_date DATE,
+    requested_standard VARCHAR,
+    requested_supplier_site_id BIGINT,
+    requested_audit_id VARCHAR,
+    audit_scope VARCHAR,
+    contact_information VARCHAR,
+    quality_officer_id BIGINT,
+    is_currently_blacklisted INTEGER,
+    credit_id VARCHAR,
+    credit_state VARCHAR,
+    reserved_date DATE,
+    consumed_date DATE,
+    request_count INTEGER,
+    has_audit_id BOOLEAN
+"""
+
+FACT_REQUESTS_VIEW = """
+    CREATE OR REPLACE VIEW FACT_REQUESTS AS
+    SELECT
+        f.request_rowid,
+        f.id_request,
+        f.request_date,
+        f.requested_standard,
+        f.requested_supplier_site_id,
+        f.requested_audit_id,
+        f.audit_scope,
+        f.contact_information,
+        f.quality_officer_id,
+        c.customer_id,
+        s.supplier_site_id AS supplier_site_id_resolved,
+        s.supplier_site_name,
+        s.supplier_site_country,
+        s.supplier_site_address,
+        s.supplier_site_availability,
+        f.is_currently_blacklisted,
+        f.credit_id,
+        f.credit_state,
+        f.reserved_date,
+        f.consumed_date,
+        f.request_count,
+        f.has_audit_id,
+        f.date_key,
+        f.customer_key,
+        f.supplier_site_key,
+        f.standard_key
+    FROM fact_request_all f
+    LEFT JOIN dim_customer c ON c.customer_key = f.customer_key
+    LEFT JOIN dim_supplier_site s ON s.supplier_site_key = f.supplier_site_key
+"""
+
+
+def fact_requests_query(request_filter="true"):
+    """Build the fact_request select for the requests matching request_filter (a SQL predicate over requests r).
+    The dimensions must already hold the natural keys of these requests."""
+    return f"""
+        WITH request_base AS (
+            SELECT
+                r.rowid AS request_rowid,
+                r.id_request,
+                r.request_date,
+                r.requested_standard,
+                r.requested_supplier_site_id,
+                r.requested_audit_id,
+                r.audit_scope,
+                r.contact_information,
+                r.quality_officer_id,
+                r.customer_id
+            FROM requests r
+            WHERE {request_filter}
+        ),
+
+        -- Choose the single most relevant credit per request
+        credit_ranked AS (
+            SELECT
+                c.credit_id,
+                c.credit_state,
+                c.reserved_date,
+                c.consumed_date,
+                c.id_request,
+                ROW_NUMBER() OVER (
+                    PARTITION BY c.id_request
+                    ORDER BY COALESCE(c.consumed_date, c.reserved_date) DESC NULLS LAST,
+                            c.credit_id
+                ) AS rn
+            FROM credits c
+            WHERE c.id_request IN (SELECT id_request FROM request_base)
+        ),
+        credit_best AS (
+            SELECT *
+            FROM credit_ranked
+            WHERE rn = 1
+        )
+
+        SELECT
+            rb.request_rowid,
+            rb.id_request,
+
+            -- Surrogate keys of the dimensions
+            dd.date_key,
+            dc.customer_key,
+            ds.supplier_site_key,
+            dst.standard_key,
+
+            rb.request_date,
+            rb.requested_standard,
+            rb.requested_supplier_site_id,
+            rb.requested_audit_id,
+            rb.audit_scope,
+            rb.contact_information,
+            rb.quality_officer_id,
+
+            -- Blacklist snapshot as-of request date
+            CASE WHEN bi.supplier_site_id IS NOT NULL THEN 1 ELSE 0 END AS is_currently_blacklisted,
+
+            -- Credit linked to this request (if any)
+            cb.credit_id,
+            cb.credit_state,
+            cb.reserved_date,
+            cb.consumed_date,
+
+            -- Simple additive metrics
+            1 AS request_count,
+            CASE WHEN rb.requested_audit_id IS NOT NULL AND rb.requested_audit_id <> '' THEN TRUE ELSE FALSE END AS has_audit_id
+        FROM request_base rb
+        LEFT JOIN dim_date dd ON dd.calendar_date = rb.request_date
+        LEFT JOIN dim_customer dc ON dc.customer_id = rb.customer_id
+        LEFT JOIN dim_supplier_site ds ON ds.supplier_site_id = rb.requested_supplier_site_id
+        LEFT JOIN dim_standard dst ON dst.requested_standard = rb.requested_standard
+        LEFT JOIN credit_best cb ON cb.id_request = rb.id_request
+        -- Merged blacklist intervals never overlap, so this range join matches at most one row
+        LEFT JOIN blacklist_intervals bi
+            ON bi.supplier_site_id = rb.requested_supplier_site_id
+            AND rb.request_date >= bi.blacklist_since
+            AND rb.request_date <= COALESCE(bi.blacklist_until, DATE '9999-12-31')
+    """
+
+
+def dimension_keys_query(dimension, request_filter="true", first_key=1):
+    """Build the insert numbering, from first_key, the natural keys of the requests matching request_filter missing from a dimension."""
+    source = dimension.source.format(request_filter=request_filter)
+    return f"""
+        INSERT INTO {dimension.table}
+        SELECT {int(first_key) - 1} + row_number() OVER (ORDER BY n.{dimension.natural_key}), n.*
+        FROM ({source}) n
+        LEFT JOIN {dimension.table} d ON d.{dimension.natural_key} = n.{dimension.natural_key}
+        WHERE n.{dimension.natural_key} IS NOT NULL
+        AND d.{dimension.key} IS NULL
+    """
+
+
+def add_dimension_keys(duckdb_conn, request_filter="true"):
+    """Add the natural keys of the requests matching request_filter to every dimension.
+    Keys are never reused or changed, so fact rows written earlier stay valid."""
+    for dimension in DIMENSIONS:
+        last_key = duckdb_conn.execute(f"SELECT COALESCE(max({dimension.key}), 0) FROM {dimension.table}").fetchone()[0]
+        duckdb_conn.execute(dimension_keys_query(dimension, request_filter, last_key + 1))
+
+
+def fact_requests_type(duckdb_conn):
+    """Get whether FACT_REQUESTS is a 'VIEW' or a 'BASE TABLE', as materialized by older versions. Returns None if missing or on error."""
+    try:
+        row = duckdb_conn.execute("""
+            SELECT table_type
+            FROM information_schema.tables
+            WHERE lower(table_name) = 'fact_requests'
+            LIMIT 1
+        """).fetchone()
+        return row[0] if row else None
+    except Exception as e:
+        print(f"Error checking FACT_REQUESTS type: {e}")
+        return None
+
+
+def insert_fact_requests(duckdb_conn, request_filter="true"):
+    """Insert the fact rows of the requests matching request_filter in request_date order. Returns the number of rows."""
+    return duckdb_conn.execute(f"""
+        INSERT INTO fact_request
+        SELECT * FROM ({fact_requests_query(request_filter)}) ORDER BY request_date
+    """).fetchone()[0]
+
+
+def _months_filter(months):
+    for month in months:
+        datetime.date.fromisoformat(f"{month}-01")
+    return f"{partitions.month_sql('r.request_date')} IN ({', '.join(repr(month) for month in months)})"
+
+
+def rebuild_fact_requests(duckdb_conn, compact=False):
+    """Rebuild the dimensions and fact_request from scratch, archived months included, and empty credit_changes.
+    With compact, the requests table is first rewritten in request_date order. Returns True on success, False on failure."""
+    in_transaction = False
+    try:
+        if compact:
+            # rowids of the rewritten table are only final once committed, the fact is rebuilt after;
+            # fact_request is dropped with it so a failed rebuild is redone on the next start
+            duckdb_conn.begin()
+            in_transaction = True
+            partitions.compact_table(duckdb_conn, "requests")
+            duckdb_conn.execute("DROP TABLE IF EXISTS fact_request")
+            duckdb_conn.commit()
+
+        duckdb_conn.begin()
+        in_transaction = True
+        if fact_requests_type(duckdb_conn) == "BASE TABLE":
+            duckdb_conn.execute("DROP TABLE FACT_REQUESTS")
+        partitions.setup_archive(duckdb_conn)
+        archived = partitions.archived_months(duckdb_conn, "fact_request")
+        for dimension in DIMENSIONS:
+            duckdb_conn.execute(f"CREATE OR REPLACE TABLE {dimension.table} ({dimension.key} INTEGER PRIMARY KEY, {dimension.columns})")
+        add_dimension_keys(duckdb_conn)
+        duckdb_conn.execute(f"CREATE OR REPLACE TABLE fact_request ({FACT_COLUMNS})")
+        insert_fact_requests(duckdb_conn)
+        duckdb_conn.execute("""
+            CREATE OR REPLACE TABLE fact_watermark AS
+            SELECT COALESCE(max(request_rowid), -1) AS request_rowid FROM fact_request
+        """)
+        # archived months are written again with the new keys, in a single file each
+        stale_files = partitions.unarchive_months(duckdb_conn, "fact_request", archived)
+        partitions.archive_months(duckdb_conn, "fact_request", archived)
+        duckdb_conn.execute(FACT_REQUESTS_VIEW)
+        # every credit change is in the rebuilt fact, older databases compared the credits with a snapshot
+        ledger.setup_credit_changes(duckdb_conn)
+        duckdb_conn.execute("DELETE FROM credit_changes")
+        duckdb_conn.execute("DROP TABLE IF EXISTS fact_credits_snapshot")
+        kpis.rebuild_rollups(duckdb_conn)
+        duckdb_conn.commit()
+        partitions.remove_files(stale_files)
+        return True
+    except Exception as e:
+        print(f"Error rebuilding FACT_REQUESTS: {e}")
+        if in_transaction:
+            duckdb_conn.rollback()
+        return False
+
+
+def _watermark(duckdb_conn):
+    """Get the rowid of the last request in the fact, archived months included."""
+    return int(duckdb_conn.execute("SELECT request_rowid FROM fact_watermark").fetchone()[0])
+
+
+def refresh_fact_requests(duckdb_conn):
+    """Add new requests to fact_request and recompute requests whose credits changed. Returns the number of refreshed requests, -1 on error."""
+    in_transaction = False
+    try:
+        duckdb_conn.begin()
+        in_transaction = True
+
+        watermark = _watermark(duckdb_conn)
+
+        # Requests whose credits were moved by the ledger since the last refresh
+        duckdb_conn.execute("""
+            CREATE OR REPLACE TEMP TABLE fact_changed_requests AS
+            SELECT DISTINCT id_request FROM credit_changes WHERE id_request IS NOT NULL
+        """)
+        if partitions.archived_months(duckdb_conn, "fact_request"):
+            # requests of archived months are frozen, only the ones still in fact_request are recomputed
+            duckdb_conn.execute("""
+                DELETE FROM fact_changed_requests
+                WHERE id_request NOT IN (SELECT id_request FROM fact_request WHERE id_request IS NOT NULL)
+            """)
+
+        request_filter = f"r.rowid > {int(watermark)} OR r.id_request IN (SELECT id_request FROM fact_changed_requests)"
+        add_dimension_keys(duckdb_conn, request_filter)
+        duckdb_conn.execute("""
+            DELETE FROM fact_request
+            WHERE id_request IN (SELECT id_request FROM fact_changed_requests)
+        """)
+        refreshed = insert_fact_requests(duckdb_conn, request_filter)
+        duckdb_conn.execute(f"""
+            UPDATE fact_watermark
+            SET request_rowid = (SELECT COALESCE(max(request_rowid), {int(watermark)}) FROM fact_request WHERE request_rowid > {int(watermark)})
+        """)
+
+        # Days whose dashboard rollup includes a refreshed request
+        duckdb_conn.execute(f"""
+            CREATE OR REPLACE TEMP TABLE fact_changed_days AS
+            SELECT DISTINCT request_date
+            FROM fact_request
+            WHERE request_rowid > {int(watermark)}
+            OR id_request IN (SELECT id_request FROM fact_changed_requests)
+        """)
+        kpis.refresh_rollup_days(duckdb_conn, "fact_changed_days")
+
+        # changes logged by transactions committed after this one started are left for the next refresh
+        duckdb_conn.execute("DELETE FROM credit_changes")
+
+        for temp_table in ["fact_changed_requests", "fact_changed_days"]:
+            duckdb_conn.execute(f"DROP TABLE {temp_table}")
+        duckdb_conn.commit()
+        return int(refreshed)
+    except Exception as e:
+        print(f"Error refreshing FACT_REQUESTS: {e}")
+        if in_transaction:
+            duckdb_conn.rollback()
+        return -1
+
+
+def archive_fact_requests(duckdb_conn, before):
+    """Move the months of fact_request older than before (YYYY-MM) to the Parquet archive. Returns the number of archived rows, -1 on error."""
+    in_transaction = False
+    try:
+        duckdb_conn.begin()
+        in_transaction = True
+        months = partitions.months_before(duckdb_conn, "fact_request", before)
+        archived = partitions.archive_months(duckdb_conn, "fact_request", months)
+        duckdb_conn.commit()
+        return archived
+    except Exception as e:
+        print(f"Error archiving FACT_REQUESTS: {e}")
+        if in_transaction:
+            duckdb_conn.rollback()
+        return -1
+
+
+def restore_fact_requests(duckdb_conn, months):
+    """Bring archived months (YYYY-MM) back into fact_request, recomputed from the current requests and credits.
+    Returns the number of restored rows, -1 on error."""
+    in_transaction = False
+    try:
+        duckdb_conn.begin()
+        in_transaction = True
+        stale_files = partitions.unarchive_months(duckdb_conn, "fact_request", months)
+        request_filter = _months_filter(months)
+        # requests past the watermark are left for the next refresh, which would add them again
+        loaded_filter = f"({request_filter}) AND r.rowid <= {_watermark(duckdb_conn)}"
+        add_dimension_keys(duckdb_conn, loaded_filter)
+        # rows added to these months after they were archived are still in fact_request
+        duckdb_conn.execute(f"DELETE FROM fact_request r WHERE {request_filter}")
+        restored = insert_fact_requests(duckdb_conn, loaded_filter)
+        duckdb_conn.execute(f"""
+            CREATE OR REPLACE TEMP TABLE fact_changed_days AS
+            SELECT DISTINCT request_date FROM requests r WHERE {request_filter}
+        """)
+        kpis.refresh_rollup_days(duckdb_conn, "fact_changed_days")
+        duckdb_conn.execute("DROP TABLE fact_changed_days")
+        duckdb_conn.commit()
+        partitions.remove_files(stale_files)
+        return int(restored)
+    except Exception as e:
+        print(f"Error restoring FACT_REQUESTS months: {e}")
+        if in_transaction:
+            duckdb_conn.rollback()
+        return -1
+
+
+# merged blacklist intervals never overlap, so each fact row matches at most one of them
+BLACKLIST_FLAG_UPDATE = """
+    UPDATE fact_request f
+    SET is_currently_blacklisted = flags.is_currently_blacklisted
+    FROM (
+        SELECT
+            s.request_rowid,
+            CASE WHEN bi.supplier_site_id IS NOT NULL THEN 1 ELSE 0 END AS is_currently_blacklisted
+        FROM fact_request s
+        LEFT JOIN blacklist_intervals bi
+            ON bi.supplier_site_id = s.requested_supplier_site_id
+            AND s.request_date >= bi.blacklist_since
+            AND s.request_date <= COALESCE(bi.blacklist_until, DATE '9999-12-31')
+        WHERE s.requested_supplier_site_id = ?
+    ) flags
+    WHERE f.request_rowid = flags.request_rowid
+"""
+
+
+def refresh_fact_blacklist(duckdb_conn, supplier_site_id):
+    """Recompute the blacklist flag of every fact row of a supplier site. Returns True on success, False on failure."""
+    try:
+        duckdb_conn.execute(BLACKLIST_FLAG_UPDATE, [int(supplier_site_id)])
+        return True
+    except Exception as e:
+        print(f"Error refreshing FACT_REQUESTS blacklist flags: {e}")
+        return False
+
+
+if __name__ == "__main__":
+    import argparse
+
+    import duckdb
+
+    parser = argparse.ArgumentParser(description="Refresh the FACT_REQUESTS star schema.")
+    parser.add_argument("--database", default="data/qdb.duckdb", help="DuckDB database file.")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild the table from scratch instead of refreshing it.")
+    parser.add_argument("--compact", action="store_true", help="Rewrite requests in date order, then rebuild.")
+    parser.add_argument("--archive-before", metavar="YYYY-MM", help="Archive the months older than this one to Parquet.")
+    parser.add_argument("--restore", nargs="+", metavar="YYYY-MM", help="Bring archived months back into the table.")
+    parser.add_argument("--partitions", action="store_true", help="Print the rows and row groups of every month.")
+    args = parser.parse_args()
+
+    conn = duckdb.connect(args.database, read_only=False)
+    if args.rebuild or args.compact:
+        print("FACT_REQUESTS rebuilt." if rebuild_fact_requests(conn, compact=args.compact) else "FACT_REQUESTS rebuild failed.")
+    elif args.archive_before:
+        archived = archive_fact_requests(conn, args.archive_before)
+        print(f"FACT_REQUESTS archived: {archived} rows." if archived >= 0 else "FACT_REQUESTS archive failed.")
+    elif args.restore:
+        restored = restore_fact_requests(conn, args.restore)
+        print(f"FACT_REQUESTS restored: {restored} rows." if restored >= 0 else "FACT_REQUESTS restore failed.")
+    elif not args.partitions:
+        refreshed = refresh_fact_requests(conn)
+        print(f"FACT_REQUESTS refreshed: {refreshed} requests." if refreshed >= 0 else "FACT_REQUESTS refresh failed.")
+    if args.partitions:
+        for partition in partitions.partition_stats(conn, "fact_request"):
+            where = "archive" if partition.archived else "table"
+            print(f"{partition.month}: {partition.rows} rows in {partition.row_groups} row groups ({where})")
+    conn.close()
@@ -0,0 +1,128 @@
+'''
+forecast.py
+This file fits Prophet forecasts in background threads and caches them per series, so dashboard
+reruns read the last good forecast instead of fitting a new model every time. It is the high
+accuracy backend of the dashboard, for the one series picked there; tools.forecast_engine forecasts
+every series at once.
+Each series (family:key) is a shard with its own lock, cached model and forecast.
+A shard is refit only when its series gains new days; Stan fits run in a separate process, so the
+thread pool fits several series in parallel across cores.
+'''
+import collections
+import hashlib
+import os
+import threading
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+import tools.instrumentation as instrumentation
+
+FORECAST_DAYS = 30
+MIN_POINTS = 3
+
+Forecast = collections.namedtuple("Forecast", ["model", "forecast", "series_hash", "last_day", "fitted_at"])
+
+_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="forecast")
+_shards = {}
+_shards_lock = threading.Lock()
+
+
+class _Shard:
+    """Cache slot of one series: the last good forecast and the refit in progress, if any."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entry = None
+        self.pending = None
+        self.pending_last_day = None
+
+
+def _get_shard(series_key):
+    with _shards_lock:
+        return _shards.setdefault(series_key, _Shard())
+
+
+def _as_frame(data):
+    """Convert an Arrow table to pandas, Prophet only takes DataFrames."""
+    if data is not None and hasattr(data, "to_pandas"):
+        with instrumentation.timed("arrow_to_pandas"):
+            return data.to_pandas()
+    return data
+
+
+def prepare_series(series):
+    """Keep the valid (ds, y) points of a daily series, sorted by day."""
+    series = _as_frame(series)
+    if series is None or series.empty:
+        return pd.DataFrame(columns=["ds", "y"])
+    series = series[["ds", "y"]].dropna()
+    series = series[series["y"] > 0]  # Remove zero or negative values
+    series = series.assign(ds=pd.to_datetime(series["ds"]))
+    return series.sort_values("ds").reset_index(drop=True)
+
+
+def series_hash(series):
+    """Hash the points of a prepared series."""
+    values = pd.util.hash_pandas_object(series[["ds", "y"]], index=False).values
+    return hashlib.sha1(values.tobytes()).hexdigest()
+
+
+def _fit(series, hash_value):
+    """Fit Prophet on a prepared series and predict the next FORECAST_DAYS days."""
+    from prophet import Prophet
+
+    # Train Prophet with suppressed warnings
+    with warnings.catch_warnings(), instrumentation.timed("prophet_fit"):
+        warnings.simplefilter("ignore")
+        model = Prophet(yearly_seasonality=False, daily_seasonality=False, interval_width=0.95)
+        model.fit(series)
+
+        # Make future dataframe and forecast
+        future = model.make_future_dataframe(periods=FORECAST_DAYS, freq='d')
+        forecast = model.predict(future)
+
+    return Forecast(model, forecast, hash_value, series["ds"].max(), time.time())
+
+
+def _refit(shard, series, hash_value):
+    try:
+        entry = _fit(series, hash_value)
+    except Exception as e:
+        print(f"Error fitting forecast: {e}")
+        return
+    with shard.lock:
+        # a slower refit of older data must not replace a newer forecast
+        if shard.entry is None or entry.last_day >= shard.entry.last_day:
+            shard.entry = entry
+
+
+def get_forecast(series_key, series, wait=False):
+    """Get the last good forecast of a series, scheduling a background refit when it has new days.
+    Returns None if the series is too short, or if nothing was fitted yet and wait is False."""
+    series = prepare_series(series)
+    if len(series) < MIN_POINTS:
+        return None
+
+    shard = _get_shard(series_key)
+    last_day = series["ds"].max()
+    with shard.lock:
+        entry = shard.entry
+        refit_running = shard.pending is not None and not shard.pending.done()
+        has_new_days = entry is None or last_day > entry.last_day
+        already_scheduled = refit_running and shard.pending_last_day >= last_day
+
+        if has_new_days and not already_scheduled:
+            hash_value = series_hash(series)
+            if entry is None or hash_value != entry.series_hash:
+                shard.pending = _executor.submit(_refit, shard, series, hash_value)
+                shard.pending_last_day = last_day
+        pending = shard.pending
+
+    if entry is None and wait and pending is not None:
+        pending.result()
+        with shard.lock:
+            entry = shard.entry
+    return entry
@@ -0,0 +1,391 @@
+'''
+forecast_engine.py
+This file forecasts the daily request counts of many series at once: all requests, one series per
+standard, one per supplier country and one per supplier site, for capacity planning.
+Every series follows the same model, a linear trend plus a day of week profile, fitted by least
+squares with weights halving every HALF_LIFE_DAYS days so the last weeks count most. The series of a
+family share the days they are fitted on, so the family is kept as the running sums of one set of
+normal equations with a column per series, and all of them are solved in one matrix solve.
+When new days arrive the sums are decayed and the new days added to them, starting from the state
+of the last update instead of refitting the whole history. An update reads only the last
+REVISION_DAYS days, which can still change, and corrects the sums by the difference with what was
+read before. The whole history is read again every REBUILD_SECONDS, for changes to older days.
+Only NumPy is needed; Prophet (tools.forecast) is the slower backend for a closer look at one series.
+
+Usage:
+    python -m tools.forecast_engine --family site --top 20
+    python -m tools.forecast_engine --snapshot --out forecasts.parquet
+'''
+import argparse
+import collections
+import datetime
+import sys
+import threading
+import time
+
+import numpy as np
+
+import tools.instrumentation as instrumentation
+import tools.results as results
+
+FORECAST_DAYS = 30
+MIN_POINTS = 3
+HALF_LIFE_DAYS = 90
+REVISION_DAYS = 35
+REBUILD_SECONDS = 3600
+# how often the last days are read again, the forecasts of the last read are served meanwhile
+CHECK_SECONDS = 5
+# the 95% interval, as wide as the Prophet one
+INTERVAL_Z = 1.96
+# intercept, trend per year and the offsets of Tuesday to Sunday from Monday
+PARAMETERS = 8
+_RIDGE = 1e-6
+_EPOCH = datetime.date(1970, 1, 1)
+
+Family = collections.namedtuple("Family", ["name", "label", "query"])
+Forecasts = collections.namedtuple("Forecasts", [
+    "family", "keys", "days", "yhat", "yhat_lower", "yhat_upper", "weekly", "trend", "points", "last_day", "fitted_at",
+])
+SeriesForecast = collections.namedtuple("SeriesForecast", [
+    "key", "days", "yhat", "yhat_lower", "yhat_upper", "weekly", "trend", "last_day",
+])
+
+# each query selects request_date, series and y for the days matching {where}
+FAMILIES = {
+    "total": Family("total", "All requests", """
+        SELECT request_date, 'All' AS series, sum(total_requests)::DOUBLE AS y
+        FROM kpi_daily
+        WHERE requested_standard IS NOT NULL AND request_date IS NOT NULL AND {where}
+        GROUP BY ALL
+    """),
+    "standard": Family("standard", "Standard", """
+        SELECT request_date, requested_standard AS series, sum(total_requests)::DOUBLE AS y
+        FROM kpi_daily
+        WHERE requested_standard IS NOT NULL AND request_date IS NOT NULL AND {where}
+        GROUP BY ALL
+    """),
+    "country": Family("country", "Supplier country", """
+        SELECT request_date, supplier_site_country AS series, sum(total_requests)::DOUBLE AS y
+        FROM kpi_daily
+        WHERE requested_standard IS NOT NULL AND supplier_site_country IS NOT NULL
+            AND request_date IS NOT NULL AND {where}
+        GROUP BY ALL
+    """),
+    # not in kpi_daily, read from the fact rows of the window only
+    "site": Family("site", "Supplier site", """
+        SELECT request_date, requested_supplier_site_id AS series, count(*)::DOUBLE AS y
+        FROM fact_request_all
+        WHERE requested_standard IS NOT NULL AND requested_supplier_site_id IS NOT NULL
+            AND request_date IS NOT NULL AND {where}
+        GROUP BY ALL
+    """),
+}
+
+_models = {}
+_locks = {name: threading.Lock() for name in FAMILIES}
+
+
+def _design(days, origin):
+    """Build the rows of the model for days counted from 1970-01-01."""
+    days = np.asarray(days, dtype=np.int64)
+    x = np.zeros((len(days), PARAMETERS))
+    x[:, 0] = 1.0
+    x[:, 1] = (days - origin) / 365.0
+    weekday = (days + 3) % 7  # 1970-01-01 was a Thursday, Monday is 0
+    rows = np.nonzero(weekday)[0]
+    x[rows, 1 + weekday[rows]] = 1.0
+    return x
+
+
+class SeriesModel:
+    """Decayed normal equations of a family of daily series, updated day by day."""
+
+    def __init__(self, half_life=HALF_LIFE_DAYS, revision_days=REVISION_DAYS):
+        self.decay = 0.5 ** (1 / half_life)
+        self.revision_days = revision_days
+        self.keys = []
+        self.index = {}
+        self.origin = None
+        self.last_day = None
+        self.xtx = np.zeros((PARAMETERS, PARAMETERS))
+        self.xty = np.zeros((PARAMETERS, 0))
+        self.yty = np.zeros(0)
+        self.weight = 0.0
+        # days with requests per series
+        self.points = np.zeros(0, dtype=np.int64)
+        # the last days as read, to correct the sums when they change
+        self.recent_start = None
+        self.recent = np.zeros((0, 0))
+        self.loaded_at = time.monotonic()
+        self.checked_at = 0.0
+        self.forecasts = None
+
+    def _add_keys(self, keys):
+        new_keys = [key for key in dict.fromkeys(keys) if key not in self.index]
+        if not new_keys:
+            return
+        for key in new_keys:
+            self.index[key] = len(self.keys)
+            self.keys.append(key)
+        # a new series had no requests on the days already added
+        extra = len(new_keys)
+        self.xty = np.hstack([self.xty, np.zeros((PARAMETERS, extra))])
+        self.yty = np.concatenate([self.yty, np.zeros(extra)])
+        self.points = np.concatenate([self.points, np.zeros(extra, dtype=np.int64)])
+        self.recent = np.hstack([self.recent, np.zeros((len(self.recent), extra))])
+
+    def add(self, start, days, keys, values):
+        """Add the values read for every day from start on, days counted from 1970-01-01.
+        start is recent_start after the first call; days without a value had no requests."""
+        days = np.asarray(days, dtype=np.int64)
+        values = np.asarray(values, dtype=float)
+        if self.last_day is None and not len(days):
+            return
+        self._add_keys(keys)
+        columns = np.fromiter((self.index[key] for key in keys), dtype=np.int64, count=len(keys))
+        previous = start - 1 if self.last_day is None else self.last_day
+        end = max(previous, int(days.max())) if len(days) else previous
+        if self.origin is None:
+            self.origin = start
+        size = len(self.keys)
+
+        # the sums so far age by the days between the last update and this one
+        factor = self.decay ** (end - previous)
+        self.xtx *= factor
+        self.xty *= factor
+        self.yty *= factor
+        self.weight *= factor
+
+        # days after the last update: every day joins the design, the points only their own series
+        new_days = np.arange(previous + 1, end + 1)
+        weights = self.decay ** (end - new_days)
+        x = _design(new_days, self.origin)
+        self.xtx += (x * weights[:, None]).T @ x
+        self.weight += weights.sum()
+        new = days > previous
+        point_weights = self.decay ** (end - days[new]) * values[new]
+        rows = _design(days[new], self.origin) * point_weights[:, None]
+        for parameter in range(PARAMETERS):
+            self.xty[parameter] += np.bincount(columns[new], rows[:, parameter], minlength=size)
+        self.yty += np.bincount(columns[new], point_weights * values[new], minlength=size)
+        self.points += np.bincount(columns[new], values[new] > 0, minlength=size).astype(np.int64)
+
+        # days read again: the sums are corrected by the difference with the last read
+        seen = previous - start + 1
+        if seen > 0:
+            window = np.zeros((seen, size))
+            np.add.at(window, (days[~new] - start, columns[~new]), values[~new])
+            offset = start - self.recent_start
+            old = self.recent[offset:offset + seen]
+            seen_days = np.arange(start, previous + 1)
+            weights = self.decay ** (end - seen_days)
+            self.xty += (_design(seen_days, self.origin) * weights[:, None]).T @ (window - old)
+            self.yty += weights @ (window ** 2 - old ** 2)
+            self.points += (window > 0).sum(axis=0) - (old > 0).sum(axis=0)
+
+        self.recent_start = max(start, end - self.revision_days + 1)
+        self.recent = np.zeros((end - self.recent_start + 1, size))
+        kept = days >= self.recent_start
+        np.add.at(self.recent, (days[kept] - self.recent_start, columns[kept]), values[kept])
+        self.last_day = end
+
+    def fit(self):
+        """Solve the model of every series. Returns the parameters (one column per series) and the residual deviation of each."""
+        beta = np.linalg.solve(self.xtx + _RIDGE * np.eye(PARAMETERS), self.xty)
+        squares = self.yty - 2 * (beta * self.xty).sum(axis=0) + (beta * (self.xtx @ beta)).sum(axis=0)
+        sigma = np.sqrt(np.maximum(squares, 0.0) / max(self.weight - PARAMETERS, 1.0))
+        return beta, sigma
+
+    def predict(self, horizon=FORECAST_DAYS):
+        """Forecast the horizon days after the last day of every series."""
+        beta, sigma = self.fit()
+        days = np.arange(self.last_day + 1, self.last_day + 1 + horizon)
+        yhat = _design(days, self.origin) @ beta
+        spread = INTERVAL_Z * sigma
+        weekly = np.vstack([np.zeros(len(self.keys)), beta[2:]])
+        # there can't be negative requests
+        return Forecasts(
+            family=None,
+            keys=list(self.keys),
+            days=days.astype("datetime64[D]"),
+            yhat=np.maximum(yhat, 0.0),
+            yhat_lower=np.maximum(yhat - spread, 0.0),
+            yhat_upper=np.maximum(yhat + spread, 0.0),
+            weekly=weekly - weekly.mean(axis=0),
+            trend=beta[1] / 365.0,
+            points=self.points.copy(),
+            last_day=_EPOCH + datetime.timedelta(days=int(self.last_day)),
+            fitted_at=time.time(),
+        )
+
+
+def _read(duckdb_conn, family, start=None):
+    """Read the (day, series, y) points of a family from start on, the whole history if start is None."""
+    where, params = ("true", []) if start is None else ("request_date >= ?", [_EPOCH + datetime.timedelta(days=int(start))])
+    data = duckdb_conn.execute(f"""
+        SELECT (request_date - DATE '1970-01-01')::BIGINT AS day, series, y
+        FROM ({FAMILIES[family].query.format(where=where)})
+    """, params).fetchnumpy()
+    return np.asarray(data["day"], dtype=np.int64), np.asarray(data["series"]).tolist(), np.asarray(data["y"], dtype=float)
+
+
+def get_forecasts(duckdb_conn, family, horizon=FORECAST_DAYS, max_age=CHECK_SECONDS):
+    """Get the forecasts of every series of a family, updating its model with the days read since the last call
+    when it was last updated more than max_age seconds ago. Returns None if the family has no data or on error."""
+    try:
+        with _locks[family]:
+            model = _models.get(family)
+            if model is not None and time.monotonic() - model.checked_at < max_age:
+                forecasts = model.forecasts
+            else:
+                if model is None or time.monotonic() - model.loaded_at > REBUILD_SECONDS:
+                    model = SeriesModel()
+                    with instrumentation.timed("forecast_engine_load"):
+                        days, keys, values = _read(duckdb_conn, family)
+                    if not len(days):
+                        return None
+                    model.add(int(days.min()), days, keys, values)
+                    _models[family] = model
+                else:
+                    with instrumentation.timed("forecast_engine_update"):
+                        start = model.recent_start
+                        model.add(start, *_read(duckdb_conn, family, start))
+                with instrumentation.timed("forecast_engine_fit"):
+                    forecasts = model.predict(FORECAST_DAYS)._replace(family=family)
+                model.forecasts = forecasts
+                model.checked_at = time.monotonic()
+    except Exception as e:
+        print(f"Error forecasting {family}: {e}")
+        return None
+    if horizon != len(forecasts.days):
+        return _truncate(forecasts, horizon)
+    return forecasts
+
+
+def _truncate(forecasts, horizon):
+    return forecasts._replace(
+        days=forecasts.days[:horizon],
+        yhat=forecasts.yhat[:horizon],
+        yhat_lower=forecasts.yhat_lower[:horizon],
+        yhat_upper=forecasts.yhat_upper[:horizon],
+    )
+
+
+def series_forecast(forecasts, key):
+    """Get the forecast of one series. Returns None if it has fewer than MIN_POINTS days with requests."""
+    if forecasts is None or key not in forecasts.keys:
+        return None
+    column = forecasts.keys.index(key)
+    if forecasts.points[column] < MIN_POINTS:
+        return None
+    return SeriesForecast(
+        key, forecasts.days, forecasts.yhat[:, column], forecasts.yhat_lower[:, column],
+        forecasts.yhat_upper[:, column], forecasts.weekly[:, column], forecasts.trend[column], forecasts.last_day,
+    )
+
+
+def forecast_keys(forecasts):
+    """Get the series with enough days with requests to forecast, in the order they were first seen."""
+    if forecasts is None:
+        return []
+    return [key for key, points in zip(forecasts.keys, forecasts.points) if points >= MIN_POINTS]
+
+
+def top_series(forecasts, count=10):
+    """Get the (key, forecast requests over the horizon) of the count busiest series, the busiest first."""
+    if forecasts is None:
+        return []
+    totals = forecasts.yhat.sum(axis=0)
+    totals[forecasts.points < MIN_POINTS] = -1.0
+    order = np.argsort(-totals, kind="stable")[:count]
+    return [(forecasts.keys[column], float(totals[column])) for column in order if totals[column] >= 0]
+
+
+def series_history(duckdb_conn, family, key):
+    """Get the daily (ds, y) points of one series as an Arrow table, for the Prophet backend."""
+    return results.fetch_table(duckdb_conn, f"""
+        SELECT request_date AS ds, y FROM ({FAMILIES[family].query.format(where='true')})
+        WHERE series = ? ORDER BY ds
+    """, [key])
+
+
+def reset():
+    """Forget the models of every family, the next call reads the whole history."""
+    for family, lock in _locks.items():
+        with lock:
+            _models.pop(family, None)
+
+
+def write_forecasts(path, forecasts_by_family):
+    """Write the forecasts of every series of the families to Parquet, one row per series and day."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    tables = []
+    for family, forecasts in forecasts_by_family.items():
+        valid = np.nonzero(forecasts.points >= MIN_POINTS)[0]
+        days = len(forecasts.days)
+        tables.append(pa.table({
+            "family": [family] * (days * len(valid)),
+            "series": np.repeat(np.array([str(key) for key in forecasts.keys], dtype=object)[valid], days),
+            "ds": np.tile(forecasts.days, len(valid)),
+            # series by series, day after day
+            "yhat": forecasts.yhat[:, valid].T.ravel(),
+            "yhat_lower": forecasts.yhat_lower[:, valid].T.ravel(),
+            "yhat_upper": forecasts.yhat_upper[:, valid].T.ravel(),
+        }))
+    pq.write_table(pa.concat_tables(tables) if tables else pa.table({}), path)
+
+
+def main(argv=None):
+    import tools.connections as connections
+
+    parser = argparse.ArgumentParser(description="Forecast the daily requests of every series of the request families.")
+    parser.add_argument("--family", choices=list(FAMILIES), action="append", help="Family to forecast, every family by default.")
+    parser.add_argument("--days", type=int, default=FORECAST_DAYS, help="Days to forecast, at most FORECAST_DAYS.")
+    parser.add_argument("--top", type=int, default=10, help="Busiest series printed per family.")
+    parser.add_argument("--out", help="Parquet file of the forecasts of every series.")
+    parser.add_argument("--database", default=connections.DEFAULT_DATABASE, help="DuckDB database file.")
+    parser.add_argument("--snapshot", action="store_true", help="Read the current snapshot, the database is locked while the app runs.")
+    args = parser.parse_args(argv)
+
+    if args.snapshot:
+        import tools.snapshots as snapshots
+
+        manager = snapshots.ReplicaManager(snapshots.snapshot_dir_from_env(), 1)
+    else:
+        import tools.qdb as qdb
+
+        manager = connections.ConnectionManager(args.database, 1, setup=qdb.setup_database)
+    try:
+        manager.open()
+    except Exception as e:
+        print(f"Error opening the database: {e}")
+        return 2
+
+    forecasts_by_family = {}
+    try:
+        with manager.reader() as conn:
+            for family in args.family or list(FAMILIES):
+                started = time.perf_counter()
+                forecasts = get_forecasts(conn, family, min(args.days, FORECAST_DAYS))
+                elapsed = time.perf_counter() - started
+                if forecasts is None:
+                    print(f"{FAMILIES[family].label}: no data")
+                    continue
+                forecasts_by_family[family] = forecasts
+                print(f"{FAMILIES[family].label}: {len(forecast_keys(forecasts))} series forecast in {elapsed * 1000:.1f} ms, "
+                      f"requests expected over the next {len(forecasts.days)} days after {forecasts.last_day}:")
+                for key, total in top_series(forecasts, args.top):
+                    print(f"    {key}: {total:.1f}")
+    finally:
+        manager.close()
+
+    if args.out:
+        write_forecasts(args.out, forecasts_by_family)
+        print(f"Forecasts written to {args.out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
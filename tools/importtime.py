@@ -0,0 +1,90 @@
+'''
+importtime.py
+This file is the cold start benchmark of the app, based on python -X importtime.
+Each module is imported in a fresh interpreter and the check fails when its cumulative import time
+goes over its budget, or when it loads a heavy module that the app should only load on first use.
+Budgets are in milliseconds on a developer laptop, --scale multiplies them for slower machines.
+
+Usage:
+    python -m tools.importtime
+    python -m tools.importtime --scale 2 --repeat 5
+'''
+import argparse
+import os
+import subprocess
+import sys
+
+# modules that only the pages needing them may load
+HEAVY_MODULES = ["pandas", "pyarrow", "matplotlib", "prophet", "cmdstanpy"]
+
+# module: (budget in ms, heavy modules it must not load)
+BUDGETS = {
+    "tools.qdb": (1000, HEAVY_MODULES),
+    "tools.browser": (200, HEAVY_MODULES),
+    # validation runs in cron jobs and process pools, without Streamlit
+    "tools.validation": (300, HEAVY_MODULES + ["streamlit"]),
+    # the NumPy engine the dashboard forecasts with, Prophet stays behind tools.forecast
+    "tools.forecast_engine": (300, HEAVY_MODULES),
+    "tools.forecast": (1200, ["matplotlib", "prophet", "cmdstanpy"]),
+    "tools.bulk": (1200, ["matplotlib", "prophet", "cmdstanpy"]),
+}
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def measure(module):
+    """Import a module in a fresh interpreter. Returns its cumulative import time in ms and the set of loaded modules."""
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1])
+
+    cumulative_ms, loaded = None, set()
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue  # header line
+        name = name.strip()
+        loaded.add(name)
+        if name == module:
+            cumulative_ms = int(cumulative) / 1000
+    return cumulative_ms, loaded
+
+
+def check(scale=1.0, repeat=3):
+    """Measure every module in BUDGETS, keeping the fastest of repeat runs. Returns the list of violations."""
+    problems = []
+    for module, (budget_ms, forbidden) in BUDGETS.items():
+        runs = [measure(module) for _ in range(repeat)]
+        elapsed_ms = min(run[0] for run in runs)
+        loaded = runs[0][1]
+        limit_ms = budget_ms * scale
+        print(f"{module}: {elapsed_ms:.0f} ms (budget {limit_ms:.0f} ms)")
+        if elapsed_ms > limit_ms:
+            problems.append(f"{module} takes {elapsed_ms:.0f} ms to import, over its {limit_ms:.0f} ms budget")
+        for heavy in forbidden:
+            if heavy in loaded:
+                problems.append(f"{module} loads {heavy} at import time")
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check the import time of the app modules against their budgets.")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiply every budget, for slower machines.")
+    parser.add_argument("--repeat", type=int, default=3, help="Imports per module, the fastest one is kept.")
+    args = parser.parse_args(argv)
+
+    problems = check(args.scale, args.repeat)
+    for problem in problems:
+        print(problem)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,186 @@
+'''
+ingest.py
+This file declares the schema of every source table and loads the data through typed Parquet files.
+The CSV exports are read once with these explicit types (no sniffing), written as Parquet under
+data/parquet, and the database tables are created and filled from the Parquet files afterwards.
+A manifest keeps the size and modification time of each CSV, so only changed exports are converted.
+'''
+import json
+import os
+import shutil
+
+PARQUET_DIR = "data/parquet"
+MANIFEST_PATH = os.path.join(PARQUET_DIR, "_manifest.json")
+
+# id of a new request, numbered after the highest id loaded from the exports
+REQUEST_ID_SQL = "printf('REQ%05d', nextval('request_id_seq'))"
+
+# table -> source CSV, typed columns, the optional Parquet partition expression and the optional
+# column the table is stored in the order of, so its min/max zone maps prune range filters
+SCHEMAS = {
+    "requests": {
+        "csv": "data/data_requests.csv",
+        "columns": {
+            "id_request": "VARCHAR",
+            "customer_id": "BIGINT",
+            "request_date": "DATE",
+            "requested_standard": "VARCHAR",
+            "requested_supplier_site_id": "BIGINT",
+            "requested_audit_id": "VARCHAR",
+            "audit_scope": "VARCHAR",
+            "contact_information": "VARCHAR",
+            "quality_officer_id": "BIGINT",
+        },
+        "partition": ("request_month", "strftime(request_date, '%Y-%m')"),
+        "cluster": "request_date",
+    },
+    "suppliers": {
+        "csv": "data/suppliers.csv",
+        "columns": {
+            "supplier_site_id": "BIGINT",
+            "supplier_site_name": "VARCHAR",
+            "supplier_site_country": "VARCHAR",
+            "supplier_site_address": "VARCHAR",
+            "supplier_site_availability": "BOOLEAN",
+        },
+    },
+    "blacklist": {
+        "csv": "data/supplier_blacklist.csv",
+        "columns": {
+            "supplier_site_id": "BIGINT",
+            "blacklist_since": "DATE",
+            "blacklist_until": "DATE",
+        },
+    },
+    "credits": {
+        "csv": "data/credits.csv",
+        "columns": {
+            "credit_id": "VARCHAR",
+            "customer_id": "BIGINT",
+            "credit_state": "VARCHAR",
+            "reserved_date": "DATE",
+            "consumed_date": "DATE",
+            "id_request": "VARCHAR",
+        },
+    },
+    "quality_officers": {
+        "csv": "data/quality_officers.csv",
+        "columns": {
+            "quality_officer_id": "BIGINT",
+            "quality_officer_name": "VARCHAR",
+        },
+    },
+}
+
+
+def _columns_sql(table):
+    return ", ".join(SCHEMAS[table]["columns"].keys())
+
+
+def _parquet_glob(table):
+    """Glob of the Parquet files of a table, partitioned tables have one directory per partition."""
+    if "partition" in SCHEMAS[table]:
+        return os.path.join(PARQUET_DIR, table, "*", "*.parquet")
+    return os.path.join(PARQUET_DIR, table, "*.parquet")
+
+
+def _order_sql(table):
+    cluster = SCHEMAS[table].get("cluster")
+    return f"ORDER BY {cluster}" if cluster else ""
+
+
+def _source_signature(table):
+    stat = os.stat(SCHEMAS[table]["csv"])
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def _read_manifest():
+    try:
+        with open(MANIFEST_PATH) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _write_manifest(manifest):
+    with open(MANIFEST_PATH, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def convert_table(duckdb_conn, table):
+    """Convert the CSV export of a table to Parquet using its declared column types."""
+    schema = SCHEMAS[table]
+    columns = ", ".join(f"'{name}': '{column_type}'" for name, column_type in schema["columns"].items())
+    source = f"""
+        SELECT {_columns_sql(table)}
+        FROM read_csv(
+            '{schema["csv"]}',
+            header = true, delim = ',', quote = '"', escape = '"',
+            auto_detect = false, columns = {{{columns}}}
+        )
+    """
+    target = os.path.join(PARQUET_DIR, table)
+
+    if "partition" in schema:
+        partition_name, partition_expression = schema["partition"]
+        duckdb_conn.execute(f"""
+            COPY (SELECT *, {partition_expression} AS {partition_name} FROM ({source}))
+            TO '{target}' (FORMAT parquet, PARTITION_BY ({partition_name}), OVERWRITE_OR_IGNORE true)
+        """)
+    else:
+        os.makedirs(target, exist_ok=True)
+        duckdb_conn.execute(f"COPY ({source}) TO '{os.path.join(target, 'data.parquet')}' (FORMAT parquet)")
+
+
+def convert_changed_tables(duckdb_conn, force=False):
+    """Convert the CSV exports that changed since the last conversion. Returns the list of converted tables."""
+    os.makedirs(PARQUET_DIR, exist_ok=True)
+    manifest = _read_manifest()
+    converted = []
+    for table in SCHEMAS:
+        signature = _source_signature(table)
+        if not force and manifest.get(table) == signature:
+            continue
+        if "partition" in SCHEMAS[table]:
+            # drop old partitions so rows removed from the export do not linger
+            shutil.rmtree(os.path.join(PARQUET_DIR, table), ignore_errors=True)
+        convert_table(duckdb_conn, table)
+        manifest[table] = signature
+        converted.append(table)
+    _write_manifest(manifest)
+    return converted
+
+
+def create_table(duckdb_conn, table):
+    """Create a table with its declared column types and load it from Parquet, in the order of its cluster column."""
+    columns = ", ".join(f"{name} {column_type}" for name, column_type in SCHEMAS[table]["columns"].items())
+    duckdb_conn.execute(f"CREATE TABLE IF NOT EXISTS {table} ({columns})")
+    duckdb_conn.execute(f"""
+        INSERT INTO {table}
+        SELECT {_columns_sql(table)} FROM read_parquet('{_parquet_glob(table)}', hive_partitioning = false)
+        {_order_sql(table)}
+    """)
+
+
+def append_new_requests(duckdb_conn):
+    """Append the requests of the Parquet export that are not loaded yet. Returns the number of new rows, -1 on error."""
+    try:
+        return duckdb_conn.execute(f"""
+            INSERT INTO requests ({_columns_sql('requests')})
+            SELECT {_columns_sql('requests')}
+            FROM read_parquet('{_parquet_glob('requests')}', hive_partitioning = false) p
+            WHERE p.id_request IS NOT NULL
+            AND NOT EXISTS (SELECT 1 FROM requests r WHERE r.id_request = p.id_request)
+            {_order_sql('requests')}
+        """).fetchone()[0]
+    except Exception as e:
+        print(f"Error appending new requests: {e}")
+        return -1
+
+
+def setup_request_ids(duckdb_conn):
+    """Create the sequence that numbers new requests after the highest loaded id."""
+    start = duckdb_conn.execute("""
+        SELECT COALESCE(max(try_cast(regexp_extract(id_request, '[0-9]+$') AS BIGINT)), 0) + 1 FROM requests
+    """).fetchone()[0]
+    duckdb_conn.execute(f"CREATE SEQUENCE IF NOT EXISTS request_id_seq START {int(start)}")
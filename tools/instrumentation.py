@@ -0,0 +1,474 @@
+'''
+instrumentation.py
+This file records how long every database query takes, how many rows it returns and which function
+ran it, plus the duration of named sections of the app such as Prophet fits or pandas conversions.
+The connection manager hands out InstrumentedConnection proxies, so every helper is measured without
+changing it. A query is timed from execute() to the end of the fetch that reads its result, because
+DuckDB streams some results and only runs them while they are fetched. Queries slower than the slow
+threshold are kept in a log, with their EXPLAIN ANALYZE plan when plan capture is on.
+The metrics live in memory per process and are exported in the Prometheus text format, served over
+HTTP when QDB_METRICS_PORT is set and written to QDB_METRICS_FILE every QDB_METRICS_INTERVAL seconds.
+
+Usage:
+    QDB_METRICS_PORT=9464 uv run streamlit run main.py
+    QDB_SLOW_QUERY_MS=200 QDB_EXPLAIN_SLOW=1 uv run streamlit run main.py
+'''
+import collections
+import contextlib
+import http.server
+import os
+import re
+import sys
+import threading
+import time
+
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float("inf"))
+# distinct (caller, query) series, later ones are counted under the query "other"
+MAX_SERIES = 500
+MAX_SLOW_QUERIES = 50
+QUERY_LABEL_LENGTH = 200
+
+# modules whose frames are skipped when looking for the function that ran a query
+_PLUMBING_MODULES = {__name__, "tools.results", "tools.connections", "contextlib"}
+# statements that can be run again under EXPLAIN ANALYZE without side effects
+_READ_ONLY = ("SELECT", "WITH", "FROM", "VALUES", "TABLE")
+
+SlowQuery = collections.namedtuple("SlowQuery", ["at", "caller", "query", "seconds", "rows", "plan"])
+
+
+def _env_float(name, default):
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        print(f"Error: {name} must be a number, using {default}")
+        return default
+
+
+slow_query_seconds = _env_float("QDB_SLOW_QUERY_MS", 500) / 1000
+explain_slow_queries = os.environ.get("QDB_EXPLAIN_SLOW") == "1"
+
+
+class Histogram:
+    """Per-bucket counts, sum and maximum of observed durations. Buckets are made cumulative on export."""
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """Estimate a quantile as the upper bound of the bucket holding it. Returns 0 without observations."""
+        if not self.count:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class QueryStats:
+    """Everything recorded for one (caller, query) series."""
+
+    def __init__(self):
+        self.duration = Histogram()
+        self.fetch_seconds = 0.0
+        self.rows = 0
+        self.errors = 0
+
+
+_lock = threading.Lock()
+_queries = {}
+_sections = collections.defaultdict(Histogram)
+_slow = collections.deque(maxlen=MAX_SLOW_QUERIES)
+_started_at = time.time()
+
+_LITERALS = [
+    (re.compile(r"'(?:[^']|'')*'"), "?"),
+    (re.compile(r"\b[0-9a-f]{32}\b"), "*"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r"\s+"), " "),
+]
+
+
+def normalize_query(query):
+    """Replace literals and generated names with placeholders, so repeated queries share one series."""
+    for pattern, replacement in _LITERALS:
+        query = pattern.sub(replacement, query)
+    return query.strip()[:QUERY_LABEL_LENGTH]
+
+
+def _caller():
+    """Name the function outside the database plumbing that ran the current query."""
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_globals.get("__name__") in _PLUMBING_MODULES:
+        frame = frame.f_back
+    if frame is None:
+        return "unknown"
+    module = frame.f_globals.get("__name__", "")
+    if module == "__main__":
+        # Streamlit runs pages as __main__, name them after their file
+        module = os.path.splitext(os.path.basename(frame.f_code.co_filename))[0]
+    return f"{module}.{frame.f_code.co_name}"
+
+
+def _series(caller, query):
+    key = (caller, query)
+    stats = _queries.get(key)
+    if stats is None:
+        if len(_queries) >= MAX_SERIES:
+            key = (caller, "other")
+            stats = _queries.get(key)
+        if stats is None:
+            stats = _queries[key] = QueryStats()
+    return stats
+
+
+def record_query(caller, query, seconds, fetch_seconds=0.0, rows=None, error=False):
+    """Add one query run to the metrics of its series."""
+    with _lock:
+        stats = _series(caller, query)
+        stats.duration.observe(seconds)
+        stats.fetch_seconds += fetch_seconds
+        stats.rows += rows or 0
+        stats.errors += int(error)
+
+
+def record_section(name, seconds):
+    """Add one run of a named section to the metrics."""
+    with _lock:
+        _sections[name].observe(seconds)
+
+
+@contextlib.contextmanager
+def timed(name):
+    """Time the block as a section, whether it succeeds or raises."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_section(name, time.perf_counter() - started)
+
+
+def reset():
+    """Forget every recorded metric and slow query."""
+    global _started_at
+    with _lock:
+        _queries.clear()
+        _sections.clear()
+        _slow.clear()
+        _started_at = time.time()
+
+
+class _Pending:
+    __slots__ = ("caller", "query", "params", "started", "executed")
+
+    def __init__(self, caller, query, params, started, executed):
+        self.caller = caller
+        self.query = query
+        self.params = params
+        self.started = started
+        self.executed = executed
+
+
+class InstrumentedConnection:
+    """DuckDB connection or cursor that records every query run through execute().
+    Attributes other than execute and the fetch methods are passed to the wrapped connection,
+    so relations from sql() and registered views work but are not timed."""
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._pending = None
+
+    def execute(self, query, parameters=None):
+        self.flush()
+        caller = _caller()
+        started = time.perf_counter()
+        try:
+            if parameters is None:
+                self._conn.execute(query)
+            else:
+                self._conn.execute(query, parameters)
+        except Exception:
+            record_query(caller, normalize_query(query), time.perf_counter() - started, error=True)
+            raise
+        self._pending = _Pending(caller, query, parameters, started, time.perf_counter())
+        return self
+
+    def executemany(self, query, parameters=None):
+        self.flush()
+        caller = _caller()
+        started = time.perf_counter()
+        try:
+            self._conn.executemany(query, parameters or [])
+        except Exception:
+            record_query(caller, normalize_query(query), time.perf_counter() - started, error=True)
+            raise
+        record_query(caller, normalize_query(query), time.perf_counter() - started)
+        return self
+
+    def flush(self):
+        """Record the last statement if its result was never fetched, such as DDL or an INSERT."""
+        pending, self._pending = self._pending, None
+        if pending is not None:
+            record_query(pending.caller, normalize_query(pending.query), pending.executed - pending.started)
+
+    def _fetched(self, fetch_started, rows, explain=True):
+        pending, self._pending = self._pending, None
+        if pending is None:
+            return
+        now = time.perf_counter()
+        seconds = now - pending.started
+        query = normalize_query(pending.query)
+        record_query(pending.caller, query, seconds, now - fetch_started, rows)
+        if seconds >= slow_query_seconds:
+            plan = self._explain(pending) if explain and explain_slow_queries else None
+            with _lock:
+                _slow.append(SlowQuery(time.time(), pending.caller, query, seconds, rows, plan))
+
+    def _explain(self, pending):
+        """Run a slow read-only query again under EXPLAIN ANALYZE. Returns the plan text, or None."""
+        if not pending.query.lstrip().lstrip("(").upper().startswith(_READ_ONLY):
+            return None
+        try:
+            explain = "EXPLAIN ANALYZE " + pending.query
+            if pending.params is None:
+                rows = self._conn.execute(explain).fetchall()
+            else:
+                rows = self._conn.execute(explain, pending.params).fetchall()
+            return "\n".join(row[1] for row in rows)
+        except Exception as e:
+            print(f"Error explaining slow query: {e}")
+            return None
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = self._conn.fetchone()
+        self._fetched(started, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=1):
+        started = time.perf_counter()
+        rows = self._conn.fetchmany(size)
+        self._fetched(started, len(rows))
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = self._conn.fetchall()
+        self._fetched(started, len(rows))
+        return rows
+
+    def df(self, *args, **kwargs):
+        started = time.perf_counter()
+        frame = self._conn.df(*args, **kwargs)
+        self._fetched(started, len(frame))
+        return frame
+
+    fetchdf = df
+
+    def fetchnumpy(self):
+        started = time.perf_counter()
+        arrays = self._conn.fetchnumpy()
+        self._fetched(started, len(next(iter(arrays.values()), [])))
+        return arrays
+
+    def fetch_arrow_table(self, *args, **kwargs):
+        started = time.perf_counter()
+        table = self._conn.fetch_arrow_table(*args, **kwargs)
+        self._fetched(started, table.num_rows)
+        return table
+
+    def fetch_record_batch(self, *args, **kwargs):
+        # the rows are produced while the reader is consumed, only the start of the stream is timed,
+        # and the query is not explained again since that would close the stream
+        started = time.perf_counter()
+        reader = self._conn.fetch_record_batch(*args, **kwargs)
+        self._fetched(started, None, explain=False)
+        return reader
+
+    def cursor(self):
+        return InstrumentedConnection(self._conn.cursor())
+
+    def close(self):
+        self.flush()
+        self._conn.close()
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def query_stats():
+    """Get one row per (caller, query) series, the slowest in total first."""
+    with _lock:
+        rows = [
+            {
+                "caller": caller,
+                "query": query,
+                "calls": stats.duration.count,
+                "errors": stats.errors,
+                "total_s": stats.duration.total,
+                "mean_ms": 1000 * stats.duration.total / stats.duration.count if stats.duration.count else 0.0,
+                "p95_ms": 1000 * stats.duration.quantile(0.95),
+                "max_ms": 1000 * stats.duration.max,
+                "fetch_s": stats.fetch_seconds,
+                "rows": stats.rows,
+            }
+            for (caller, query), stats in _queries.items()
+        ]
+    return sorted(rows, key=lambda row: row["total_s"], reverse=True)
+
+
+def section_stats():
+    """Get one row per timed section, the slowest in total first."""
+    with _lock:
+        rows = [
+            {
+                "section": name,
+                "calls": histogram.count,
+                "total_s": histogram.total,
+                "mean_ms": 1000 * histogram.total / histogram.count if histogram.count else 0.0,
+                "p95_ms": 1000 * histogram.quantile(0.95),
+                "max_ms": 1000 * histogram.max,
+            }
+            for name, histogram in _sections.items()
+        ]
+    return sorted(rows, key=lambda row: row["total_s"], reverse=True)
+
+
+def slow_queries():
+    """Get the last slow queries, the most recent first."""
+    with _lock:
+        return list(reversed(_slow))
+
+
+def _label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(**labels):
+    return ",".join(f'{name}="{_label(value)}"' for name, value in labels.items())
+
+
+def _histogram_lines(metric, labels, histogram):
+    lines, cumulative = [], 0
+    for bound, count in zip(BUCKETS, histogram.counts):
+        cumulative += count
+        le = "+Inf" if bound == float("inf") else repr(bound)
+        lines.append(f"{metric}_bucket{{{labels},le=\"{le}\"}} {cumulative}")
+    lines.append(f"{metric}_sum{{{labels}}} {histogram.total}")
+    lines.append(f"{metric}_count{{{labels}}} {histogram.count}")
+    return lines
+
+
+def prometheus_text():
+    """Render every metric in the Prometheus text exposition format."""
+    lines = []
+    with _lock:
+        queries = list(_queries.items())
+        sections = list(_sections.items())
+
+        lines += [
+            "# HELP qdb_query_duration_seconds Time from execute to the end of the fetch of a query.",
+            "# TYPE qdb_query_duration_seconds histogram",
+        ]
+        for (caller, query), stats in queries:
+            lines += _histogram_lines("qdb_query_duration_seconds", _labels(caller=caller, query=query), stats.duration)
+
+        for metric, kind, help_text, attribute in [
+            ("qdb_query_fetch_seconds_total", "counter", "Time spent in fetch calls, converting or streaming results.", "fetch_seconds"),
+            ("qdb_query_rows_total", "counter", "Rows fetched from query results.", "rows"),
+            ("qdb_query_errors_total", "counter", "Queries that raised an error.", "errors"),
+        ]:
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} {kind}"]
+            for (caller, query), stats in queries:
+                lines.append(f"{metric}{{{_labels(caller=caller, query=query)}}} {getattr(stats, attribute)}")
+
+        lines += [
+            "# HELP qdb_section_duration_seconds Time spent in named sections of the app.",
+            "# TYPE qdb_section_duration_seconds histogram",
+        ]
+        for name, histogram in sections:
+            lines += _histogram_lines("qdb_section_duration_seconds", _labels(section=name), histogram)
+
+        lines += [
+            "# HELP qdb_slow_queries Slow queries kept in the log.",
+            "# TYPE qdb_slow_queries gauge",
+            f"qdb_slow_queries {len(_slow)}",
+            "# HELP qdb_metrics_start_time_seconds When the metrics were last reset.",
+            "# TYPE qdb_metrics_start_time_seconds gauge",
+            f"qdb_metrics_start_time_seconds {_started_at}",
+        ]
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus_file(path):
+    """Write the metrics to path atomically, for a node exporter textfile collector."""
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as f:
+        f.write(prometheus_text())
+    os.replace(temporary, path)
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_exporters_started = False
+
+
+def start_exporters():
+    """Start the HTTP endpoint and the file writer configured in the environment, once per process."""
+    global _exporters_started
+    with _lock:
+        if _exporters_started:
+            return
+        _exporters_started = True
+
+    port = os.environ.get("QDB_METRICS_PORT")
+    if port:
+        try:
+            server = http.server.ThreadingHTTPServer(("", int(port)), _MetricsHandler)
+            threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+            print(f"Serving metrics on port {port} at /metrics")
+        except (OSError, ValueError) as e:
+            print(f"Error starting metrics endpoint: {e}")
+
+    path = os.environ.get("QDB_METRICS_FILE")
+    if path:
+        interval = _env_float("QDB_METRICS_INTERVAL", 15)
+
+        def write_forever():
+            while True:
+                try:
+                    write_prometheus_file(path)
+                except OSError as e:
+                    print(f"Error writing metrics file: {e}")
+                time.sleep(interval)
+
+        threading.Thread(target=write_forever, name="metrics-file", daemon=True).start()
@@ -0,0 +1,51 @@
+'''
+kpis.py
+This file keeps the daily rollup the dashboard tiles are read from.
+kpi_daily holds one row per request date, standard, supplier country and credit state with the
+request count and the resolution time of the requests in it, built from fact_request and its archived
+months in one scan. Its size grows with the number of days, not with the number of requests, and only
+the days touched by a fact refresh are recomputed. It is stored in request_date order, so the windowed
+tiles only read the row groups of their last days.
+'''
+
+ROLLUP_SELECT = """
+    SELECT
+        f.request_date,
+        f.requested_standard,
+        s.supplier_site_country,
+        f.credit_state,
+        count(*) AS total_requests,
+        count(f.consumed_date - f.reserved_date) AS resolved_requests,
+        COALESCE(sum(f.consumed_date - f.reserved_date), 0) AS resolution_days
+    FROM fact_request_all f
+    LEFT JOIN dim_supplier_site s ON s.supplier_site_key = f.supplier_site_key
+    {where}
+    GROUP BY ALL
+"""
+
+
+def rebuild_rollups(duckdb_conn):
+    """Rebuild kpi_daily from the whole fact_request table and its archived months."""
+    duckdb_conn.execute(f"""
+        CREATE OR REPLACE TABLE kpi_daily AS
+        SELECT * FROM ({ROLLUP_SELECT.format(where='')}) ORDER BY request_date
+    """)
+
+
+def rollup_days_query(days_table):
+    """Build the kpi_daily select of the request dates listed in days_table (request_date)."""
+    return ROLLUP_SELECT.format(where=_day_filter(days_table, "f."))
+
+
+def _day_filter(days_table, alias):
+    return f"""
+        WHERE EXISTS (
+            SELECT 1 FROM {days_table} d WHERE d.request_date IS NOT DISTINCT FROM {alias}request_date
+        )
+    """
+
+
+def refresh_rollup_days(duckdb_conn, days_table):
+    """Recompute the kpi_daily rows of the request dates listed in days_table (request_date)."""
+    duckdb_conn.execute(f"DELETE FROM kpi_daily k {_day_filter(days_table, 'k.')}")
+    duckdb_conn.execute(f"INSERT INTO kpi_daily {rollup_days_query(days_table)}")
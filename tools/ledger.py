@@ -0,0 +1,247 @@
+'''
+ledger.py
+This file moves credits between the available, reserved and consumed states.
+The credit_balances table keeps the number of credits per customer and state, so balance checks
+are a primary key lookup instead of a count over credits. A reservation first decrements the
+available balance with a single compare-and-update (it only matches when enough credits are left)
+and then assigns that many available credits to the request, all in one transaction. Two
+concurrent reservations for the same customer update the same balance row, so DuckDB rejects one
+of them with a conflict instead of letting both spend the same credits.
+Every write also adds the requests whose credits it moved to credit_changes, in the same transaction,
+so tools.facts refreshes exactly those requests instead of comparing the whole credits table.
+'''
+import collections
+import random
+import time
+
+import duckdb
+
+import tools.event_log as event_log
+
+# GMP = 1 credit, GVP = 2 credits, GCP = 3 credits
+REQUIRED_CREDITS = {"GMP": 1, "GVP": 2, "GCP": 3}
+
+# attempts of a reservation that lost a write conflict against a concurrent one
+RESERVE_ATTEMPTS = 5
+
+
+def setup_credit_changes(duckdb_conn):
+    """Create the log of requests whose credits changed, drained by the FACT_REQUESTS refresh."""
+    duckdb_conn.execute("CREATE TABLE IF NOT EXISTS credit_changes (id_request VARCHAR)")
+
+
+def rebuild_balances(duckdb_conn):
+    """Recompute credit_balances from the credits table."""
+    setup_credit_changes(duckdb_conn)
+    duckdb_conn.execute("""
+        CREATE TABLE IF NOT EXISTS credit_balances (
+            customer_id BIGINT PRIMARY KEY,
+            available BIGINT NOT NULL,
+            reserved BIGINT NOT NULL,
+            consumed BIGINT NOT NULL
+        )
+    """)
+    duckdb_conn.execute("DELETE FROM credit_balances")
+    duckdb_conn.execute("""
+        INSERT INTO credit_balances
+        SELECT
+            customer_id,
+            count(*) FILTER (WHERE credit_state = 'available'),
+            count(*) FILTER (WHERE credit_state = 'reserved'),
+            count(*) FILTER (WHERE credit_state = 'consumed')
+        FROM credits
+        WHERE customer_id IS NOT NULL
+        GROUP BY customer_id
+    """)
+
+
+def get_available_credits(duckdb_conn, customer_id):
+    """Get the available balance of a customer. Returns 0 if the customer has no credits."""
+    row = duckdb_conn.execute(
+        "SELECT available FROM credit_balances WHERE customer_id = ?", [int(customer_id)]
+    ).fetchone()
+    return int(row[0]) if row else 0
+
+
+def reserve(duckdb_conn, customer_id, id_request, credits):
+    """Reserve credits for a request inside the caller's transaction. Returns False if the balance is too low."""
+    taken = duckdb_conn.execute("""
+        UPDATE credit_balances
+        SET available = available - ?, reserved = reserved + ?
+        WHERE customer_id = ? AND available >= ?
+        RETURNING customer_id
+    """, [credits, credits, int(customer_id), credits]).fetchall()
+    if not taken:
+        return False
+
+    reserved = duckdb_conn.execute("""
+        UPDATE credits
+        SET credit_state = 'reserved', reserved_date = current_date, id_request = ?
+        WHERE credit_id IN (
+            SELECT credit_id
+            FROM credits
+            WHERE customer_id = ? AND credit_state = 'available'
+            ORDER BY credit_id
+            LIMIT ?
+        )
+    """, [id_request, int(customer_id), credits]).fetchone()[0]
+    if reserved != credits:
+        raise RuntimeError(f"credit_balances is out of sync for customer {customer_id}")
+    duckdb_conn.execute("INSERT INTO credit_changes VALUES (?)", [id_request])
+    return True
+
+
+def reserve_for_requests(duckdb_conn, requests_table):
+    """Reserve credits for every row of requests_table (row_id, customer_id, id_request, required_credits)
+    inside the caller's transaction. Credits are assigned in row_id order. Returns False if any balance is too low."""
+    needed = duckdb_conn.execute(f"""
+        SELECT count(DISTINCT customer_id), COALESCE(sum(required_credits), 0) FROM {requests_table}
+    """).fetchone()
+    customers, credits = int(needed[0]), int(needed[1])
+    if credits == 0:
+        return True
+
+    taken = duckdb_conn.execute(f"""
+        UPDATE credit_balances b
+        SET available = b.available - n.credits, reserved = b.reserved + n.credits
+        FROM (
+            SELECT customer_id, sum(required_credits) AS credits
+            FROM {requests_table}
+            GROUP BY customer_id
+        ) n
+        WHERE b.customer_id = n.customer_id AND b.available >= n.credits
+    """).fetchone()[0]
+    if taken != customers:
+        return False
+
+    # the n-th credit slot of a customer takes its n-th available credit
+    reserved = duckdb_conn.execute(f"""
+        UPDATE credits
+        SET credit_state = 'reserved', reserved_date = current_date, id_request = assigned.id_request
+        FROM (
+            SELECT free.credit_id, slots.id_request
+            FROM (
+                SELECT
+                    customer_id,
+                    id_request,
+                    row_number() OVER (PARTITION BY customer_id ORDER BY row_id, slot) AS slot_rank
+                FROM (
+                    SELECT customer_id, id_request, row_id, unnest(range(required_credits)) AS slot
+                    FROM {requests_table}
+                )
+            ) slots
+            JOIN (
+                SELECT
+                    credit_id,
+                    customer_id,
+                    row_number() OVER (PARTITION BY customer_id ORDER BY credit_id) AS credit_rank
+                FROM credits
+                WHERE credit_state = 'available'
+                AND customer_id IN (SELECT customer_id FROM {requests_table})
+            ) free
+                ON free.customer_id = slots.customer_id AND free.credit_rank = slots.slot_rank
+        ) assigned
+        WHERE credits.credit_id = assigned.credit_id
+    """).fetchone()[0]
+    if reserved != credits:
+        raise RuntimeError("credit_balances is out of sync with credits")
+    duckdb_conn.execute(f"INSERT INTO credit_changes SELECT DISTINCT id_request FROM {requests_table} WHERE required_credits > 0")
+    return True
+
+
+def _rollback(duckdb_conn):
+    try:
+        duckdb_conn.rollback()
+    except duckdb.TransactionException:
+        pass
+
+
+def reserve_credits(duckdb_conn, customer_id, id_request, credits):
+    """Reserve credits for a request in its own transaction, retrying lost write conflicts.
+    Returns True on success, False if the balance is too low or on error."""
+    for attempt in range(RESERVE_ATTEMPTS):
+        in_transaction = False
+        try:
+            duckdb_conn.begin()
+            in_transaction = True
+            if not reserve(duckdb_conn, customer_id, id_request, credits):
+                duckdb_conn.rollback()
+                return False
+            duckdb_conn.commit()
+        except duckdb.TransactionException:
+            # a conflict found at commit time has already ended the transaction
+            if in_transaction:
+                _rollback(duckdb_conn)
+            time.sleep(random.uniform(0, 0.002 * 2 ** attempt))
+            continue
+        except Exception as e:
+            print(f"Error reserving credits: {e}")
+            if in_transaction:
+                duckdb_conn.rollback()
+            return False
+
+        # the credits are reserved, a failure to record the event does not undo that
+        try:
+            event_log.record(event_log.RESERVED, id_request, customer_id, source="ledger")
+        except Exception as e:
+            print(f"Error recording the {event_log.RESERVED} event of request {id_request}: {e}")
+        return True
+    print(f"Error reserving credits: conflict persisted after {RESERVE_ATTEMPTS} attempts")
+    return False
+
+
+def _move_request_credits(duckdb_conn, id_request, assignments, balance_changes, event):
+    """Move the reserved credits of a request to another state, update the balances and record the event.
+    Returns the number of moved credits, -1 on error."""
+    in_transaction = False
+    try:
+        duckdb_conn.begin()
+        in_transaction = True
+        moved = duckdb_conn.execute(f"""
+            UPDATE credits
+            SET {assignments}
+            WHERE id_request = ? AND credit_state = 'reserved'
+            RETURNING customer_id
+        """, [id_request]).fetchall()
+        for customer_id, count in collections.Counter(row[0] for row in moved).items():
+            duckdb_conn.execute(
+                f"UPDATE credit_balances SET {balance_changes} WHERE customer_id = ?", [count, count, customer_id]
+            )
+        if moved:
+            duckdb_conn.execute("INSERT INTO credit_changes VALUES (?)", [id_request])
+        duckdb_conn.commit()
+    except Exception as e:
+        print(f"Error moving credits of request {id_request}: {e}")
+        if in_transaction:
+            duckdb_conn.rollback()
+        return -1
+
+    # the credits are moved, a failure to record the event does not undo that
+    if moved:
+        try:
+            event_log.record(event, id_request, moved[0][0], source="ledger")
+        except Exception as e:
+            print(f"Error recording the {event} event of request {id_request}: {e}")
+    return len(moved)
+
+
+def release_credits(duckdb_conn, id_request):
+    """Give the reserved credits of a request back to the customer. Returns the number of released credits, -1 on error."""
+    return _move_request_credits(
+        duckdb_conn,
+        id_request,
+        "credit_state = 'available', reserved_date = NULL, id_request = NULL",
+        "reserved = reserved - ?, available = available + ?",
+        event_log.RELEASED,
+    )
+
+
+def consume_credits(duckdb_conn, id_request):
+    """Mark the reserved credits of a request as consumed. Returns the number of consumed credits, -1 on error."""
+    return _move_request_credits(
+        duckdb_conn,
+        id_request,
+        "credit_state = 'consumed', consumed_date = current_date",
+        "reserved = reserved - ?, consumed = consumed + ?",
+        event_log.CONSUMED,
+    )
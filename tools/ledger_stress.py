@@ -0,0 +1,108 @@
+'''
+ledger_stress.py
+This file is a concurrency harness for the credit ledger.
+It fills an in-memory database with a few customers and credits, lets many threads reserve
+credits at the same time through their own cursors, and then checks that no credit was spent
+twice: every successful reservation owns exactly the credits it asked for, no customer went
+below zero and credit_balances matches the credits table.
+
+Usage:
+    python -m tools.ledger_stress --threads 16 --reservations 200
+'''
+import argparse
+import random
+import sys
+import threading
+
+import duckdb
+
+import tools.ledger as ledger
+
+
+def _setup(conn, customers, credits_per_customer):
+    conn.execute("""
+        CREATE TABLE credits (
+            credit_id VARCHAR, customer_id BIGINT, credit_state VARCHAR,
+            reserved_date DATE, consumed_date DATE, id_request VARCHAR
+        )
+    """)
+    conn.execute("""
+        INSERT INTO credits
+        SELECT printf('C%d-%05d', c, n), c, 'available', NULL, NULL, NULL
+        FROM range(1, ? + 1) t1(c), range(?) t2(n)
+    """, [customers, credits_per_customer])
+    ledger.rebuild_balances(conn)
+
+
+def _worker(conn, worker_id, reservations, customers, successes, lock):
+    cursor = conn.cursor()
+    rng = random.Random(worker_id)
+    for n in range(reservations):
+        customer_id = rng.randint(1, customers)
+        credits = rng.choice(list(ledger.REQUIRED_CREDITS.values()))
+        id_request = f"W{worker_id}-{n}"
+        if ledger.reserve_credits(cursor, customer_id, id_request, credits):
+            with lock:
+                successes[id_request] = (customer_id, credits)
+    cursor.close()
+
+
+def check(conn, successes, credits_per_customer):
+    """Check the ledger invariants after the run. Returns the list of violations."""
+    problems = []
+    owned = dict(((id_request, customer_id), count) for id_request, customer_id, count in conn.execute("""
+        SELECT id_request, customer_id, count(*) FROM credits WHERE credit_state = 'reserved' GROUP BY ALL
+    """).fetchall())
+    for id_request, (customer_id, credits) in successes.items():
+        if owned.pop((id_request, customer_id), 0) != credits:
+            problems.append(f"{id_request} does not own exactly {credits} credits of customer {customer_id}")
+    problems.extend(f"{id_request} owns credits but its reservation failed" for id_request, _ in owned)
+
+    mismatched = conn.execute("""
+        SELECT b.customer_id
+        FROM credit_balances b
+        JOIN (
+            SELECT customer_id,
+                count(*) FILTER (WHERE credit_state = 'available') AS available,
+                count(*) FILTER (WHERE credit_state = 'reserved') AS reserved
+            FROM credits GROUP BY customer_id
+        ) c USING (customer_id)
+        WHERE b.available <> c.available OR b.reserved <> c.reserved OR b.available < 0
+        OR b.available + b.reserved + b.consumed <> ?
+    """, [credits_per_customer]).fetchall()
+    problems.extend(f"customer {row[0]} balance does not match its credits" for row in mismatched)
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reserve credits from many threads and check for double spending.")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--reservations", type=int, default=200, help="Reservations attempted per thread.")
+    parser.add_argument("--customers", type=int, default=5)
+    parser.add_argument("--credits", type=int, default=300, help="Credits per customer.")
+    args = parser.parse_args(argv)
+
+    conn = duckdb.connect()
+    _setup(conn, args.customers, args.credits)
+
+    successes = {}
+    lock = threading.Lock()
+    workers = [
+        threading.Thread(target=_worker, args=(conn, n, args.reservations, args.customers, successes, lock))
+        for n in range(args.threads)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    problems = check(conn, successes, args.credits)
+    spent = sum(credits for _, credits in successes.values())
+    print(f"reservations={len(successes)} credits_spent={spent} of {args.customers * args.credits} violations={len(problems)}")
+    for problem in problems[:20]:
+        print(problem)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,166 @@
+'''
+partitions.py
+This file keeps the request tables partitioned by month and archives the closed months of a table.
+DuckDB keeps the min and max of every column for each row group of ROW_GROUP_ROWS rows and skips the
+row groups a filter rules out, so a table stored in request_date order reads only the months a
+windowed query asks for. Loads and rebuilds insert in that order, compact_table restores it after
+out of order appends.
+Archived months are moved out of the table into Hive-partitioned Parquet files, one directory per
+month under data/archive/<table>/request_month=YYYY-MM, sorted by request_date so the Parquet row
+group statistics prune them the same way. The files of every archived month are listed in
+archived_partitions, and the <table>_all view reads the table and these files together.
+Only fact_request is archived. requests is kept in date order with compact_table but stays whole, since
+the fact rebuild and restore, the ledger and the request ids read every request from it.
+'''
+import collections
+import datetime
+import os
+import uuid
+
+ARCHIVE_DIR = "data/archive"
+# rows of a DuckDB row group, the unit the min/max zone maps are kept for
+ROW_GROUP_ROWS = 122880
+
+Partition = collections.namedtuple("Partition", ["month", "rows", "row_groups", "min_date", "max_date", "archived"])
+
+
+def month_sql(column):
+    """Build the SQL expression of the partition (YYYY-MM) of a date column."""
+    return f"strftime({column}, '%Y-%m')"
+
+
+def archive_view(table):
+    """Get the name of the view reading a table together with its archived months."""
+    return f"{table}_all"
+
+
+def setup_archive(duckdb_conn):
+    """Create the table listing the Parquet files of the archived months."""
+    duckdb_conn.execute("""
+        CREATE TABLE IF NOT EXISTS archived_partitions (
+            table_name VARCHAR,
+            request_month VARCHAR,
+            path VARCHAR,
+            rows BIGINT,
+            row_groups BIGINT,
+            min_date DATE,
+            max_date DATE,
+            archived_at TIMESTAMP DEFAULT current_timestamp
+        )
+    """)
+
+
+def archived_months(duckdb_conn, table):
+    """Get the archived months of a table, oldest first. Returns an empty list on error."""
+    try:
+        rows = duckdb_conn.execute("""
+            SELECT DISTINCT request_month FROM archived_partitions WHERE table_name = ? ORDER BY request_month
+        """, [table]).fetchall()
+        return [row[0] for row in rows]
+    except Exception as e:
+        print(f"Error getting archived months: {e}")
+        return []
+
+
+def months_before(duckdb_conn, table, before, column="request_date"):
+    """Get the months of a table, in its current rows, older than before (YYYY-MM). Returns an empty list on error."""
+    try:
+        rows = duckdb_conn.execute(f"""
+            SELECT DISTINCT {month_sql(column)} AS month FROM {table}
+            WHERE {column} < ? ORDER BY month
+        """, [datetime.date.fromisoformat(f"{before}-01")]).fetchall()
+        return [row[0] for row in rows]
+    except Exception as e:
+        print(f"Error getting months before {before}: {e}")
+        return []
+
+
+def create_archive_view(duckdb_conn, table):
+    """Create or replace the view reading a table and the Parquet files of its archived months."""
+    paths = [row[0] for row in duckdb_conn.execute(
+        "SELECT path FROM archived_partitions WHERE table_name = ? ORDER BY request_month, archived_at", [table]
+    ).fetchall()]
+    query = f"SELECT * FROM {table}"
+    if paths:
+        files = ", ".join(f"'{path}'" for path in paths)
+        query += f" UNION ALL BY NAME SELECT * FROM read_parquet([{files}], hive_partitioning = false)"
+    duckdb_conn.execute(f"CREATE OR REPLACE VIEW {archive_view(table)} AS {query}")
+
+
+def archive_months(duckdb_conn, table, months, column="request_date"):
+    """Move the rows of the given months (YYYY-MM) out of a table into a new Parquet file per month.
+    A month archived before gets one more file, so rows added to it later are archived too.
+    Run it in a transaction: the rows are only deleted when the files were written. Returns the number of archived rows."""
+    archived = 0
+    for month in months:
+        start = datetime.date.fromisoformat(f"{month}-01")
+        end = (start + datetime.timedelta(days=32)).replace(day=1)
+        where = f"{column} >= DATE '{start}' AND {column} < DATE '{end}'"
+        rows = duckdb_conn.execute(f"SELECT count(*) FROM {table} WHERE {where}").fetchone()[0]
+        if not rows:
+            continue
+
+        directory = os.path.join(ARCHIVE_DIR, table, f"request_month={month}")
+        path = os.path.join(directory, f"{uuid.uuid4().hex}.parquet")
+        os.makedirs(directory, exist_ok=True)
+        duckdb_conn.execute(f"COPY (SELECT * FROM {table} WHERE {where} ORDER BY {column}) TO '{path}' (FORMAT parquet)")
+        duckdb_conn.execute(f"""
+            INSERT INTO archived_partitions (table_name, request_month, path, rows, row_groups, min_date, max_date)
+            SELECT ?, ?, ?, ?, (SELECT count(DISTINCT row_group_id) FROM parquet_metadata('{path}')), min({column}), max({column})
+            FROM {table} WHERE {where}
+        """, [table, month, path, rows])
+        duckdb_conn.execute(f"DELETE FROM {table} WHERE {where}")
+        archived += rows
+    create_archive_view(duckdb_conn, table)
+    return archived
+
+
+def unarchive_months(duckdb_conn, table, months):
+    """Forget the archived files of the given months, the caller loads their rows back into the table.
+    Returns the paths of the files, to delete with remove_files once the transaction is committed."""
+    if not months:
+        return []
+    placeholders = ", ".join("?" for _ in months)
+    paths = [row[0] for row in duckdb_conn.execute(f"""
+        DELETE FROM archived_partitions WHERE table_name = ? AND request_month IN ({placeholders}) RETURNING path
+    """, [table, *months]).fetchall()]
+    create_archive_view(duckdb_conn, table)
+    return paths
+
+
+def remove_files(paths):
+    """Delete archived files and the month directories they leave empty."""
+    for path in paths:
+        try:
+            os.remove(path)
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+
+
+def compact_table(duckdb_conn, table, column="request_date"):
+    """Rewrite a table in column order, so every month is stored in as few row groups as possible again.
+    The rowids of the table change once the transaction is committed."""
+    duckdb_conn.execute(f"CREATE OR REPLACE TABLE {table} AS SELECT * FROM {table} ORDER BY {column}")
+
+
+def partition_stats(duckdb_conn, table, column="request_date"):
+    """Get the rows, row groups and date range of every month of a table, archived months included. Returns an empty list on error."""
+    try:
+        # rowids are numbered by row group, a month spread over many row groups needs compaction
+        rows = duckdb_conn.execute(f"""
+            SELECT {month_sql(column)} AS month, count(*), count(DISTINCT rowid // {ROW_GROUP_ROWS}),
+                min({column}), max({column}), false
+            FROM {table}
+            GROUP BY month
+            UNION ALL
+            SELECT request_month, sum(rows), sum(row_groups), min(min_date), max(max_date), true
+            FROM archived_partitions
+            WHERE table_name = ?
+            GROUP BY request_month
+            ORDER BY 1 NULLS FIRST, 6
+        """, [table]).fetchall()
+        return [Partition(*row) for row in rows]
+    except Exception as e:
+        print(f"Error getting partitions of {table}: {e}")
+        return []
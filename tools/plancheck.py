@@ -0,0 +1,135 @@
+'''
+plancheck.py
+This file is the plan regression check of the fact queries.
+It generates a synthetic dataset with tools.synthetic in a scratch directory, sets the database up
+and asks DuckDB for the plan of every query that builds or reads the star schema: the fact build and
+refresh, the dimension keys, the FACT_REQUESTS view, the KPI rollups, the request browser, the quality
+officer assignment and the blacklist flag update. The check fails when a plan joins with anything
+else than a hash join, such as a nested loop join or a cross product. Join orders depend on table
+sizes, so run it on large data.
+
+Usage:
+    python -m tools.plancheck
+    python -m tools.plancheck --requests 1000000 --verbose
+'''
+import argparse
+import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import tools.browser as browser
+import tools.connections as connections
+import tools.facts as facts
+import tools.kpis as kpis
+import tools.qdb as qdb
+import tools.synthetic as synthetic
+import tools.validation as validation
+
+ALLOWED_JOINS = {"HASH_JOIN"}
+
+
+def fact_queries():
+    """Get the queries to check, as name: (query, parameters)."""
+    today = datetime.date.today()
+    filters = browser.RequestFilter(customer_id=1001, date_from=today - datetime.timedelta(days=90), date_to=today)
+    page_query, page_params = browser._ordered_query(filters, "request_date", True, after=(today, "REQ99999"))
+    count_where, count_params = browser._where(filters)
+    refresh_filter = "r.rowid > 0 OR r.id_request IN (SELECT id_request FROM fact_changed_requests)"
+
+    queries = {
+        "fact_build": (f"INSERT INTO fact_request {facts.fact_requests_query()}", None),
+        "fact_refresh": (f"INSERT INTO fact_request {facts.fact_requests_query(refresh_filter)}", None),
+        "fact_view": ("SELECT * FROM FACT_REQUESTS", None),
+        "kpi_rollup": (kpis.ROLLUP_SELECT.format(where=""), None),
+        "kpi_rollup_days": (kpis.rollup_days_query("fact_changed_days"), None),
+        "browser_page": (page_query, page_params),
+        "browser_count": (f"SELECT count(*) FROM FACT_REQUESTS WHERE {count_where}", count_params),
+        "quality_officer": (validation.QUALITY_OFFICER_QUERY, None),
+        "blacklist_flags": (facts.BLACKLIST_FLAG_UPDATE, [1]),
+    }
+    for dimension in facts.DIMENSIONS:
+        queries[f"keys_{dimension.table}"] = (facts.dimension_keys_query(dimension, refresh_filter), None)
+    return queries
+
+
+def _operators(node):
+    """Yield the operator names of a JSON plan tree."""
+    yield node.get("name", "").strip()
+    for child in node.get("children", []):
+        yield from _operators(child)
+
+
+def plan_operators(duckdb_conn, query, params=None):
+    """Get the operator names of the physical plan of a query."""
+    explain = f"EXPLAIN (FORMAT JSON) {query}"
+    rows = duckdb_conn.execute(explain, params).fetchall() if params else duckdb_conn.execute(explain).fetchall()
+    operators = []
+    for _, plan in rows:
+        for node in json.loads(plan):
+            operators.extend(_operators(node))
+    return operators
+
+
+def check_plans(duckdb_conn, verbose=False):
+    """Explain every fact query. Returns the list of queries joining with something else than hash joins."""
+    # the temporary tables the refresh queries read
+    duckdb_conn.execute("CREATE OR REPLACE TEMP TABLE fact_changed_requests AS SELECT id_request FROM credits LIMIT 1000")
+    duckdb_conn.execute("CREATE OR REPLACE TEMP TABLE fact_changed_days AS SELECT DISTINCT request_date FROM requests LIMIT 30")
+
+    problems = []
+    for name, (query, params) in fact_queries().items():
+        operators = plan_operators(duckdb_conn, query, params)
+        joins = [op for op in operators if "JOIN" in op or op == "CROSS_PRODUCT"]
+        bad = sorted(set(joins) - ALLOWED_JOINS)
+        print(f"{name}: {len(joins)} joins{', ' + ', '.join(bad) if bad else ''}")
+        if verbose:
+            print("    " + " > ".join(operators))
+        if bad:
+            problems.append(f"{name} plans {', '.join(bad)}")
+
+    duckdb_conn.execute("DROP TABLE fact_changed_requests")
+    duckdb_conn.execute("DROP TABLE fact_changed_days")
+    return problems
+
+
+def run(requests, skew=1.0, seed=0, workdir=None, verbose=False):
+    """Generate a dataset in workdir, the current directory, set the database up and check the plans. Returns the list of problems."""
+    synthetic.generate(workdir, requests, skew=skew, seed=seed)
+    manager = connections.ConnectionManager(connections.DEFAULT_DATABASE, pool_size=1, setup=qdb.setup_database)
+    try:
+        with manager.writer() as conn:
+            return check_plans(conn, verbose)
+    finally:
+        manager.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check that the fact queries plan as hash joins on synthetic data.")
+    parser.add_argument("--requests", type=int, default=200000)
+    parser.add_argument("--skew", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="Directory for the generated data and database, a temporary one by default.")
+    parser.add_argument("--verbose", action="store_true", help="Print the operators of every plan.")
+    args = parser.parse_args(argv)
+
+    workdir = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix="qualifyze-plans-")
+    os.makedirs(workdir, exist_ok=True)
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        problems = run(args.requests, args.skew, args.seed, workdir, args.verbose)
+    finally:
+        os.chdir(cwd)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    for problem in problems:
+        print(problem)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,168 +1,125 @@
 '''
 database.py
 This file create the database connection and load the data files as tables to be queried.
+The connection is opened lazily, so importing it does not open the database.
 '''
 import tools.utils as utils
-import streamlit as st
-
-duckdb_conn = utils.get_duckdb_conn()
-
+import tools.facts as facts
+import tools.blacklist as blacklist
+import tools.ingest as ingest
+import tools.ledger as ledger
+import tools.dimensions as dimensions
+import tools.bulk_jobs as bulk_jobs
+import tools.event_log as event_log
+import tools.instrumentation as instrumentation
+import tools.snapshots as snapshots
 
 def setup_database(duckdb_conn):
     """Set up the DuckDB database with necessary tables."""
 
-    # check if the tables exist, if not create them
+    # convert the CSV exports that changed to typed Parquet files
+    converted = ingest.convert_changed_tables(duckdb_conn)
+    if converted:
+        print(f"Converted to Parquet: {', '.join(converted)}")
+
+    # writes to suppliers, customers and quality officers are logged for the in-memory copies
+    dimensions.setup_changes(duckdb_conn)
+
+    # check if the tables exist, if not create them
     if not utils.check_table_exists(duckdb_conn, 'requests'):
         print("Setting up database tables...")
 
         # Create requests table
-        duckdb_conn.execute("""
-            create table if not exists requests as
-            from 'data/data_requests.csv'
-        """)
+        ingest.create_table(duckdb_conn, 'requests')
         print("Requests table created.")
 
         #create  Suppliers table
-        duckdb_conn.sql("""
-            create table if not exists suppliers as
-            from 'data/suppliers.csv'
-        """)
+        ingest.create_table(duckdb_conn, 'suppliers')
         print("Suppliers table created.")
 
         # Create the Suppliers Blacklist table
-        duckdb_conn.sql("""
-            create table if not exists blacklist as
-            from 'data/supplier_blacklist.csv'
-        """)
+        ingest.create_table(duckdb_conn, 'blacklist')
         print("Blacklist table created.")
 
         # Create the credits table
-        duckdb_conn.sql("""
-            create table if not exists credits as
-            from 'data/credits.csv'
-        """)
+        ingest.create_table(duckdb_conn, 'credits')
         print("Credits table created.")
 
         # Create the quality officers table
-        duckdb_conn.sql("""
-            create table if not exists quality_officers as
-            from 'data/quality_officers.csv'
-        """)
+        ingest.create_table(duckdb_conn, 'quality_officers')
         print("Quality Officers table created.")
 
-        # create a fact table for OLAP purposes
-        duckdb_conn.sql("""
-                CREATE view if not exists FACT_REQUESTS AS
-                    WITH request_base AS (
-                        SELECT
-                            r.id_request,
-                            r.request_date,
-                            r.requested_standard,
-                            r.requested_supplier_site_id,
-                            r.requested_audit_id,
-                            r.audit_scope,
-                            r.contact_information,
-                            r.quality_officer_id,
-                            r.customer_id
-                        FROM requests r
-                    ),
-
-                    -- Choose the single most relevant credit per request
-                    credit_ranked AS (
-                        SELECT
-                            c.credit_id,
-                            c.customer_id AS credit_customer_id,
-                            c.credit_state,
-                            c.reserved_date,
-                            c.consumed_date,
-                            c.id_request,
-                            ROW_NUMBER() OVER (
-                                PARTITION BY c.id_request
-                                ORDER BY COALESCE(c.consumed_date, c.reserved_date) DESC NULLS LAST,
-                                        c.credit_id
-                            ) AS rn
-                        FROM credits c
-                    ),
-                    credit_best AS (
-                        SELECT *
-                        FROM credit_ranked
-                        WHERE rn = 1
-                    ),
-
-                    -- Blacklist status of supplier site as-of the request date
-                    blacklist_match AS (
-                        SELECT
-                            sb.supplier_site_id,
-                            sb.blacklist_since,
-                            sb.blacklist_until
-                        FROM blacklist sb
-                    ),
-
-                    -- Supplier site attributes (from SUPPLIERS per your ER)
-                    supplier_site AS (
-                        SELECT
-                            s.supplier_site_id,
-                            s.supplier_site_name,
-                            s.supplier_site_country,
-                            s.supplier_site_address,
-                            s.supplier_site_availability
-                        FROM suppliers s
-                    ),
-
-                    -- Final select: join all parts
-                    final_rows AS (
-                        SELECT
-                            rb.id_request,
-                            rb.request_date,
-                            rb.requested_standard,
-                            rb.requested_supplier_site_id,
-                            rb.requested_audit_id,
-                            rb.audit_scope,
-                            rb.contact_information,
-                            rb.quality_officer_id,
-
-                            -- Customer (dimension attributes included to simplify)
-                            rb.customer_id,
-
-                            -- Supplier (organization-level)
-                            rb.requested_supplier_site_id,
-
-                            -- Supplier site
-                            ss.supplier_site_id AS supplier_site_id_resolved,
-                            ss.supplier_site_name,
-                            ss.supplier_site_country,
-                            ss.supplier_site_address,
-                            ss.supplier_site_availability,
-
-                            -- Blacklist snapshot as-of request date
-                            CASE
-                                WHEN EXISTS (
-                                    SELECT 1
-                                    FROM blacklist_match bm
-                                    WHERE bm.supplier_site_id = COALESCE(ss.supplier_site_id, rb.requested_supplier_site_id)
-                                    AND rb.request_date BETWEEN bm.blacklist_since
-                                                            AND COALESCE(bm.blacklist_until, rb.request_date)
-                                ) THEN 1 ELSE 0
-                            END AS is_currently_blacklisted,
-
-                            -- Credit linked to this request (if any)
-                            cb.credit_id,
-                            cb.credit_state,
-                            cb.reserved_date,
-                            cb.consumed_date,
-
-                            -- Simple additive metrics
-                            1 AS request_count,
-                            CASE WHEN rb.requested_audit_id IS NOT NULL AND rb.requested_audit_id <> '' THEN TRUE ELSE FALSE END AS has_audit_id
-                        FROM request_base rb
-                        LEFT JOIN supplier_site ss
-                            ON ss.supplier_site_id = rb.requested_supplier_site_id
-                            OR ss.supplier_site_id = rb.requested_supplier_site_id
-                        LEFT JOIN credit_best cb
-                            ON cb.id_request = rb.id_request
-                    )
-                    SELECT * FROM final_rows
-        """)
-        print("FACT_REQUEST table created.")
-
-    duckdb_conn.commit()
\ No newline at end of file
+        # Number new requests and index the credit balance of each customer
+        ingest.setup_request_ids(duckdb_conn)
+        ledger.rebuild_balances(duckdb_conn)
+        print("Credit balances created.")
+
+        for dimension in ["suppliers", "customers", "quality_officers"]:
+            dimensions.log_change(duckdb_conn, dimension)
+
+        # Merge the blacklist windows used by validation and the fact table
+        blacklist.rebuild_blacklist_intervals(duckdb_conn)
+        print("Blacklist intervals created.")
+
+        # create the fact table and its dimensions for OLAP purposes
+        facts.rebuild_fact_requests(duckdb_conn)
+        print("FACT_REQUEST star schema created.")
+
+    else:
+        # load only the requests added to the export since the last run
+        if 'requests' in converted:
+            print(f"New requests loaded: {ingest.append_new_requests(duckdb_conn)}")
+
+        ingest.setup_request_ids(duckdb_conn)
+        if not utils.check_table_exists(duckdb_conn, 'credit_balances'):
+            ledger.rebuild_balances(duckdb_conn)
+            dimensions.log_change(duckdb_conn, "customers")
+            print("Credit balances created.")
+
+        if not utils.check_table_exists(duckdb_conn, 'blacklist_intervals'):
+            blacklist.rebuild_blacklist_intervals(duckdb_conn)
+            print("Blacklist intervals created.")
+
+        # FACT_REQUESTS used to be a single table, credit changes were found with a snapshot of the
+        # credits and the refresh watermark was read from fact_request: older databases get the star
+        # schema built once
+        if (
+            not utils.check_table_exists(duckdb_conn, 'fact_request')
+            or not utils.check_table_exists(duckdb_conn, 'fact_request_all')
+            or not utils.check_table_exists(duckdb_conn, 'credit_changes')
+            or utils.check_table_exists(duckdb_conn, 'fact_credits_snapshot')
+            or not utils.check_table_exists(duckdb_conn, 'kpi_daily')
+            or not utils.check_table_exists(duckdb_conn, 'fact_watermark')
+        ):
+            facts.rebuild_fact_requests(duckdb_conn)
+            print("FACT_REQUEST star schema built.")
+
+        # add the requests appended to the export since the last run to the fact; a changed credits
+        # export is only converted to Parquet, credits and credit_balances keep the reservations made here
+        else:
+            facts.refresh_fact_requests(duckdb_conn)
+
+    bulk_jobs.setup_jobs(duckdb_conn)
+
+    # requests and credits loaded from the exports get their state transitions in the event log
+    if converted or not utils.check_table_exists(duckdb_conn, 'request_events'):
+        event_log.setup_events(duckdb_conn)
+        logged = event_log.log_imported(duckdb_conn)
+        if logged:
+            print(f"Request events logged: {logged}")
+
+    duckdb_conn.commit()
+
+
+# the database is opened and set up by the first query, not when this module is imported
+connections = utils.get_connection_manager(setup_database)
+# serve or write the query metrics if QDB_METRICS_PORT or QDB_METRICS_FILE is set
+instrumentation.start_exporters()
+# publish read-only snapshots for the dashboard replicas if QDB_SNAPSHOT_SECONDS is set
+snapshots.start_publisher(connections)
+
+
+def init_database():
+    """Open and set up the database now instead of on the first query."""
+    connections.open()
+    return True
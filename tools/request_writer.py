@@ -0,0 +1,353 @@
+'''
+request_writer.py
+This file writes new requests to the database in batches instead of one transaction per request.
+A batch is appended from an Arrow table: the requests get their ids from request_id_seq, are checked
+against the supplier availability, the blacklist and the credit balances in one query, and the
+accepted ones are inserted with their credits reserved in a single transaction. Credits are spent in
+submission order, as in the bulk upload.
+RequestWriter buffers the requests submitted by any thread. A background thread writes the buffer
+every FLUSH_SECONDS, or as soon as it holds FLUSH_REQUESTS requests, and the interactive form flushes
+it right away. FACT_REQUESTS is not refreshed per batch: the thread refreshes it at most every
+REFRESH_SECONDS, once for all the batches written meanwhile.
+A request is only acknowledged once the transaction of its batch is committed: the PendingRequest
+returned by submit() resolves with its id_request, or with the reason it was turned down or failed.
+The requests still buffered when the process dies were never acknowledged; the ones buffered when
+the interpreter exits normally are written before it does.
+'''
+import atexit
+import datetime
+import threading
+import time
+
+import tools.event_log as event_log
+import tools.facts as facts
+import tools.ingest as ingest
+import tools.instrumentation as instrumentation
+import tools.ledger as ledger
+
+FLUSH_SECONDS = 0.05
+FLUSH_REQUESTS = 1000
+REFRESH_SECONDS = 1.0
+# longest wait of the form for its request, its batch is written while it waits
+WAIT_SECONDS = 30
+
+REQUEST_COLUMNS = ["customer_id", "requested_supplier_site_id", "request_date", "requested_standard", "quality_officer_id"]
+
+UNAVAILABLE_SUPPLIER_REASON = "Supplier is not available to process requests."
+BLACKLISTED_REASON = "Supplier is blacklisted and cannot process requests."
+UNRECORDED_REASON = "Request could not be recorded."
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def _verdict_query(buffer_name):
+    """Build the query that returns the verdict of every buffered request, in submission order."""
+    required_values = ", ".join(f"('{standard}', {credits})" for standard, credits in ledger.REQUIRED_CREDITS.items())
+    return f"""
+        WITH required AS (
+            SELECT * FROM (VALUES {required_values}) AS t(requested_standard, required_credits)
+        ),
+        blacklisted AS (
+            SELECT b.row_id
+            FROM {buffer_name} b
+            JOIN blacklist_intervals bi
+                ON bi.supplier_site_id = b.requested_supplier_site_id
+                AND b.request_date >= bi.blacklist_since
+                AND b.request_date <= COALESCE(bi.blacklist_until, DATE '9999-12-31')
+        ),
+        checked AS (
+            SELECT
+                b.*,
+                r.required_credits,
+                COALESCE(bal.available, 0) AS available_credits,
+                CASE
+                    WHEN r.required_credits IS NULL
+                        THEN 'Invalid request type. Please choose from: {', '.join(ledger.REQUIRED_CREDITS)}.'
+                    WHEN bl.row_id IS NOT NULL
+                        THEN '{BLACKLISTED_REASON}'
+                    WHEN NOT COALESCE(s.supplier_site_availability, false)
+                        THEN '{UNAVAILABLE_SUPPLIER_REASON}'
+                END AS rejection_reason
+            FROM {buffer_name} b
+            LEFT JOIN required r ON r.requested_standard = b.requested_standard
+            LEFT JOIN credit_balances bal ON bal.customer_id = b.customer_id
+            LEFT JOIN suppliers s ON s.supplier_site_id = b.requested_supplier_site_id
+            LEFT JOIN blacklisted bl ON bl.row_id = b.row_id
+        ),
+        spent AS (
+            SELECT
+                *,
+                SUM(required_credits) FILTER (WHERE rejection_reason IS NULL) OVER (
+                    PARTITION BY customer_id
+                    ORDER BY row_id
+                    ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+                ) AS credits_spent
+            FROM checked
+        )
+        SELECT
+            row_id, {", ".join(REQUEST_COLUMNS)}, required_credits,
+            COALESCE(
+                rejection_reason,
+                CASE WHEN credits_spent > available_credits
+                    THEN 'Customer does not have enough credits for ' || requested_standard || '.'
+                END
+            ) AS rejection_reason
+        FROM spent
+        ORDER BY row_id
+    """
+
+
+def write_requests(duckdb_conn, requests, sources=None, refresh_facts=True):
+    """Insert requests, tuples of REQUEST_COLUMNS, and reserve their credits in one transaction, then record their events
+    as coming from sources (one per request, "form" by default). Returns one (id_request, rejection reason) pair per
+    request in order, id_request None for the turned down ones, or None on error (nothing is written)."""
+    import pyarrow as pa
+
+    if not requests:
+        return []
+    columns = list(zip(*requests))
+    buffer = pa.table({
+        "row_id": pa.array(range(len(requests)), pa.int64()),
+        "customer_id": pa.array(columns[0], pa.int64()),
+        "requested_supplier_site_id": pa.array(columns[1], pa.int64()),
+        "request_date": pa.array(columns[2], pa.date32()),
+        "requested_standard": pa.array(columns[3], pa.string()),
+        "quality_officer_id": pa.array(columns[4], pa.int64()),
+    })
+
+    in_transaction = False
+    duckdb_conn.register("request_writer_buffer", buffer)
+    try:
+        with instrumentation.timed("request_writer_batch"):
+            duckdb_conn.begin()
+            in_transaction = True
+            duckdb_conn.execute(f"""
+                CREATE OR REPLACE TEMP TABLE request_writer_verdicts AS {_verdict_query("request_writer_buffer")}
+            """)
+            duckdb_conn.execute(f"""
+                CREATE OR REPLACE TEMP TABLE request_writer_accepted AS
+                SELECT row_id, {ingest.REQUEST_ID_SQL} AS id_request, {", ".join(REQUEST_COLUMNS)}, required_credits
+                FROM request_writer_verdicts
+                WHERE rejection_reason IS NULL
+                ORDER BY row_id
+            """)
+            duckdb_conn.execute(f"""
+                INSERT INTO requests (id_request, {", ".join(REQUEST_COLUMNS)})
+                SELECT id_request, {", ".join(REQUEST_COLUMNS)}
+                FROM request_writer_accepted
+                ORDER BY row_id
+            """)
+            if not ledger.reserve_for_requests(duckdb_conn, "request_writer_accepted"):
+                raise RuntimeError("credit balances changed during the batch")
+            outcomes = duckdb_conn.execute("""
+                SELECT a.id_request, v.rejection_reason
+                FROM request_writer_verdicts v
+                LEFT JOIN request_writer_accepted a USING (row_id)
+                ORDER BY row_id
+            """).fetchall()
+            duckdb_conn.execute("DROP TABLE request_writer_verdicts")
+            duckdb_conn.execute("DROP TABLE request_writer_accepted")
+            duckdb_conn.commit()
+            in_transaction = False
+    except Exception as e:
+        print(f"Error writing requests to database: {e}")
+        if in_transaction:
+            duckdb_conn.rollback()
+        return None
+    finally:
+        duckdb_conn.unregister("request_writer_buffer")
+
+    # the batch is committed, a failure from here on must not report its requests as failed
+    try:
+        for request, source, (id_request, reason) in zip(requests, sources or ["form"] * len(requests), outcomes):
+            if id_request is None:
+                event_log.record_rejected(request[0], request[3], source, reason)
+            else:
+                event_log.record_accepted(id_request, request[0], request[3], source)
+    except Exception as e:
+        print(f"Error recording request events: {e}")
+    if refresh_facts and any(id_request is not None for id_request, _ in outcomes):
+        facts.refresh_fact_requests(duckdb_conn)
+    return outcomes
+
+
+class PendingRequest:
+    """A submitted request, resolved once the batch it was written in is committed or failed."""
+
+    def __init__(self, request, source):
+        self.request = request
+        self.source = source
+        self.id_request = None
+        self.reason = None
+        self._done = threading.Event()
+
+    def resolve(self, id_request, reason):
+        self.id_request = id_request
+        self.reason = reason
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Wait for the batch of the request. Returns True if the request was stored, False if it was turned down,
+        failed or is still buffered after timeout seconds."""
+        return self._done.wait(timeout) and self.id_request is not None
+
+
+class RequestWriter:
+    """Buffer of submitted requests written by a background thread, one batch per transaction."""
+
+    def __init__(self, manager, flush_seconds=FLUSH_SECONDS, flush_requests=FLUSH_REQUESTS):
+        self.manager = manager
+        self.flush_seconds = flush_seconds
+        self.flush_requests = flush_requests
+        self.flushes = 0
+        self.written = 0
+        self.rejected = 0
+        self.failed = 0
+        self.refreshes = 0
+        self._stale = False
+        self._refreshed_at = 0.0
+        self._buffer = []
+        self._ready = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, customer_id, supplier_site_id, request_date, requested_standard, quality_officer_id=None, source="form"):
+        """Buffer a request. Returns its PendingRequest."""
+        if isinstance(request_date, str):
+            request_date = datetime.date.fromisoformat(request_date)
+        elif isinstance(request_date, datetime.datetime):
+            request_date = request_date.date()
+        pending = PendingRequest(
+            (
+                int(customer_id),
+                int(supplier_site_id),
+                request_date,
+                requested_standard,
+                None if quality_officer_id is None else int(quality_officer_id),
+            ),
+            source,
+        )
+        with self._ready:
+            self._buffer.append(pending)
+            if len(self._buffer) >= self.flush_requests:
+                self._ready.notify()
+        return pending
+
+    def pending(self):
+        """Count the buffered requests."""
+        return len(self._buffer)
+
+    def flush(self):
+        """Write the buffered requests as one batch and resolve them. Returns the number stored, -1 on error
+        (the requests of the batch are resolved as failed)."""
+        with self._flush_lock:
+            with self._ready:
+                batch, self._buffer = self._buffer, []
+            if not batch:
+                return 0
+            outcomes = None
+            try:
+                with self.manager.writer() as conn:
+                    outcomes = write_requests(
+                        conn, [pending.request for pending in batch], [pending.source for pending in batch], refresh_facts=False,
+                    )
+            except Exception as e:
+                print(f"Error writing requests to database: {e}")
+            finally:
+                # every request of the batch is resolved, so no caller waits for it forever
+                self.flushes += 1
+                for position, pending in enumerate(batch):
+                    pending.resolve(*(outcomes[position] if outcomes is not None else (None, UNRECORDED_REASON)))
+            if outcomes is None:
+                self.failed += len(batch)
+                return -1
+            stored = sum(1 for id_request, _ in outcomes if id_request is not None)
+            self.written += stored
+            self.rejected += len(batch) - stored
+            self._stale = self._stale or stored > 0
+            return stored
+
+    def refresh_facts(self, force=False):
+        """Refresh FACT_REQUESTS for the requests stored since the last refresh, at most every REFRESH_SECONDS
+        unless forced. Returns True if it was refreshed."""
+        if not self._stale or (not force and time.monotonic() - self._refreshed_at < REFRESH_SECONDS):
+            return False
+        self._stale = False
+        self._refreshed_at = time.monotonic()
+        with self.manager.writer() as conn:
+            refreshed = facts.refresh_fact_requests(conn)
+        if refreshed < 0:
+            self._stale = True
+            return False
+        self.refreshes += 1
+        return True
+
+    def close(self):
+        """Write the buffered requests and refresh FACT_REQUESTS for them."""
+        self.flush()
+        self.refresh_facts(force=True)
+
+    def start(self):
+        """Flush on a background thread every flush_seconds, or sooner when flush_requests are buffered."""
+
+        def flush_forever():
+            while True:
+                with self._ready:
+                    self._ready.wait_for(lambda: len(self._buffer) >= self.flush_requests, timeout=self.flush_seconds)
+                # an error ends this round only, the thread keeps flushing
+                try:
+                    self.flush()
+                    self.refresh_facts()
+                except Exception as e:
+                    print(f"Error in the request writer: {e}")
+
+        self._thread = threading.Thread(target=flush_forever, name="request-writer", daemon=True)
+        self._thread.start()
+        # the requests buffered when the interpreter exits are written before it does
+        atexit.register(self.close)
+
+
+def start(manager):
+    """Start the request writer of this process on the writer of manager, once. Returns True if started.
+    Replicas read a snapshot and have no writer, they do not take requests."""
+    global _writer
+    import tools.snapshots as snapshots
+
+    if snapshots.is_replica():
+        return False
+    with _writer_lock:
+        if _writer is not None:
+            return False
+        _writer = RequestWriter(manager)
+        _writer.start()
+    return True
+
+
+def submit(customer_id, supplier_site_id, request_date, requested_standard, quality_officer_id=None, source="form"):
+    """Buffer a request for the next batch. Returns its PendingRequest, None if the writer was not started in this process."""
+    if _writer is None:
+        return None
+    return _writer.submit(customer_id, supplier_site_id, request_date, requested_standard, quality_officer_id, source)
+
+
+def flush():
+    """Write the buffered requests now. Returns the number stored, -1 on error."""
+    return _writer.flush() if _writer is not None else 0
+
+
+def stats():
+    """Get the buffered, stored, rejected and failed counts of the request writer."""
+    if _writer is None:
+        return {"pending": 0, "written": 0, "rejected": 0, "failed": 0, "flushes": 0, "refreshes": 0}
+    return {
+        "pending": _writer.pending(),
+        "written": _writer.written,
+        "rejected": _writer.rejected,
+        "failed": _writer.failed,
+        "flushes": _writer.flushes,
+        "refreshes": _writer.refreshes,
+    }
@@ -0,0 +1,43 @@
+'''
+results.py
+This file fetches query results in the shape each caller needs instead of building a pandas
+DataFrame for every query: a plain Python value for scalars, an Arrow table for the frames handed to
+Streamlit, and a stream of Arrow record batches for exports that should not sit in memory at once.
+pyarrow is imported by DuckDB when a result is first fetched as Arrow, not when this module loads.
+'''
+
+# rows per record batch when streaming a result
+BATCH_ROWS = 10000
+
+
+def fetch_scalar(duckdb_conn, query, params=None, default=None):
+    """Get the first column of the first row of a query. Returns default if there are no rows or the value is NULL."""
+    row = duckdb_conn.execute(query, params or []).fetchone()
+    if row is None or row[0] is None:
+        return default
+    return row[0]
+
+
+def fetch_table(duckdb_conn, query, params=None):
+    """Get the whole result of a query as an Arrow table."""
+    return duckdb_conn.execute(query, params or []).fetch_arrow_table()
+
+
+def stream_batches(duckdb_conn, query, params=None, batch_size=BATCH_ROWS):
+    """Get the result of a query as a reader of Arrow record batches of at most batch_size rows.
+    The batches are produced while the reader is consumed, so the cursor must stay open until then."""
+    return duckdb_conn.execute(query, params or []).fetch_record_batch(batch_size)
+
+
+def empty_table():
+    """Get an Arrow table without rows or columns."""
+    import pyarrow as pa
+
+    return pa.table({})
+
+
+def empty_stream():
+    """Get a record batch reader without rows."""
+    import pyarrow as pa
+
+    return pa.RecordBatchReader.from_batches(pa.schema([]), [])
@@ -0,0 +1,245 @@
+'''
+snapshots.py
+This file publishes read-only snapshots of the database for dashboard replicas.
+DuckDB lets a single process open the database for writing, so only one app process can create
+requests. That writer copies the whole database into a new file under data/snapshots every
+QDB_SNAPSHOT_SECONDS seconds, from a reader cursor so writes go on meanwhile, and points the CURRENT
+file at it once it is complete. A snapshot file is never changed after that.
+Replicas started with QDB_REPLICA=1 open the current snapshot with read_only=True instead of the
+database, switch to a newer one when it is published and hide the request page. Any number of them
+can run side by side, on every node that sees the snapshot directory. Archived fact months are read
+from data/archive, which the replicas need at the same relative path.
+
+Usage:
+    QDB_SNAPSHOT_SECONDS=60 uv run streamlit run main.py                  # the writer
+    QDB_REPLICA=1 uv run streamlit run main.py --server.port 8502         # a replica
+    python -m tools.snapshots --publish                                   # once, while the app is stopped
+'''
+import argparse
+import contextlib
+import datetime
+import glob
+import os
+import queue
+import sys
+import threading
+import time
+
+import duckdb
+
+import tools.connections as connections
+import tools.instrumentation as instrumentation
+
+SNAPSHOT_DIR = "data/snapshots"
+CURRENT_FILE = "CURRENT"
+# snapshots kept besides the current one, for replicas still reading them
+KEEP = 2
+# how often a replica looks for a newer snapshot
+CHECK_SECONDS = 5
+
+_publisher_started = False
+_publish_lock = threading.Lock()
+
+
+def snapshot_dir_from_env():
+    """Read the snapshot directory from QDB_SNAPSHOT_DIR. Returns the default if unset."""
+    return os.environ.get("QDB_SNAPSHOT_DIR", SNAPSHOT_DIR)
+
+
+def is_replica():
+    """Check if this process is a dashboard replica reading snapshots (QDB_REPLICA=1)."""
+    return os.environ.get("QDB_REPLICA") == "1"
+
+
+def current_snapshot(directory=SNAPSHOT_DIR):
+    """Get the path of the current snapshot. Returns None if none was published or on error."""
+    try:
+        with open(os.path.join(directory, CURRENT_FILE)) as f:
+            name = f.read().strip()
+        return os.path.join(directory, name) if name else None
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        print(f"Error reading current snapshot: {e}")
+        return None
+
+
+def _set_current(directory, name):
+    """Point CURRENT at a snapshot, replacing the file in one step so readers never see it half written."""
+    partial = os.path.join(directory, f"{CURRENT_FILE}.partial")
+    with open(partial, "w") as f:
+        f.write(name)
+    os.replace(partial, os.path.join(directory, CURRENT_FILE))
+
+
+def prune(directory=SNAPSHOT_DIR, keep=KEEP):
+    """Delete the snapshots older than the current one and the keep before it. Returns the number deleted."""
+    current = current_snapshot(directory)
+    snapshots = sorted(glob.glob(os.path.join(directory, "qdb-*.duckdb")))
+    if current not in snapshots:
+        return 0
+    old = snapshots[: max(0, snapshots.index(current) - keep)]
+    for path in old:
+        try:
+            os.remove(path)
+        except OSError as e:
+            print(f"Error deleting snapshot {path}: {e}")
+    return len(old)
+
+
+def publish(manager, directory=SNAPSHOT_DIR, keep=KEEP):
+    """Copy the committed state of the database into a new snapshot and make it the current one. Returns its path, None on error."""
+    with _publish_lock:
+        name = f"qdb-{datetime.datetime.now():%Y%m%dT%H%M%S%f}.duckdb"
+        path = os.path.join(directory, name)
+        partial = f"{path}.partial"
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with instrumentation.timed("snapshot_publish"), manager.reader() as conn:
+                source = conn.execute("SELECT current_database()").fetchone()[0]
+                conn.execute(f"ATTACH '{partial}' AS qdb_snapshot")
+                try:
+                    conn.execute(f"COPY FROM DATABASE {source} TO qdb_snapshot")
+                finally:
+                    # detaching checkpoints the copy, the file is complete afterwards
+                    conn.execute("DETACH qdb_snapshot")
+            os.replace(partial, path)
+            _set_current(directory, name)
+            prune(directory, keep)
+            return path
+        except Exception as e:
+            print(f"Error publishing snapshot: {e}")
+            with contextlib.suppress(OSError):
+                os.remove(partial)
+            return None
+
+
+def start_publisher(manager):
+    """Publish a snapshot every QDB_SNAPSHOT_SECONDS seconds on a background thread, once per process. Returns True if started."""
+    global _publisher_started
+    seconds = os.environ.get("QDB_SNAPSHOT_SECONDS")
+    if not seconds or is_replica():
+        return False
+    try:
+        interval = float(seconds)
+    except ValueError:
+        print("Error: QDB_SNAPSHOT_SECONDS must be a number, snapshots are not published")
+        return False
+    with _publish_lock:
+        if _publisher_started:
+            return False
+        _publisher_started = True
+
+    directory = snapshot_dir_from_env()
+
+    def publish_forever():
+        while True:
+            publish(manager, directory)
+            time.sleep(interval)
+
+    threading.Thread(target=publish_forever, name="snapshot-publisher", daemon=True).start()
+    print(f"Publishing a snapshot to {directory} every {interval:g} s")
+    return True
+
+
+class ReplicaManager(connections.ConnectionManager):
+    """A pool of reader cursors over the current snapshot, opened read-only, with no writer.
+    The pool moves to a newer snapshot when one is published; the cursors of the old one are closed
+    once every session gave them back."""
+
+    def __init__(self, directory=SNAPSHOT_DIR, pool_size=connections.DEFAULT_POOL_SIZE):
+        super().__init__(None, pool_size)
+        self.directory = directory
+        self._checked_at = 0.0
+        self._retired = []
+
+    def open(self):
+        """Open the current snapshot, or a newer one published since the last check."""
+        if self._writer is not None and time.monotonic() - self._checked_at < CHECK_SECONDS:
+            return
+        with self._write_lock:
+            self._checked_at = time.monotonic()
+            path = current_snapshot(self.directory)
+            if path is None or path == self.database:
+                if self._writer is None:
+                    raise FileNotFoundError(f"No snapshot published in {self.directory}")
+                return
+            connection = instrumentation.InstrumentedConnection(duckdb.connect(path, read_only=True))
+            readers = queue.Queue(maxsize=self.pool_size)
+            for _ in range(self.pool_size):
+                readers.put(connection.cursor())
+            if self._writer is not None:
+                self._retired.append((self._writer, self._readers))
+            self._writer, self._readers, self.database = connection, readers, path
+            self._close_retired()
+
+    def _close_retired(self):
+        """Close the snapshots replaced by a newer one whose cursors are all back in their pool."""
+        for connection, readers in list(self._retired):
+            if readers.full():
+                while not readers.empty():
+                    readers.get_nowait().close()
+                connection.close()
+                self._retired.remove((connection, readers))
+
+    @contextlib.contextmanager
+    def reader(self, timeout=None):
+        """Borrow a reader cursor of the current snapshot, waiting for a free one when the pool is exhausted."""
+        self.open()
+        readers = self._readers
+        cursor = readers.get(timeout=timeout)
+        try:
+            yield cursor
+        finally:
+            cursor.flush()
+            readers.put(cursor)
+            if readers is not self._readers:
+                with self._write_lock:
+                    self._close_retired()
+
+    def writer(self):
+        raise RuntimeError("This replica reads a snapshot, requests are written by the writer process")
+
+    def transaction(self):
+        raise RuntimeError("This replica reads a snapshot, requests are written by the writer process")
+
+    def close(self):
+        """Close every snapshot still open."""
+        with self._write_lock:
+            if self._writer is not None:
+                self._retired.append((self._writer, self._readers))
+                self._writer = None
+                self.database = None
+            for connection, readers in self._retired:
+                while not readers.empty():
+                    readers.get_nowait().close()
+                connection.close()
+            self._retired = []
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Publish read-only snapshots of the database for dashboard replicas.")
+    parser.add_argument("--database", default=connections.DEFAULT_DATABASE, help="DuckDB database file.")
+    parser.add_argument("--output-dir", default=SNAPSHOT_DIR, help="Directory of the snapshots.")
+    parser.add_argument("--keep", type=int, default=KEEP, help="Older snapshots kept besides the current one.")
+    parser.add_argument("--interval", type=float, help="Publish every this many seconds instead of once.")
+    parser.add_argument("--publish", action="store_true", help="Publish a snapshot now.")
+    args = parser.parse_args(argv)
+    if not args.publish and args.interval is None:
+        parser.print_usage()
+        return 2
+
+    manager = connections.ConnectionManager(args.database, pool_size=1)
+    try:
+        while True:
+            path = publish(manager, args.output_dir, args.keep)
+            print(f"Snapshot published: {path}" if path else "Snapshot publish failed.")
+            if args.interval is None:
+                return 0 if path else 1
+            time.sleep(args.interval)
+    finally:
+        manager.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
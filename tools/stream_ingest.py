@@ -0,0 +1,288 @@
+'''
+stream_ingest.py
+This file is the ingestion worker for requests sent through the API as JSON lines.
+It reads records from a JSONL file (optionally following it as it grows), from stdin or from a
+local TCP socket, validates them in batches with the same set-based rules as the bulk upload and
+appends the accepted ones to the requests table.
+
+Records are handed from the reader thread to the writer through a bounded queue, so a slow
+database applies back-pressure to the source instead of buffering without limit. For file
+sources the byte offset of the last processed line is stored in ingest_checkpoints inside the
+same transaction as the inserted requests, so a restart resumes exactly where it stopped.
+
+DuckDB allows a single writer process: run the worker while the app is stopped, or as the
+only process that opens the database for writing.
+
+Usage:
+    python -m tools.stream_ingest --source requests.jsonl --follow
+    python -m tools.stream_ingest --stdin < requests.jsonl
+    python -m tools.stream_ingest --socket 127.0.0.1:7071
+'''
+import argparse
+import collections
+import json
+import queue
+import socketserver
+import sys
+import threading
+import time
+
+import pandas as pd
+
+import tools.bulk as bulk
+import tools.connections as connections
+import tools.event_log as event_log
+import tools.facts as facts
+
+# marks the end of a source that does not follow new data, or of one that failed
+_END = object()
+# put on the queue before _END by a reader that stopped on an error
+SourceError = collections.namedtuple("SourceError", ["error"])
+
+
+def setup_checkpoints(duckdb_conn):
+    """Create the table that stores the offset reached in each source file."""
+    duckdb_conn.execute("""
+        CREATE TABLE IF NOT EXISTS ingest_checkpoints (
+            source VARCHAR PRIMARY KEY,
+            position BIGINT,
+            updated_at TIMESTAMP
+        )
+    """)
+
+
+def get_checkpoint(duckdb_conn, source):
+    """Get the byte offset already processed in a source file. Returns 0 if the file was never read."""
+    row = duckdb_conn.execute("SELECT position FROM ingest_checkpoints WHERE source = ?", [source]).fetchone()
+    return int(row[0]) if row else 0
+
+
+def save_checkpoint(duckdb_conn, source, position):
+    duckdb_conn.execute("""
+        INSERT OR REPLACE INTO ingest_checkpoints (source, position, updated_at)
+        VALUES (?, ?, current_timestamp)
+    """, [source, int(position)])
+
+
+class IngestMetrics:
+    """Throughput counters of the worker."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.read = 0
+        self.accepted = 0
+        self.rejected = 0
+        self.malformed = 0
+        self.batches = 0
+        self.batch_seconds = 0.0
+
+    def report(self, backlog=0):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        avg_batch_ms = 1000 * self.batch_seconds / self.batches if self.batches else 0.0
+        return (
+            f"read={self.read} accepted={self.accepted} rejected={self.rejected} malformed={self.malformed} "
+            f"batches={self.batches} avg_batch_ms={avg_batch_ms:.1f} rate={self.read / elapsed:.0f}/s backlog={backlog}"
+        )
+
+
+def read_file(path, start, records, stop, follow=False, poll_interval=0.2):
+    """Put (line, end offset) pairs of a JSONL file on the queue, starting at a byte offset.
+    Only complete lines are read, so a line being written is picked up once it ends."""
+    try:
+        with open(path, "rb") as f:
+            f.seek(start)
+            position = start
+            while not stop.is_set():
+                line = f.readline()
+                if line.endswith(b"\n"):
+                    position += len(line)
+                    records.put((line, position))
+                    continue
+                # partial or no line: rewind and wait for more data
+                f.seek(position)
+                if not follow:
+                    if line:
+                        records.put((line, position + len(line)))
+                    break
+                time.sleep(poll_interval)
+    except Exception as e:
+        records.put(SourceError(e))
+    finally:
+        records.put(_END)
+
+
+def read_stream(stream, records, stop):
+    """Put the lines of a binary stream on the queue, without offsets."""
+    try:
+        for line in stream:
+            if stop.is_set():
+                break
+            records.put((line, None))
+    except Exception as e:
+        records.put(SourceError(e))
+    finally:
+        records.put(_END)
+
+
+def serve_socket(host, port, records, stop):
+    """Accept line based connections on a local TCP socket and put their lines on the queue.
+    A full queue blocks the handler, which in turn lets TCP flow control slow the client down."""
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if stop.is_set():
+                    break
+                records.put((line, None))
+
+    try:
+        server = socketserver.ThreadingTCPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=lambda: (stop.wait(), server.shutdown()), daemon=True).start()
+        server.serve_forever()
+    except Exception as e:
+        records.put(SourceError(e))
+    finally:
+        records.put(_END)
+
+
+def _parse(lines, metrics):
+    """Parse a batch of JSON lines into a request frame, counting the malformed ones."""
+    rows = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            rows.append({column: record.get(column) for column in bulk.BULK_COLUMNS})
+        except (ValueError, AttributeError):
+            metrics.malformed += 1
+    return pd.DataFrame(rows, columns=bulk.BULK_COLUMNS)
+
+
+def process_batch(manager, batch, source, metrics):
+    """Validate and insert one batch, saving the checkpoint in the same transaction. Returns True on success."""
+    started = time.monotonic()
+    lines = [line for line, _ in batch]
+    position = batch[-1][1]
+    frame = _parse(lines, metrics)
+
+    def checkpoint(conn, verdicts=None):
+        if source is not None and position is not None:
+            save_checkpoint(conn, source, position)
+
+    with manager.writer() as conn:
+        if frame.empty:
+            checkpoint(conn)
+        else:
+            verdicts = bulk.load_bulk_requests(conn, frame, before_commit=checkpoint, refresh_facts=False, source="api")
+            if verdicts.empty:
+                return False
+            accepted = int(verdicts["accepted"].sum())
+            metrics.accepted += accepted
+            metrics.rejected += len(verdicts) - accepted
+
+    metrics.read += len(lines)
+    metrics.batches += 1
+    metrics.batch_seconds += time.monotonic() - started
+    return True
+
+
+def run(manager, records, source=None, batch_size=1000, batch_timeout=0.5, report_interval=10.0):
+    """Consume the queue in batches until the source ends. Returns the metrics, or None if a batch or the source failed.
+    The records read before a source error are still stored."""
+    metrics = IngestMetrics()
+    last_report = time.monotonic()
+    finished = False
+    failed = False
+
+    while not finished:
+        batch = []
+        deadline = time.monotonic() + batch_timeout
+        while len(batch) < batch_size:
+            try:
+                item = records.get(timeout=max(deadline - time.monotonic(), 0.001))
+            except queue.Empty:
+                break
+            if item is _END:
+                finished = True
+                break
+            if isinstance(item, SourceError):
+                print(f"Error reading source: {item.error}")
+                failed = True
+                continue
+            batch.append(item)
+
+        if batch and not process_batch(manager, batch, source, metrics):
+            print("Error: batch could not be stored, stopping so it is retried on restart.")
+            return None
+
+        if time.monotonic() - last_report >= report_interval:
+            with manager.writer() as conn:
+                facts.refresh_fact_requests(conn)
+            print(metrics.report(records.qsize()))
+            last_report = time.monotonic()
+
+    with manager.writer() as conn:
+        facts.refresh_fact_requests(conn)
+    print(metrics.report(records.qsize()))
+    return None if failed else metrics
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ingest JSONL requests into the requests table.")
+    source_group = parser.add_mutually_exclusive_group()
+    source_group.add_argument("--source", default="requests.jsonl", help="JSONL file to read.")
+    source_group.add_argument("--stdin", action="store_true", help="Read JSON lines from stdin.")
+    source_group.add_argument("--socket", metavar="HOST:PORT", help="Listen for JSON lines on a local TCP socket.")
+    parser.add_argument("--follow", action="store_true", help="Keep reading the file as it grows.")
+    parser.add_argument("--database", default=connections.DEFAULT_DATABASE, help="DuckDB database file.")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Maximum records per transaction.")
+    parser.add_argument("--batch-timeout", type=float, default=0.5, help="Seconds to wait before flushing a partial batch.")
+    parser.add_argument("--queue-size", type=int, default=10000, help="Records buffered before the reader blocks.")
+    parser.add_argument("--report-interval", type=float, default=10.0, help="Seconds between metric reports.")
+    args = parser.parse_args(argv)
+
+    if not args.stdin and not args.socket:
+        # a missing or unreadable file is reported before the database is opened
+        try:
+            with open(args.source, "rb"):
+                pass
+        except OSError as e:
+            print(f"Error reading source: {e}")
+            return 2
+
+    manager = connections.ConnectionManager(args.database, pool_size=1)
+    with manager.writer() as conn:
+        event_log.setup_events(conn)
+    event_log.start(manager)
+    records = queue.Queue(maxsize=args.queue_size)
+    stop = threading.Event()
+    source = None
+
+    if args.stdin:
+        reader = threading.Thread(target=read_stream, args=(sys.stdin.buffer, records, stop), daemon=True)
+    elif args.socket:
+        host, port = args.socket.rsplit(":", 1)
+        reader = threading.Thread(target=serve_socket, args=(host, int(port), records, stop), daemon=True)
+    else:
+        source = args.source
+        with manager.writer() as conn:
+            setup_checkpoints(conn)
+            start = get_checkpoint(conn, source)
+        reader = threading.Thread(target=read_file, args=(source, start, records, stop, args.follow), daemon=True)
+
+    reader.start()
+    try:
+        metrics = run(manager, records, source, args.batch_size, args.batch_timeout, args.report_interval)
+    except KeyboardInterrupt:
+        metrics = None
+    finally:
+        stop.set()
+        event_log.flush()
+        manager.close()
+    return 0 if metrics is not None else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,201 @@
+'''
+synthetic.py
+This file generates synthetic CSV exports with the same layout as the ones in data/, at any scale.
+Rows are produced by DuckDB from range() with hash based randomness, so the same seed and end date
+always give the same data and 10^8 requests do not go through Python. Requests cover the DAYS days
+before the end date, today by default, so the dashboard windows are filled.
+The tables are consistent with each other: requests point to existing suppliers and quality
+officers, blacklist windows to existing sites, and the reserved and consumed credits belong to the
+customer of the request they are linked to.
+Customers and supplier sites are picked with a power law: skew 1 is uniform, higher values send more
+requests to the lowest ids.
+
+Usage:
+    python -m tools.synthetic --requests 1000000 --skew 2 --output-dir /tmp/qualifyze-bench
+'''
+import argparse
+import datetime
+import os
+import sys
+
+import duckdb
+
+import tools.ingest as ingest
+import tools.ledger as ledger
+
+DAYS = 730
+FIRST_CUSTOMER_ID = 1001
+QUALITY_OFFICERS = 15
+
+COUNTRIES = ["DE", "ES", "FR", "IT", "NL", "PT", "PL", "BE", "AT", "IE"]
+CITIES = ["Madrid", "Munich", "Paris", "Milan", "Rotterdam", "Lisbon", "Warsaw", "Brussels", "Vienna", "Dublin"]
+AUDIT_SCOPES = [
+    "training_records", "batch_release", "risk_management", "clinical_data_mgmt", "complaint_handling",
+    "supplier_qualification", "deviation_mgmt", "pharmacovigilance_system", "change_control",
+    "validation_program", "data_integrity",
+]
+FIRST_NAMES = ["Casey", "Taylor", "Morgan", "Riley", "Nico", "Pablo", "Alex", "Sam", "Jamie", "Robin"]
+LAST_NAMES = ["Fischer", "Hernandez", "Schmidt", "Rossi", "Dubois", "Silva", "Nowak", "Jansen", "Murphy", "Weber"]
+
+
+def _sql_list(values):
+    return "[" + ", ".join(f"'{value}'" for value in values) + "]"
+
+
+def _pick(values, uniform):
+    """SQL expression picking one of values with a uniform draw."""
+    return f"{_sql_list(values)}[1 + floor({len(values)} * {uniform})::INT]"
+
+
+def default_sizes(requests):
+    """Number of customers, supplier sites and blacklist windows that keep the ratios of the shipped data."""
+    customers = max(10, min(requests // 4, 1_000_000))
+    suppliers = max(50, min(requests // 3, 1_000_000))
+    return customers, suppliers, max(5, suppliers // 12)
+
+
+def generate(output_dir, requests, customers=None, suppliers=None, blacklist_windows=None,
+             available_credits=8, skew=1.0, seed=0, end_date=None):
+    """Write the CSV exports of a synthetic dataset under output_dir. Returns the number of rows per table."""
+    end_date = end_date or datetime.date.today()
+    start_date = end_date - datetime.timedelta(days=DAYS)
+    default_customers, default_suppliers, default_windows = default_sizes(requests)
+    customers = customers or default_customers
+    suppliers = suppliers or default_suppliers
+    blacklist_windows = blacklist_windows or default_windows
+
+    os.makedirs(os.path.join(output_dir, "data"), exist_ok=True)
+    scratch = os.path.join(output_dir, "_synthetic.duckdb")
+    if os.path.exists(scratch):
+        os.remove(scratch)
+    conn = duckdb.connect(scratch)
+    try:
+        # uniform draw in [0, 1) for row i, independent per salt
+        conn.execute(f"CREATE MACRO u(i, salt) AS (hash(i, '{int(seed)}-' || salt) % 1000000) / 1000000.0")
+        conn.execute(f"CREATE MACRO skewed(i, salt, n) AS 1 + least(n - 1, floor(n * pow(u(i, salt), {float(skew)})))::BIGINT")
+
+        conn.execute(f"""
+            CREATE TABLE suppliers AS
+            SELECT
+                i AS supplier_site_id,
+                printf('Site %03d', i) AS supplier_site_name,
+                {_pick(COUNTRIES, "u(i, 'country')")} AS supplier_site_country,
+                printf('Main St %d, %s', 1 + floor(300 * u(i, 'street'))::INT, {_pick(CITIES, "u(i, 'city')")}) AS supplier_site_address,
+                u(i, 'available') < 0.85 AS supplier_site_availability
+            FROM range(1, {int(suppliers)} + 1) t(i)
+        """)
+
+        conn.execute(f"""
+            CREATE TABLE blacklist AS
+            SELECT
+                skewed(i, 'bl_site', {int(suppliers)}) AS supplier_site_id,
+                DATE '{start_date}' + floor({DAYS} * u(i, 'bl_since'))::INT AS blacklist_since,
+                CASE WHEN u(i, 'bl_open') < 0.25 THEN NULL
+                    ELSE DATE '{start_date}' + floor({DAYS} * u(i, 'bl_since'))::INT + 1 + floor(120 * u(i, 'bl_days'))::INT
+                END AS blacklist_until
+            FROM range(1, {int(blacklist_windows)} + 1) t(i)
+        """)
+
+        conn.execute(f"""
+            CREATE TABLE quality_officers AS
+            SELECT
+                i AS quality_officer_id,
+                {_pick(FIRST_NAMES, "u(i, 'qo_first')")} || ' ' || {_pick(LAST_NAMES, "u(i, 'qo_last')")} AS quality_officer_name
+            FROM range(1, {QUALITY_OFFICERS} + 1) t(i)
+        """)
+
+        standards = list(ledger.REQUIRED_CREDITS)
+        conn.execute(f"""
+            CREATE TABLE requests AS
+            SELECT
+                printf('REQ%05d', i) AS id_request,
+                {FIRST_CUSTOMER_ID} - 1 + skewed(i, 'customer', {int(customers)}) AS customer_id,
+                DATE '{start_date}' + floor({DAYS} * u(i, 'date'))::INT AS request_date,
+                CASE WHEN u(i, 'has_standard') < 0.2 THEN NULL ELSE {_pick(standards, "u(i, 'standard')")} END AS requested_standard,
+                skewed(i, 'site', {int(suppliers)}) AS requested_supplier_site_id,
+                CASE WHEN u(i, 'has_audit') < 0.75 THEN printf('AUD%05d', i) END AS requested_audit_id,
+                CASE WHEN u(i, 'has_scope') < 0.22 THEN NULL ELSE {_pick(AUDIT_SCOPES, "u(i, 'scope')")} END AS audit_scope,
+                printf(
+                    '{{"name": "%s", "surname": "%s", "email": "%s.%s@example.com"}}',
+                    {_pick(FIRST_NAMES, "u(i, 'first')")}, {_pick(LAST_NAMES, "u(i, 'last')")},
+                    lower({_pick(FIRST_NAMES, "u(i, 'first')")}), lower({_pick(LAST_NAMES, "u(i, 'last')")})
+                ) AS contact_information,
+                CASE WHEN u(i, 'has_officer') < 0.9 THEN 1 + floor({QUALITY_OFFICERS} * u(i, 'officer'))::BIGINT END AS quality_officer_id
+            FROM range(1, {int(requests)} + 1) t(i)
+        """)
+
+        # 80% of the requests with a standard hold their credits, most of them already consumed
+        required_values = ", ".join(f"('{standard}', {credits})" for standard, credits in ledger.REQUIRED_CREDITS.items())
+        conn.execute(f"""
+            CREATE TABLE credits AS
+            WITH required(requested_standard, required_credits) AS (VALUES {required_values}),
+            linked AS (
+                SELECT r.*, q.required_credits, u(hash(r.id_request), 'consumed') < 0.85 AS consumed
+                FROM requests r JOIN required q USING (requested_standard)
+                WHERE u(hash(r.id_request), 'linked') < 0.8
+            ),
+            request_credits AS (
+                SELECT
+                    printf('C%d-%s-%d', customer_id, id_request, slot) AS credit_id,
+                    customer_id,
+                    CASE WHEN consumed THEN 'consumed' ELSE 'reserved' END AS credit_state,
+                    request_date AS reserved_date,
+                    CASE WHEN consumed THEN least(DATE '{end_date}', request_date + 1 + floor(60 * u(hash(id_request), 'resolution'))::INT) END AS consumed_date,
+                    id_request
+                FROM linked, range(required_credits) s(slot)
+            ),
+            free_credits AS (
+                SELECT
+                    printf('C%d-F%06d', c.customer_id, slot) AS credit_id,
+                    c.customer_id,
+                    'available' AS credit_state,
+                    NULL::DATE AS reserved_date,
+                    NULL::DATE AS consumed_date,
+                    NULL AS id_request
+                FROM (
+                    SELECT {FIRST_CUSTOMER_ID} - 1 + i AS customer_id, floor(2 * {float(available_credits)} * u(i, 'free'))::INT AS free
+                    FROM range(1, {int(customers)} + 1) t(i)
+                ) c, range(c.free) s(slot)
+            )
+            SELECT * FROM request_credits
+            UNION ALL
+            SELECT * FROM free_credits
+        """)
+
+        counts = {}
+        for table in ingest.SCHEMAS:
+            path = os.path.join(output_dir, ingest.SCHEMAS[table]["csv"])
+            conn.execute(f"""
+                COPY (SELECT {", ".join(ingest.SCHEMAS[table]["columns"])} FROM {table})
+                TO '{path}' (HEADER, DELIMITER ',', QUOTE '"', ESCAPE '"')
+            """)
+            counts[table] = conn.execute(f"SELECT count(*) FROM {table}").fetchone()[0]
+        return counts
+    finally:
+        conn.close()
+        os.remove(scratch)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate synthetic CSV exports for benchmarks.")
+    parser.add_argument("--requests", type=int, default=10000)
+    parser.add_argument("--customers", type=int, help="Default: one per 4 requests, at most 10^6.")
+    parser.add_argument("--suppliers", type=int, help="Default: one site per 3 requests, at most 10^6.")
+    parser.add_argument("--blacklist-windows", type=int, help="Default: one per 12 supplier sites.")
+    parser.add_argument("--available-credits", type=float, default=8, help="Average available credits per customer.")
+    parser.add_argument("--skew", type=float, default=1.0, help="1 is uniform, higher values concentrate requests.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--end-date", type=datetime.date.fromisoformat, help="Last request date, default today.")
+    parser.add_argument("--output-dir", required=True, help="The CSV files are written to its data/ directory.")
+    args = parser.parse_args(argv)
+
+    counts = generate(
+        args.output_dir, args.requests, args.customers, args.suppliers, args.blacklist_windows,
+        args.available_credits, args.skew, args.seed, args.end_date,
+    )
+    print(", ".join(f"{table}={rows}" for table, rows in counts.items()))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
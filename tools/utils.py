@@ -1,12 +1,27 @@
-import duckdb
-import streamlit as st
+import functools
 
+import tools.connections as connections
+import tools.event_log as event_log
+import tools.blacklist as blacklist
+import tools.ledger as ledger
+import tools.request_writer as request_writer
+import tools.results as results
+import tools.dimensions as dimensions
+import tools.snapshots as snapshots
 
-@st.cache_resource
-def get_duckdb_conn():
-    duckdb_conn = duckdb.connect("data/qdb.duckdb", read_only=False)
+Supplier = dimensions.Supplier
 
-    return duckdb_conn
+
+# one manager per process; functools instead of st.cache_resource keeps this module, and the
+# validation rules on top of it, importable without Streamlit
+@functools.cache
+def get_connection_manager(_setup=None):
+    """Get the connection manager shared by every session: one writer and a pool of reader cursors.
+    _setup runs on the writer connection when the first query opens the database.
+    A replica (QDB_REPLICA=1) gets reader cursors over the current read-only snapshot instead."""
+    if snapshots.is_replica():
+        return snapshots.ReplicaManager(snapshots.snapshot_dir_from_env(), connections.pool_size_from_env())
+    return connections.ConnectionManager(connections.DEFAULT_DATABASE, connections.pool_size_from_env(), _setup)
 
 
 def get_customer_credits(duckdb_conn, customer_id):
@@ -15,13 +30,7 @@ def get_customer_credits(duckdb_conn, customer_id):
         return 0
 
     try:
-        query = """
-            SELECT count(credit_id) FROM credits WHERE customer_id = ? and credit_state = 'available'
-        """
-        result = duckdb_conn.execute(query, [customer_id]).df()
-        if result.empty:
-            return 0
-        return int(result.iloc[0, 0])
+        return ledger.get_available_credits(duckdb_conn, customer_id)
     except Exception as e:
         print(f"Error getting customer credits: {e}")
         return 0
@@ -31,110 +40,71 @@ def get_total_requests(duckdb_conn):
     """Get total number of requests. Returns 0 on error."""
     try:
         query = """
-            SELECT count(*) FROM requests
+            SELECT COALESCE(sum(total_requests), 0) FROM kpi_daily
         """
-        result = duckdb_conn.sql(query).df()
-        if result.empty:
-            return 0
-        return int(result.iloc[0, 0])
+        return int(results.fetch_scalar(duckdb_conn, query, default=0))
     except Exception as e:
         print(f"Error getting total requests: {e}")
         return 0
     
-def get_all_requests(duckdb_conn):
-    """Get total number of requests. Returns 0 on error."""
+def get_all_requests(duckdb_conn, batch_size=results.BATCH_ROWS):
+    """Stream all requests as Arrow record batches, read them before releasing the cursor. Returns an empty reader on error."""
     try:
         query = """
             SELECT * FROM requests
         """
-        result = duckdb_conn.sql(query).df()
-        return result
+        return results.stream_batches(duckdb_conn, query, batch_size=batch_size)
     except Exception as e:
-        print(f"Error getting total requests: {e}")
-        return 0
+        print(f"Error getting all requests: {e}")
+        return results.empty_stream()
 
 def get_total_customers(duckdb_conn):
     """Get total number of distinct customers. Returns 0 on error."""
     try:
         query = """
-            SELECT count(DISTINCT customer_id) FROM credits
+            SELECT count(*) FROM credit_balances
         """
-        result = duckdb_conn.sql(query).df()
-        if result.empty:
-            return 0
-        return int(result.iloc[0, 0])
+        return int(results.fetch_scalar(duckdb_conn, query, default=0))
     except Exception as e:
         print(f"Error getting total customers: {e}")
         return 0
 
-def get_audit_type_by_date(duckdb_conn):
-    """Get audit requests grouped by standard and date. Returns empty DataFrame on error."""
-    try:
-        query = """
-            SELECT requested_standard, request_date, count(*) as total_requests
-            FROM requests
-            WHERE requested_standard IS NOT NULL
-            GROUP BY requested_standard, request_date
-            ORDER BY request_date
-        """
-        result = duckdb_conn.sql(query).df()
-        return result
-    except Exception as e:
-        print(f"Error getting audit type by date: {e}")
-        import pandas as pd
-        return pd.DataFrame()
-
-
 def get_audit_by_country(duckdb_conn):
-    """Get audit requests grouped by country. Returns empty DataFrame on error."""
+    """Get audit requests grouped by country. Returns an empty Arrow table on error."""
     try:
         query = """
-            SELECT supplier_site_country as country, count(*) as total_requests
-            FROM requests JOIN suppliers ON requests.requested_supplier_site_id = suppliers.supplier_site_id
-            WHERE requested_supplier_site_id IS NOT NULL
+            SELECT supplier_site_country as country, sum(total_requests)::BIGINT as total_requests
+            FROM kpi_daily
+            WHERE supplier_site_country IS NOT NULL
             GROUP BY 1
             ORDER BY total_requests DESC
         """
-        result = duckdb_conn.sql(query).df()
-        return result
+        return results.fetch_table(duckdb_conn, query)
     except Exception as e:
         print(f"Error getting audit by country: {e}")
-        import pandas as pd
-        return pd.DataFrame()
+        return results.empty_table()
 
 
-def write_request_to_db(duckdb_conn, customer_id, supplier, request_date, request_type):
-    """Write a request to the database. Returns True on success, False on failure."""
+def write_request_to_db(duckdb_conn, customer_id, supplier, request_date, request_type, quality_officer_id=None, source="form"):
+    """Write a request to the database and record its events, coming from source. Returns True on success, False on failure.
+    The request is written as a batch of one by tools.request_writer, the form submits to its buffer instead."""
     if not all([customer_id, supplier, request_date, request_type]):
         print("Error: Missing required parameters for write_request_to_db")
         return False
 
     try:
-        # Find the id of supplier
-        supplier_name_and_location = get_suppliers_name_and_location(duckdb_conn)
-        
-        if supplier_name_and_location.empty:
-            print(f"Error: No suppliers available in database")
-            return False
-        
-        supplier_match = supplier_name_and_location[supplier_name_and_location['supplier_site_id'] == supplier]
-        
-        if supplier_match.empty:
-            print(f"Error: Supplier '{supplier}' not found in database")
-            return False
-        
-        supplier_id = int(supplier_match['supplier_site_id'].values[0])
-
-        query = """
-            INSERT INTO requests (customer_id, requested_supplier_site_id, request_date, requested_standard)
-            VALUES (?, ?, ?, ?)
-        """
-        duckdb_conn.execute(query, [int(customer_id), supplier_id, request_date, request_type])
-        duckdb_conn.commit()
-        return True
+        request = (int(customer_id), int(supplier), request_date, request_type, quality_officer_id)
+        outcomes = request_writer.write_requests(duckdb_conn, [request], [source])
     except Exception as e:
         print(f"Error writing request to database: {e}")
         return False
+    if not outcomes:
+        return False
+    id_request, reason = outcomes[0]
+    if id_request is None:
+        print(f"Error: Request of customer '{customer_id}' was turned down: {reason}")
+        return False
+    return True
 
 
 def get_supplier_site_id(duckdb_conn, location):
@@ -146,79 +116,66 @@ def get_supplier_site_id(duckdb_conn, location):
         query = """
             SELECT supplier_site_id FROM suppliers WHERE supplier_site_location = ? LIMIT 1
         """
-        result = duckdb_conn.execute(query, [location]).df()
-        if not result.empty:
-            return result.iloc[0, 0]
-        else:
-            return None
+        return results.fetch_scalar(duckdb_conn, query, [location])
     except Exception as e:
         print(f"Error getting supplier site ID: {e}")
         return None
 
 def get_suppliers_name_and_location(duckdb_conn):
-    """Get all available suppliers with their names and locations. Returns empty DataFrame on error."""
+    """Get all available suppliers with their names and locations. Returns an empty Arrow table on error."""
     try:
         query = """
             SELECT supplier_site_id, supplier_site_name, supplier_site_country
             FROM suppliers
             WHERE supplier_site_availability = true
         """
-        result = duckdb_conn.sql(query).df()
-        return result
+        return results.fetch_table(duckdb_conn, query)
     except Exception as e:
         print(f"Error getting suppliers name and location: {e}")
-        import pandas as pd
-        return pd.DataFrame()
+        return results.empty_table()
     
 
 def get_audit_type_by_date(duckdb_conn):
-    """Get audit requests grouped by standard and date. Returns empty DataFrame on error."""
+    """Get audit requests grouped by standard and date. Returns an empty Arrow table on error."""
     try:
         query = """
-            SELECT requested_standard, request_date, count(*) as total_requests
-            FROM requests
+            SELECT requested_standard, request_date, sum(total_requests)::BIGINT as total_requests
+            FROM kpi_daily
             WHERE requested_standard IS NOT NULL
             GROUP BY requested_standard, request_date
             ORDER BY request_date
         """
-        result = duckdb_conn.sql(query).df()
-        return result
+        return results.fetch_table(duckdb_conn, query)
     except Exception as e:
         print(f"Error getting audit type by date: {e}")
-        import pandas as pd
-        return pd.DataFrame()
+        return results.empty_table()
 
 
 def get_audits_by_date(duckdb_conn):
-    """Get audit requests grouped by date for time series analysis. Returns empty DataFrame on error."""
+    """Get audit requests grouped by date for time series analysis. Returns an empty Arrow table on error."""
     try:
         query = """
-            SELECT date_trunc('day', request_date) as ds, count(*) as y
-            FROM requests
+            SELECT date_trunc('day', request_date) as ds, sum(total_requests)::BIGINT as y
+            FROM kpi_daily
             WHERE requested_standard IS NOT NULL
             GROUP BY ds
             ORDER BY ds
         """
-        result = duckdb_conn.sql(query).df()
-        return result
+        return results.fetch_table(duckdb_conn, query)
     except Exception as e:
         print(f"Error getting audits by date: {e}")
-        import pandas as pd
-        return pd.DataFrame()
+        return results.empty_table()
 
 def avg_timeof_resolution(duckdb_conn):
     """Get average time of resolution in days. Returns 0 on error or if no data."""
     try:
         query = """
             SELECT
-            round(avg(consumed_date-reserved_date),1) as avg_timeof_resolution
-            FROM FACT_REQUESTS
-            WHERE consumed_date IS NOT NULL
+            round(sum(resolution_days) / sum(resolved_requests),1) as avg_timeof_resolution
+            FROM kpi_daily
+            WHERE resolved_requests > 0
         """
-        result = duckdb_conn.sql(query).df()
-        if result.empty or result.iloc[0, 0] is None:
-            return 0
-        return float(result.iloc[0, 0])
+        return float(results.fetch_scalar(duckdb_conn, query, default=0))
     except Exception as e:
         print(f"Error getting average time of resolution: {e}")
         return 0
@@ -228,52 +185,30 @@ def get_credits_by_customer(duckdb_conn):
     try:
         query = """
             SELECT
-            round(avg(available_credits),1) as avg_credits_by_customer
-            FROM (
-                SELECT customer_id, count(credit_id) as available_credits
-                FROM credits
-                WHERE credit_state = 'available'
-                GROUP BY customer_id
-            )
+            round(avg(available),1) as avg_credits_by_customer
+            FROM credit_balances
+            WHERE available > 0
         """
-        result = duckdb_conn.sql(query).df()
-        if result.empty or result.iloc[0, 0] is None:
-            return 0
-        return float(result.iloc[0, 0])
+        return float(results.fetch_scalar(duckdb_conn, query, default=0))
     except Exception as e:
         print(f"Error getting credits by customer: {e}")
         return 0
 
 
-def get_90d_requests(duckdb_conn):
-    """Get all requests from the last 90 days. Returns empty DataFrame on error."""
-    try:
-        query = """
-            SELECT
-                credit_state
-            FROM FACT_REQUESTS
-            WHERE request_date >= current_date - interval '90' day
-        """
-        result = duckdb_conn.sql(query).df()
-        return result
-    except Exception as e:
-        print(f"Error getting 90 day requests: {e}")
-        import pandas as pd
-        return pd.DataFrame()
+def get_90d_funnel(duckdb_conn):
+    """Get the number of events of each request state transition from the last 90 days, read from the event log. Returns an empty dict on error."""
+    return event_log.get_funnel(duckdb_conn, 90)
 
 def get_valid_requests(duckdb_conn):
     """Get count of valid (reserved) requests from last 30 days. Returns 0 on error."""
     try:
         query = """
             SELECT
-            count(*) as valid_requests
-            FROM FACT_REQUESTS
+            COALESCE(sum(total_requests), 0) as valid_requests
+            FROM kpi_daily
             WHERE credit_state = 'reserved' and request_date >= current_date - interval '30' day
         """
-        result = duckdb_conn.sql(query).df()
-        if result.empty:
-            return 0
-        return int(result.iloc[0, 0])
+        return int(results.fetch_scalar(duckdb_conn, query, default=0))
     except Exception as e:
         print(f"Error getting valid requests: {e}")
         return 0
@@ -283,61 +218,42 @@ def get_finished_requests(duckdb_conn):
     try:
         query = """
             SELECT
-            count(*) as finished_requests
-            FROM FACT_REQUESTS
+            COALESCE(sum(total_requests), 0) as finished_requests
+            FROM kpi_daily
             WHERE credit_state = 'consumed' and request_date >= current_date - interval '30' day
         """
-        result = duckdb_conn.sql(query).df()
-        if result.empty:
-            return 0
-        return int(result.iloc[0, 0])
+        return int(results.fetch_scalar(duckdb_conn, query, default=0))
     except Exception as e:
         print(f"Error getting finished requests: {e}")
         return 0
 
 
-def is_supplier_available(duckdb_conn, supplier_site_id):
-    """Check if supplier is available. Returns False if not available or on error."""
+def get_supplier(duckdb_conn, supplier_site_id):
+    """Get a supplier site from the in-memory copy of suppliers. Returns None if not found or on error."""
     if not supplier_site_id:
-        return False
+        return None
 
     try:
-        query = """
-            SELECT supplier_site_availability FROM suppliers WHERE supplier_site_id = ? LIMIT 1
-        """
-        result = duckdb_conn.execute(query, [int(supplier_site_id)]).df()
-
-        if not result.empty:
-            return bool(result.iloc[0, 0])
-        else:
-            return False
+        return dimensions.suppliers.get(duckdb_conn, int(supplier_site_id))
     except Exception as e:
-        print(f"Error checking supplier availability: {e}")
-        return False
+        print(f"Error getting supplier: {e}")
+        return None
+
+def is_supplier_available(duckdb_conn, supplier_site_id):
+    """Check if supplier is available. Returns False if not available or on error."""
+    supplier = get_supplier(duckdb_conn, supplier_site_id)
+    return bool(supplier.supplier_site_availability) if supplier else False
 
 def is_supplier_blacklisted(duckdb_conn, supplier_site_id, request_date):
-    """Check if supplier is blacklisted on the given date. Returns False if not blacklisted or on error."""
+    """Check if supplier is blacklisted on the given date, open ended windows included. Returns True if blacklisted or on error."""
     if not supplier_site_id or not request_date:
         return False
 
     try:
-        query = """
-            SELECT COUNT(*) as count FROM blacklist
-            WHERE supplier_site_id = ?
-            AND blacklist_since <= ?
-            AND blacklist_until >= ?
-            LIMIT 1
-        """
-        
-        result = duckdb_conn.execute(query, [int(supplier_site_id), request_date, request_date]).df()
-        
-        if not result.empty:
-            return int(result.iloc[0, 0]) == 0
-        else:
-            return False
+        return blacklist.get_blacklist_index(duckdb_conn).is_blacklisted(supplier_site_id, request_date)
     except Exception as e:
         print(f"Error checking supplier blacklist status: {e}")
-        return False
+        return True
     
 def check_table_exists(duckdb_conn, table_name, schema='main'):
     """Check if a table exists in the database. Returns True if exists, False otherwise."""
@@ -0,0 +1,302 @@
+'''
+validation.py
+This file validates a single request through a pipeline of independent rules.
+Rules are grouped in stages: the completeness check runs first, on the form values alone, and the
+rules that query the database (credit balance, blacklist, availability, quality officer assignment)
+then run concurrently on a thread pool, each on its own pooled reader cursor. The first failure
+short-circuits the pipeline and the rules still running are reported as skipped.
+The verdict lists every rule with its outcome and timing.
+Nothing here depends on Streamlit: the request page is one client of validate, the batch command
+line below is another, for cron jobs and benchmarks.
+
+Usage:
+    python -m tools.validation requests.csv --out verdicts.parquet
+    python -m tools.validation requests.csv --out verdicts.parquet --snapshot     # while the app runs
+'''
+import argparse
+import asyncio
+import collections
+import csv
+import datetime
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import tools.dimensions as dimensions
+import tools.ledger as ledger
+import tools.results as results
+import tools.utils as utils
+
+ValidationRequest = collections.namedtuple(
+    "ValidationRequest", ["customer_id", "supplier_site_id", "request_date", "requested_standard"]
+)
+Rule = collections.namedtuple("Rule", ["name", "check"])
+RuleResult = collections.namedtuple("RuleResult", ["name", "status", "message", "value", "seconds"])
+Verdict = collections.namedtuple("Verdict", ["valid", "results", "seconds"])
+# a field read from a file that could not be parsed, keeping the text as it was written
+Malformed = collections.namedtuple("Malformed", ["text"])
+
+PASSED, FAILED, SKIPPED = "passed", "failed", "skipped"
+
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="validation")
+
+
+def check_completeness(conn, request):
+    """The request says who, where, when and which standard."""
+    malformed = [f"{field} '{value.text}'" for field, value in zip(request._fields, request) if isinstance(value, Malformed)]
+    if malformed:
+        return False, f"Malformed fields: {', '.join(malformed)}.", None
+    if not request.customer_id or not request.supplier_site_id or not request.request_date:
+        return False, "Please fill in all required fields: Customer ID, Supplier, and Request Date.", None
+    if request.requested_standard not in ledger.REQUIRED_CREDITS:
+        return False, f"Invalid request type. Please choose from: {', '.join(ledger.REQUIRED_CREDITS)}.", None
+    return True, "All required fields are filled in.", None
+
+
+def check_credits(conn, request):
+    """The customer has enough available credits for the standard."""
+    required = ledger.REQUIRED_CREDITS[request.requested_standard]
+    available = utils.get_customer_credits(conn, request.customer_id)
+    if available < required:
+        return (
+            False,
+            f"Customer does not have enough credits for {request.requested_standard}. Required: {required}, Available: {available}.",
+            available,
+        )
+    return True, f"Customer has {available} credits available.", available
+
+
+def check_blacklist(conn, request):
+    """The supplier is not blacklisted on the request date."""
+    if utils.is_supplier_blacklisted(conn, request.supplier_site_id, request.request_date):
+        return False, "Supplier is blacklisted and cannot process requests.", None
+    return True, "Supplier is not blacklisted.", None
+
+
+def check_availability(conn, request):
+    """The supplier is available."""
+    if not utils.is_supplier_available(conn, request.supplier_site_id):
+        return False, "Supplier is not available to process requests.", None
+    return True, "Supplier is available.", None
+
+
+# the quality officer with the fewest reserved requests
+QUALITY_OFFICER_QUERY = """
+    SELECT q.quality_officer_id
+    FROM quality_officers q
+    LEFT JOIN fact_request f
+        ON f.quality_officer_id = q.quality_officer_id AND f.credit_state = 'reserved'
+    GROUP BY q.quality_officer_id
+    ORDER BY count(f.id_request), q.quality_officer_id
+    LIMIT 1
+"""
+
+
+def check_quality_officer(conn, request):
+    """A quality officer can take the request, the one with the fewest open requests is assigned."""
+    try:
+        officer_id = results.fetch_scalar(conn, QUALITY_OFFICER_QUERY)
+    except Exception as e:
+        print(f"Error assigning quality officer: {e}")
+        officer_id = None
+    if officer_id is None:
+        return False, "No quality officer is available to take the request.", None
+    officer = dimensions.quality_officers.get(conn, officer_id)
+    name = f"{officer.quality_officer_name} ({officer_id})" if officer else officer_id
+    return True, f"Quality officer {name} will handle the request.", int(officer_id)
+
+
+# rules of a stage run concurrently, a stage starts when the previous one passed
+STAGES = [
+    [Rule("completeness", check_completeness)],
+    [
+        Rule("credit_balance", check_credits),
+        Rule("blacklist", check_blacklist),
+        Rule("availability", check_availability),
+        Rule("quality_officer", check_quality_officer),
+    ],
+]
+
+
+def _run_rule(manager, rule, request):
+    started = time.perf_counter()
+    try:
+        with manager.reader() as conn:
+            passed, message, value = rule.check(conn, request)
+    except Exception as e:
+        print(f"Error running validation rule {rule.name}: {e}")
+        passed, message, value = False, f"Validation rule {rule.name} could not be evaluated.", None
+    return RuleResult(rule.name, PASSED if passed else FAILED, message, value, time.perf_counter() - started)
+
+
+async def validate_async(manager, request):
+    """Run the validation stages, stopping at the first failed rule. Returns a Verdict."""
+    started = time.perf_counter()
+    done_results = {}
+    failed = False
+
+    for stage in STAGES:
+        if failed:
+            break
+        # the awaitable of every rule, with the thread pool future that runs it
+        submitted = {}
+        for rule in stage:
+            future = _executor.submit(_run_rule, manager, rule, request)
+            submitted[asyncio.wrap_future(future)] = future
+        pending = set(submitted)
+        while pending and not failed:
+            finished, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for future in finished:
+                result = future.result()
+                done_results[result.name] = result
+                failed = failed or result.status == FAILED
+        # rules that did not start are dropped; the running ones are waited for, so no rule still
+        # holds a cursor once the verdict is returned and the caller may close the manager
+        running = {future for future in pending if not submitted[future].cancel()}
+        if running:
+            await asyncio.wait(running)
+
+    rule_results = [
+        done_results.get(rule.name, RuleResult(rule.name, SKIPPED, "Skipped after an earlier failure.", None, 0.0))
+        for stage in STAGES
+        for rule in stage
+    ]
+    return Verdict(not failed, rule_results, time.perf_counter() - started)
+
+
+def validate(manager, request):
+    """Validate a request from synchronous code. Returns a Verdict."""
+    return asyncio.run(validate_async(manager, request))
+
+
+def rule_value(verdict, name):
+    """Get the value a rule returned, such as the assigned quality officer. Returns None if the rule did not pass."""
+    for result in verdict.results:
+        if result.name == name and result.status == PASSED:
+            return result.value
+    return None
+
+
+async def validate_many_async(manager, requests, concurrency=8):
+    """Validate requests independently of each other, at most concurrency at a time. Returns the Verdicts in request order."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(request):
+        async with semaphore:
+            return await validate_async(manager, request)
+
+    return await asyncio.gather(*(bounded(request) for request in requests))
+
+
+def validate_many(manager, requests, concurrency=8):
+    """Validate requests from synchronous code, as if each was submitted alone. Returns the Verdicts in request order."""
+    return asyncio.run(validate_many_async(manager, requests, concurrency))
+
+
+# CSV columns of a request, the bulk upload format
+CSV_COLUMNS = ["customer_id", "requested_supplier_site_id", "request_date", "requested_standard"]
+
+
+def _parse(value, parse):
+    """Parse a CSV field. Returns None if it is empty, Malformed if it cannot be parsed."""
+    value = (value or "").strip()
+    try:
+        return parse(value) if value else None
+    except ValueError:
+        return Malformed(value)
+
+
+def _text(value):
+    """Write a request field back as text. Returns None if it is empty."""
+    if value is None:
+        return None
+    return value.text if isinstance(value, Malformed) else str(value)
+
+
+def read_requests(path):
+    """Read the requests of a CSV file in the bulk upload format. Raises ValueError if columns are missing."""
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.DictReader(f, skipinitialspace=True)
+        reader.fieldnames = [name.strip() for name in reader.fieldnames or []]
+        missing = [column for column in CSV_COLUMNS if column not in reader.fieldnames]
+        if missing:
+            raise ValueError(f"{path} is missing columns: {', '.join(missing)}")
+        return [
+            ValidationRequest(
+                _parse(row["customer_id"], int),
+                _parse(row["requested_supplier_site_id"], int),
+                _parse(row["request_date"], datetime.date.fromisoformat),
+                _parse(row["requested_standard"], str),
+            )
+            for row in reader
+        ]
+
+
+def write_verdicts(path, requests, verdicts):
+    """Write one row per request with its verdict, the first failed rule and the assigned quality officer as Parquet."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    rows = []
+    for row_number, (request, verdict) in enumerate(zip(requests, verdicts), start=1):
+        failed = next((result for result in verdict.results if result.status == FAILED), None)
+        rows.append({
+            "row_number": row_number,
+            "customer_id": _text(request.customer_id),
+            "requested_supplier_site_id": _text(request.supplier_site_id),
+            "request_date": _text(request.request_date),
+            "requested_standard": request.requested_standard,
+            "valid": verdict.valid,
+            "failed_rule": failed.name if failed else None,
+            "message": failed.message if failed else None,
+            "quality_officer_id": rule_value(verdict, "quality_officer") if verdict.valid else None,
+            "ms": verdict.seconds * 1000,
+        })
+    pq.write_table(pa.Table.from_pylist(rows), path)
+
+
+def main(argv=None):
+    import tools.connections as connections
+
+    parser = argparse.ArgumentParser(description="Validate the requests of a CSV file without Streamlit.")
+    parser.add_argument("requests", help="CSV file with customer_id, requested_supplier_site_id, request_date, requested_standard.")
+    parser.add_argument("--out", default="verdicts.parquet", help="Parquet file of the verdicts.")
+    parser.add_argument("--database", default=connections.DEFAULT_DATABASE, help="DuckDB database file.")
+    parser.add_argument("--snapshot", action="store_true", help="Read the current snapshot, the database is locked while the app runs.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Requests validated at the same time.")
+    args = parser.parse_args(argv)
+
+    try:
+        requests = read_requests(args.requests)
+    except (OSError, ValueError) as e:
+        print(f"Error reading requests: {e}")
+        return 2
+
+    if args.snapshot:
+        import tools.snapshots as snapshots
+
+        manager = snapshots.ReplicaManager(snapshots.snapshot_dir_from_env(), args.concurrency)
+    else:
+        import tools.qdb as qdb
+
+        manager = connections.ConnectionManager(args.database, args.concurrency, setup=qdb.setup_database)
+    try:
+        manager.open()
+    except Exception as e:
+        print(f"Error opening the database: {e}")
+        return 2
+    try:
+        started = time.perf_counter()
+        verdicts = validate_many(manager, requests, args.concurrency)
+        elapsed = time.perf_counter() - started
+    finally:
+        manager.close()
+
+    write_verdicts(args.out, requests, verdicts)
+    valid = sum(verdict.valid for verdict in verdicts)
+    print(f"{valid} of {len(verdicts)} requests valid in {elapsed:.2f} s, verdicts written to {args.out}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())